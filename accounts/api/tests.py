@@ -152,6 +152,7 @@ class AccountApiTest(TestCase):
 class UserProfileAPITests(TestCase):
 
     def test_update(self):
+        self.use_temporary_media_root()
         linghu, linghu_client = self.create_user_and_client('linghu')
         p = linghu.profile
         p.nickname = 'old nickname'
@@ -4,16 +4,21 @@ from comments.models import Comment
 from accounts.api.serializers import UserSerializerForComment
 from tweets.models import Tweet
 from likes.services import LikeService
-from utils.redis_helper import RedisHelper
+from utils.count_serializers import (
+    CountsListSerializer,
+    CountsSerializerMixin,
+)
 
 
-class CommentSerializer(serializers.ModelSerializer):
+class CommentSerializer(CountsSerializerMixin, serializers.ModelSerializer):
     user = UserSerializerForComment(source='cached_user')
     has_liked = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
+    count_attrs = ('likes_count',)
 
     class Meta:
         model = Comment
+        list_serializer_class = CountsListSerializer
         fields = (
             'id',
             'tweet_id',
@@ -25,7 +30,7 @@ class CommentSerializer(serializers.ModelSerializer):
         )
 
     def get_likes_count(self, obj):
-        return RedisHelper.get_count(obj, 'likes_count')
+        return self.get_count(obj, 'likes_count')
 
     def get_has_liked(self, obj):
         return LikeService.has_liked(self.context['request'].user, obj)
@@ -1,4 +1,5 @@
 from utils.redis_helper import RedisHelper
+from utils.write_behind_counters import WriteBehindCounter
 
 
 def incr_comments_count(sender, instance, created, **kwargs):
@@ -7,6 +8,11 @@ def incr_comments_count(sender, instance, created, **kwargs):
 
     if not created:
         return
+    # write-behind模式下只修改redis，由flush_counts_task批量写入数据库
+    if WriteBehindCounter.is_enabled():
+        WriteBehindCounter.incr_count(
+            Tweet(id=instance.tweet_id), 'comments_count')
+        return
     Tweet.objects.filter(id=instance.tweet_id)\
         .update(comments_count=F('comments_count') + 1)
     # invalidate_object_cache(sender=Tweet, instance=instance.tweet)
@@ -17,7 +23,24 @@ def decr_comments_count(sender, instance, **kwargs):
     from tweets.models import Tweet
     from django.db.models import F
 
+    if WriteBehindCounter.is_enabled():
+        WriteBehindCounter.decr_count(
+            Tweet(id=instance.tweet_id), 'comments_count')
+        return
     Tweet.objects.filter(id=instance.tweet_id) \
         .update(comments_count=F('comments_count') - 1)
     # invalidate_object_cache(sender=Tweet, instance=instance.tweet)
     RedisHelper.decr_count(instance.tweet, 'comments_count')
+
+
+def count_comments(model_class, object_ids):
+    """
+    实际的comments数量，用于WriteBehindCounter.reconcile
+    """
+    from comments.models import Comment
+    from django.db.models import Count
+
+    rows = Comment.objects.filter(
+        tweet_id__in=object_ids,
+    ).values('tweet_id').annotate(count=Count('id'))
+    return {row['tweet_id']: row['count'] for row in rows}
@@ -5,7 +5,12 @@ from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 from utils.memcached_helper import MemcachedHelper
 from django.db.models.signals import pre_delete, post_save
-from comments.listeners import incr_comments_count, decr_comments_count
+from utils.write_behind_counters import WriteBehindCounter
+from comments.listeners import (
+    count_comments,
+    decr_comments_count,
+    incr_comments_count,
+)
 
 
 class Comment(models.Model):
@@ -46,3 +51,5 @@ class Comment(models.Model):
 
 pre_delete.connect(decr_comments_count, sender=Comment)
 post_save.connect(incr_comments_count, sender=Comment)
+
+WriteBehindCounter.register('tweets.Tweet', 'comments_count', count_comments)
@@ -1,4 +1,17 @@
 from testing.testcases import TestCase
+from gatekeeper.models import GateKeeper
+from likes.tasks import flush_counts_task, reconcile_counts_task
+from tweets.models import Tweet
+from utils.redis_client import RedisClient
+from utils.redis_helper import (
+    DIRTY_COUNTS_KEY,
+    FLUSHING_COUNTS_KEY,
+    RedisHelper,
+)
+from utils.write_behind_counters import (
+    RECONCILE_COUNTS_KEY,
+    WriteBehindCounter,
+)
 
 
 class CommentModelTests(TestCase):
@@ -24,3 +37,110 @@ class CommentModelTests(TestCase):
         dongxie = self.create_user('dongxie')
         self.create_like(dongxie, self.comment)
         self.assertEqual(self.comment.like_set.count(), 2)
+
+    def test_write_behind_counts(self):
+        GateKeeper.turn_on(WriteBehindCounter.switch_name)
+        dongxie = self.create_user('dongxie')
+        self.create_like(self.linghu, self.tweet)
+        self.create_like(dongxie, self.tweet)
+        self.create_like(dongxie, self.comment)
+        comment = self.create_comment(dongxie, self.tweet)
+        comment.delete()
+
+        # 只修改了redis，数据库中还没有变化
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+        self.assertEqual(
+            RedisHelper.get_count(self.tweet, 'comments_count'), 1)
+
+        # 每个count字段只需要一条UPDATE，另外两条是事务的SAVEPOINT和RELEASE
+        with self.assertNumQueries(4):
+            self.assertEqual(flush_counts_task(), '2 rows flushed')
+        self.tweet.refresh_from_db()
+        self.comment.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(self.tweet.comments_count, 1)
+        self.assertEqual(self.comment.likes_count, 1)
+        self.assertEqual(flush_counts_task(), '0 rows flushed')
+
+        # 数据库和redis都漂移了，reconcile用实际的数量修复
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=10)
+        RedisClient.get_connection().set(
+            RedisHelper.get_count_key(self.tweet, 'likes_count'), 20)
+        # 还没有flush的增量会被保留
+        self.create_like(self.create_user('xiaoming'), self.tweet)
+        self.assertEqual(reconcile_counts_task(), '3 rows reconciled')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 3)
+        flush_counts_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 3)
+
+    def test_write_behind_reconcile_race(self):
+        GateKeeper.turn_on(WriteBehindCounter.switch_name)
+        self.create_like(self.linghu, self.tweet)
+        flush_counts_task()
+        key = RedisHelper.get_count_key(self.tweet, 'likes_count')
+        conn = RedisClient.get_connection()
+        conn.set(key, 10)
+
+        # count之前的like已经在数据库中，增量在count和脚本之间才写入redis
+        model_label, attr, count_likes = WriteBehindCounter.counters[
+            'Tweet.likes_count']
+        dongxie = self.create_user('dongxie')
+
+        def count_with_like(model_class, object_ids):
+            if not self.tweet.like_set.filter(user=dongxie).exists():
+                self.create_like(dongxie, self.tweet)
+            return count_likes(model_class, object_ids)
+
+        WriteBehindCounter.counters['Tweet.likes_count'] = (
+            model_label, attr, count_with_like)
+        self.addCleanup(
+            WriteBehindCounter.counters.__setitem__,
+            'Tweet.likes_count',
+            (model_label, attr, count_likes),
+        )
+
+        # 增量变了，跳过这个key，放回去下一次reconcile
+        self.assertEqual(reconcile_counts_task(), '0 rows reconciled')
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 11)
+        self.assertEqual(conn.sismember(RECONCILE_COUNTS_KEY, key), True)
+
+        # 下一次增量没有变化，redis和数据库都被修复，flush之后不会多加1
+        self.assertEqual(reconcile_counts_task(), '1 rows reconciled')
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 2)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        flush_counts_task()
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 2)
+
+        # 上一次flush失败时，FLUSHING_COUNTS_KEY中的增量也还没有写入数据库
+        conn.hset(FLUSHING_COUNTS_KEY, key, 1)
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=5)
+        conn.sadd(RECONCILE_COUNTS_KEY, key)
+        self.assertEqual(reconcile_counts_task(), '1 rows reconciled')
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+    def test_write_behind_flush_is_atomic(self):
+        GateKeeper.turn_on(WriteBehindCounter.switch_name)
+        self.create_like(self.linghu, self.tweet)
+        # 第二个counter的UPDATE会失败
+        WriteBehindCounter.register('tweets.Tweet', 'missing_count', None)
+        self.addCleanup(WriteBehindCounter.counters.pop, 'Tweet.missing_count')
+        RedisClient.get_connection().hincrby(
+            DIRTY_COUNTS_KEY, f'Tweet.missing_count:{self.tweet.id}', 1)
+
+        # 不存在的字段，django在生成UPDATE时就会报错
+        with self.assertRaises(Exception):
+            flush_counts_task()
+        # 第一个counter的UPDATE也被回滚了，增量还在，下一次flush不会重复写入
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(RedisClient.get_connection().hget(
+            FLUSHING_COUNTS_KEY, f'Tweet.likes_count:{self.tweet.id}'), b'1')
@@ -0,0 +1,223 @@
+from collections import OrderedDict
+from django.conf import settings
+from utils.redis_client import RedisClient
+
+import base64
+import hashlib
+import json
+import threading
+import uuid
+
+STAT_NAMES = ('local_hits', 'redis_hits', 'misses', 'invalidations')
+
+
+class HBaseScanCache:
+    """
+    HBaseModel.filter的read-through cache，在Meta中设置scan_cache = True开启
+    分两层：进程内的LRU和所有进程共享的redis，key由scan的参数生成
+    每个row key前缀(row key中第一个field的值，例如user_id)和每个table都有一个
+    version token存在redis中，写入时删除对应的token，之后读到的是新的token，
+    旧token下缓存的结果就不会再被读到，等待过期即可，不需要逐个删除
+    - prefix或者start/stop限定在同一个第一个field的scan，使用这个前缀的token
+    - 其它scan使用table的token，任何写入都会让它失效
+    每次读取都需要从redis中取一次token(进程内的LRU也是)，但比一次Thrift scan便宜
+    """
+    lock = threading.Lock()
+    # {cache_key: serialized instances}
+    local_cache = OrderedDict()
+    # {table_name: {'local_hits': 0, 'redis_hits': 0, 'misses': 0, ...}}
+    stats = {}
+
+    @classmethod
+    def get_partition(cls, start, stop, prefix):
+        if prefix:
+            partition = prefix[0]
+        elif start and stop and str(start[0]) == str(stop[0]):
+            partition = start[0]
+        else:
+            partition = None
+        return None if partition is None else str(partition)
+
+    @classmethod
+    def get_version_key(cls, model_class, partition=None):
+        table_name = model_class.get_table_name()
+        if partition is None:
+            return f'hbase_scan:{table_name}:version'
+        return f'hbase_scan:{table_name}:{partition}:version'
+
+    @classmethod
+    def get_version(cls, conn, version_key):
+        version = conn.get(version_key)
+        if version is not None:
+            return version.decode('utf-8')
+        version = uuid.uuid4().hex
+        # 多个进程同时创建时，以先写入的为准
+        if not conn.set(
+                version_key, version, nx=True,
+                ex=settings.REDIS_KEY_EXPIRE_TIME):
+            version = conn.get(version_key).decode('utf-8')
+        return version
+
+    @classmethod
+    def get_cache_key(cls, model_class, version, **scan_kwargs):
+        # row key序列化之后的值是确定的，str和int的user_id会得到相同的key
+        scan_args = (
+            model_class.serialize_row_key_from_tuple(scan_kwargs['start']),
+            model_class.serialize_row_key_from_tuple(scan_kwargs['stop']),
+            model_class.serialize_row_key_from_tuple(scan_kwargs['prefix']),
+            scan_kwargs['limit'],
+            scan_kwargs['reverse'],
+            model_class.serialize_columns(scan_kwargs['columns']),
+        )
+        digest = hashlib.md5(repr(scan_args).encode('utf-8')).hexdigest()
+        return f'hbase_scan:{model_class.get_table_name()}:{version}:{digest}'
+
+    @classmethod
+    def incr_stat(cls, model_class, name):
+        with cls.lock:
+            stats = cls.stats.setdefault(
+                model_class.get_table_name(), dict.fromkeys(STAT_NAMES, 0))
+            stats[name] += 1
+
+    @classmethod
+    def get_stats(cls, model_class):
+        """
+        当前进程中的命中次数
+        """
+        with cls.lock:
+            return dict(cls.stats.get(
+                model_class.get_table_name(), dict.fromkeys(STAT_NAMES, 0)))
+
+    @classmethod
+    def get_local(cls, cache_key):
+        with cls.lock:
+            serialized_data = cls.local_cache.get(cache_key)
+            if serialized_data is not None:
+                cls.local_cache.move_to_end(cache_key)
+            return serialized_data
+
+    @classmethod
+    def set_local(cls, cache_key, serialized_data):
+        with cls.lock:
+            cls.local_cache[cache_key] = serialized_data
+            cls.local_cache.move_to_end(cache_key)
+            while len(cls.local_cache) > settings.HBASE_SCAN_CACHE_LOCAL_SIZE:
+                cls.local_cache.popitem(last=False)
+
+    @classmethod
+    def encode_value(cls, value):
+        # json不支持bytes，用base64编码并标记类型
+        if isinstance(value, bytes):
+            return {'__bytes__': base64.b64encode(value).decode('ascii')}
+        return value
+
+    @classmethod
+    def decode_value(cls, value):
+        if isinstance(value, dict) and '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        return value
+
+    @classmethod
+    def serialize(cls, instances):
+        return json.dumps([
+            {
+                key: cls.encode_value(value)
+                for key, value in instance.to_dict().items()
+            }
+            for instance in instances
+        ])
+
+    @classmethod
+    def deserialize(cls, model_class, serialized_data):
+        instances = []
+        for data in json.loads(serialized_data):
+            instance = model_class(**{
+                key: cls.decode_value(value) for key, value in data.items()
+            })
+            # 缓存的是HBase中的数据，不算被修改过
+            instance._original = instance.get_column_values()
+            instances.append(instance)
+        return instances
+
+    @classmethod
+    def filter(cls, model_class, start=None, stop=None, prefix=None,
+               limit=None, reverse=False, columns=None, **kwargs):
+        conn = RedisClient.get_connection()
+        partition = cls.get_partition(start, stop, prefix)
+        version = cls.get_version(
+            conn, cls.get_version_key(model_class, partition))
+        cache_key = cls.get_cache_key(
+            model_class, version, start=start, stop=stop, prefix=prefix,
+            limit=limit, reverse=reverse, columns=columns)
+
+        serialized_data = cls.get_local(cache_key)
+        if serialized_data is not None:
+            cls.incr_stat(model_class, 'local_hits')
+            return cls.deserialize(model_class, serialized_data)
+
+        serialized_data = conn.get(cache_key)
+        if serialized_data is not None:
+            cls.incr_stat(model_class, 'redis_hits')
+            cls.set_local(cache_key, serialized_data)
+            return cls.deserialize(model_class, serialized_data)
+
+        cls.incr_stat(model_class, 'misses')
+        instances = model_class.list_filter(
+            start=start, stop=stop, prefix=prefix, limit=limit,
+            reverse=reverse, columns=columns, **kwargs)
+        serialized_data = cls.serialize(instances)
+        conn.set(
+            cache_key, serialized_data, ex=settings.HBASE_SCAN_CACHE_TIMEOUT)
+        cls.set_local(cache_key, serialized_data)
+        return instances
+
+    @classmethod
+    def get_invalidation_keys(cls, model_class, data):
+        partition = data.get(model_class._schema.row_key[0])
+        version_keys = [cls.get_version_key(model_class)]
+        if partition is not None:
+            version_keys.append(
+                cls.get_version_key(model_class, str(partition)))
+        return version_keys
+
+    @classmethod
+    def invalidate(cls, model_class, data):
+        """
+        data中需要包含row key的第一个field，写入HBase之后调用
+        """
+        cls.invalidate_many([(model_class, data)])
+
+    @classmethod
+    def invalidate_many(cls, invalidations):
+        """
+        invalidations: [(model_class, data)]，batch和HBaseBufferedWriter写入之后
+        所有的version token只需要一次DELETE，而不是每一行一次redis请求
+        """
+        version_keys = set()
+        for model_class, data in invalidations:
+            version_keys.update(cls.get_invalidation_keys(model_class, data))
+            cls.incr_stat(model_class, 'invalidations')
+        if version_keys:
+            RedisClient.get_connection().delete(*version_keys)
+
+    @classmethod
+    def invalidate_table(cls, model_class):
+        """
+        让整个table的缓存都失效，包括每个前缀的token，例如migrate_row_keys之后
+        前缀的token是用SCAN找到的，只适合偶尔执行的操作
+        """
+        conn = RedisClient.get_connection()
+        table_name = model_class.get_table_name()
+        version_keys = [cls.get_version_key(model_class)]
+        version_keys.extend(conn.scan_iter(
+            match=f'hbase_scan:{table_name}:*:version', count=1000))
+        # 分批删除，避免一次DELETE的参数太多
+        for index in range(0, len(version_keys), 1000):
+            conn.delete(*version_keys[index: index + 1000])
+        cls.incr_stat(model_class, 'invalidations')
+
+    @classmethod
+    def clear_local(cls):
+        with cls.lock:
+            cls.local_cache.clear()
+            cls.stats.clear()
@@ -1,14 +1,121 @@
+from contextlib import contextmanager
 from django.conf import settings
+from django_hbase.memory import MemoryConnectionPool
+from thriftpy2.transport import TTransportException
 
+import functools
 import happybase
+import os
+import random
+import threading
+import time
+
+# 可以重试的错误：网络断开、超时等，happybase会在归还connection之前刷新它
+# HBase本身返回的错误(例如IOError, IllegalArgument)重试也没有用
+TRANSIENT_ERRORS = (TTransportException, OSError)
+
+
+def retry_on_thrift_error(func):
+    """
+    遇到TRANSIENT_ERRORS时重试settings.HBASE_RETRIES次，每次等待的时间指数增长
+    只能用在幂等的操作上(get, scan, put, delete)，counter_inc和checkAndPut
+    重试可能会重复执行
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(settings.HBASE_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except TRANSIENT_ERRORS:
+                if attempt == settings.HBASE_RETRIES:
+                    raise
+                backoff = min(
+                    settings.HBASE_RETRY_BACKOFF * 2 ** attempt,
+                    settings.HBASE_RETRY_MAX_BACKOFF,
+                )
+                # 加上随机抖动，避免大量线程同时重试
+                time.sleep(backoff * random.uniform(0.5, 1))
+    return wrapper
 
 
 class HBaseClient:
-    conn = None
+    """
+    HBase的连接池，每个进程一个pool
+    gunicorn/celery的worker都是fork出来的子进程，fork之后父进程的Thrift socket
+    会被父子进程共享，同时读写会把数据搞乱，所以需要根据pid判断是否在新的进程中，
+    如果是，就重新创建一个pool
+    happybase.ConnectionPool本身是线程安全的，每个线程会借到不同的connection，
+    这样多个线程可以并行访问HBase，而不是排队使用同一个connection
+    """
+    pool = None
+    pid = None
+    lock = threading.Lock()
+
+    @classmethod
+    def get_pool(cls):
+        pid = os.getpid()
+        if cls.pool is not None and cls.pid == pid:
+            return cls.pool
+
+        with cls.lock:
+            # double check，避免多个线程同时创建pool
+            if cls.pool is None or cls.pid != pid:
+                # 不要close父进程留下来的connection，否则会把父进程的socket关掉
+                cls.pool = cls.create_pool()
+                cls.pid = pid
+        return cls.pool
+
+    @classmethod
+    def create_pool(cls):
+        """
+        HBASE_BACKEND为'memory'时使用内存中的HBase，不需要启动HBase和Thrift server，
+        用于在本地benchmark和profile，每次请求会额外等待HBASE_MEMORY_LATENCY秒
+        """
+        if settings.HBASE_BACKEND == 'memory':
+            return MemoryConnectionPool(
+                size=settings.HBASE_POOL_SIZE,
+                latency=settings.HBASE_MEMORY_LATENCY,
+                table_prefix=settings.HBASE_TABLE_PREFIX,
+            )
+        return happybase.ConnectionPool(
+            size=settings.HBASE_POOL_SIZE,
+            **cls.get_connection_kwargs(),
+        )
+
+    @classmethod
+    def get_connection_kwargs(cls):
+        """
+        happybase.Connection的参数，transport和protocol必须和Thrift server启动时
+        的参数一致(hbase thrift start -f -c 对应framed和compact)
+        """
+        return {
+            'host': settings.HBASE_HOST,
+            'port': settings.HBASE_PORT,
+            'transport': settings.HBASE_TRANSPORT,
+            'protocol': settings.HBASE_PROTOCOL,
+            # in milliseconds，不设置的话region server卡住时请求会一直等待
+            'timeout': settings.HBASE_TIMEOUT,
+            'table_prefix': settings.HBASE_TABLE_PREFIX,
+        }
+
+    @classmethod
+    @contextmanager
+    def connection(cls):
+        """
+        从pool中借一个connection，with结束后自动归还
+        如果在HBASE_POOL_TIMEOUT秒内借不到，会抛出NoConnectionsAvailable
+        如果Thrift transport出错，happybase会在归还之前刷新这个connection，
+        下一次借到它时会自动重连
+        """
+        pool = cls.get_pool()
+        with pool.connection(timeout=settings.HBASE_POOL_TIMEOUT) as conn:
+            yield conn
 
     @classmethod
-    def get_connection(cls):
-        if cls.conn:
-            return cls.conn
-        cls.conn = happybase.Connection(settings.HBASE_HOST)
-        return cls.conn
+    def reset(cls):
+        """
+        丢弃当前进程的pool，下一次调用时会重新创建
+        """
+        with cls.lock:
+            cls.pool = None
+            cls.pid = None
@@ -0,0 +1,129 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django_hbase.client import HBaseClient, TRANSIENT_ERRORS
+from django_hbase.memory import MemoryConnection
+from friendships.models import HBaseFollowing
+from newsfeeds.models import HBaseNewsFeed
+from thriftpy2.thrift import TException
+
+import happybase
+import time
+import uuid
+
+# 和线上的row key/column一样的数据
+# {name: (model_class, row key的第一个field, column field)}
+ROW_SHAPES = {
+    'newsfeeds': (HBaseNewsFeed, 'user_id', 'tweet_id'),
+    'followings': (HBaseFollowing, 'from_user_id', 'to_user_id'),
+}
+
+
+class Command(BaseCommand):
+    help = 'Compare Thrift transport/protocol combinations by timing ' \
+           'puts, gets and prefix scans of newsfeed and following rows ' \
+           'in a temporary table. The Thrift server only accepts the ' \
+           'combination it was started with (hbase thrift start -f -c), ' \
+           'the others are reported as failed'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'combinations', nargs='*',
+            help='transport:protocol, e.g. buffered:binary framed:compact, '
+                 'defaults to HBASE_TRANSPORT:HBASE_PROTOCOL')
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--rows-per-user', type=int, default=50)
+        parser.add_argument('--rounds', type=int, default=3)
+
+    def handle(self, *args, **options):
+        combinations = options['combinations'] or [
+            f'{settings.HBASE_TRANSPORT}:{settings.HBASE_PROTOCOL}',
+        ]
+        for combination in combinations:
+            transport, _, protocol = combination.partition(':')
+            if transport not in happybase.connection.THRIFT_TRANSPORTS or \
+                    protocol not in happybase.connection.THRIFT_PROTOCOLS:
+                raise CommandError(f'invalid combination {combination}')
+
+        for combination in combinations:
+            transport, _, protocol = combination.partition(':')
+            for shape, (model_class, user_key, column_key) in \
+                    ROW_SHAPES.items():
+                rows = self.generate_rows(
+                    model_class, user_key, column_key,
+                    options['users'], options['rows_per_user'])
+                try:
+                    timings = self.run_benchmark(
+                        transport, protocol, model_class, rows,
+                        options['users'], options['rounds'])
+                except (TException,) + TRANSIENT_ERRORS as e:
+                    self.stdout.write(
+                        f'{combination} {shape}: failed '
+                        f'({e.__class__.__name__}: {e})')
+                    continue
+                self.stdout.write(f'{combination} {shape}: ' + ', '.join(
+                    f'{name} {seconds * 1000:.2f}ms'
+                    for name, seconds in timings.items()
+                ))
+
+    def create_connection(self, transport, protocol):
+        if settings.HBASE_BACKEND == 'memory':
+            # 进程内的HBase没有Thrift协议，只能用来检查这个command本身
+            return MemoryConnection(latency=settings.HBASE_MEMORY_LATENCY)
+        kwargs = HBaseClient.get_connection_kwargs()
+        kwargs.update(transport=transport, protocol=protocol)
+        return happybase.Connection(**kwargs)
+
+    def generate_rows(self, model_class, user_key, column_key,
+                      users, rows_per_user):
+        created_at = int(time.time() * 1000000)
+        rows = []
+        for user_id in range(1, users + 1):
+            for index in range(rows_per_user):
+                instance = model_class(**{
+                    user_key: user_id,
+                    'created_at': created_at + index,
+                    column_key: user_id * rows_per_user + index,
+                })
+                rows.append((
+                    instance.row_key,
+                    instance.serialize_row_data(instance.to_dict()),
+                ))
+        return rows
+
+    def run_benchmark(self, transport, protocol, model_class, rows,
+                      users, rounds):
+        """
+        返回每种操作在rounds轮中的平均耗时(in seconds)
+        """
+        conn = self.create_connection(transport, protocol)
+        table_name = f'benchmark_{uuid.uuid4().hex[:8]}'
+        timings = {'put': 0, 'get': 0, 'scan': 0}
+        try:
+            conn.create_table(table_name, model_class.get_column_families())
+            table = conn.table(table_name)
+            for _ in range(rounds):
+                start = time.perf_counter()
+                with table.batch() as batch:
+                    for row_key, row_data in rows:
+                        batch.put(row_key, row_data)
+                timings['put'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                for row_key, _ in rows[::max(len(rows) // 100, 1)]:
+                    table.row(row_key)
+                timings['get'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                for user_id in range(1, users + 1):
+                    prefix = model_class.serialize_row_key_from_tuple(
+                        (user_id, None))
+                    for _ in table.scan(row_prefix=prefix):
+                        pass
+                timings['scan'] += time.perf_counter() - start
+        finally:
+            try:
+                conn.delete_table(table_name, disable=True)
+            except (TException,) + TRANSIENT_ERRORS:
+                pass
+            conn.close()
+        return {name: total / rounds for name, total in timings.items()}
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_hbase.models import HBaseModel
+from django_hbase.scanner import HBaseTableScanner
+
+
+class Command(BaseCommand):
+    help = 'Count the rows of HBase tables with a parallel full-table ' \
+           'scan, e.g. twitter_newsfeeds twitter_followers. Rerun with the ' \
+           'same --job to resume an interrupted count'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table_names', nargs='+')
+        parser.add_argument(
+            '--split', choices=['regions', 'salt'], default='regions')
+        parser.add_argument('--buckets', type=int, default=None)
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--job', default=None,
+            help='checkpoint the progress in redis under this name')
+
+    def handle(self, *args, **options):
+        models = {
+            model_class.Meta.table_name: model_class
+            for model_class in HBaseModel.__subclasses__()
+        }
+        for table_name in options['table_names']:
+            if table_name not in models:
+                raise CommandError(f'HBaseModel for {table_name} not found')
+            scanner = HBaseTableScanner(
+                models[table_name],
+                split=options['split'],
+                buckets=options['buckets'],
+                processes=options['processes'],
+                batch_size=options['batch_size'],
+                job_name=options['job'],
+            )
+            try:
+                count = scanner.run()
+            except ValueError as e:
+                raise CommandError(f'{table_name}: {e}')
+            scanner.clear_checkpoint()
+            self.stdout.write(f'{table_name}: {count} rows')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_hbase.models import HBaseModel
+
+
+class Command(BaseCommand):
+    help = 'Rewrite string row keys of HBase tables to the binary row key ' \
+           'codec, e.g. twitter_newsfeeds twitter_followings twitter_followers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table_names', nargs='+')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        models = {
+            model_class.Meta.table_name: model_class
+            for model_class in HBaseModel.__subclasses__()
+        }
+        for table_name in options['table_names']:
+            if table_name not in models:
+                raise CommandError(f'HBaseModel for {table_name} not found')
+            model_class = models[table_name]
+            if model_class._schema.row_key_codec.name != 'binary':
+                raise CommandError(
+                    f'Set row_key_codec = "binary" in '
+                    f'{model_class.__name__}.Meta before migrating')
+            migrated = model_class.migrate_row_keys(options['batch_size'])
+            self.stdout.write(f'{table_name}: {migrated} rows migrated')
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_hbase.models import HBaseModel
+
+
+class Command(BaseCommand):
+    help = 'Scan HBase tables and rewrite the rows of their Meta.indexes ' \
+           'tables, e.g. twitter_followings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table_names', nargs='+')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        models = {
+            model_class.Meta.table_name: model_class
+            for model_class in HBaseModel.__subclasses__()
+        }
+        for table_name in options['table_names']:
+            if table_name not in models:
+                raise CommandError(f'HBaseModel for {table_name} not found')
+            model_class = models[table_name]
+            if not model_class._schema.indexes:
+                raise CommandError(
+                    f'{model_class.__name__} does not have any indexes')
+            count = model_class.rebuild_indexes(options['batch_size'])
+            self.stdout.write(f'{table_name}: {count} rows indexed')
@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_hbase.client import HBaseClient
+from django_hbase.models import HBaseModel
+from django_hbase.models.schema import COLUMN_FAMILY_OPTIONS
+
+
+def normalize(value):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if isinstance(value, str):
+        return value.upper()
+    return value
+
+
+def to_shell_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return f"'{value}'"
+    return str(value)
+
+
+class Command(BaseCommand):
+    help = 'Compare column family options of HBase tables with ' \
+           'HBaseModel.Meta.column_families and print the HBase shell ' \
+           '"alter" statements needed to apply them'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'table_names', nargs='*',
+            help='defaults to the tables of all HBase models')
+        parser.add_argument(
+            '--create', action='store_true',
+            help='create missing tables with the declared options')
+
+    def handle(self, *args, **options):
+        models = {
+            model_class.get_table_name(): model_class
+            for model_class in HBaseModel.__subclasses__()
+            if model_class.Meta.table_name
+        }
+        table_names = options['table_names'] or sorted(models)
+        statements = []
+        with HBaseClient.connection() as conn:
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            for table_name in table_names:
+                if table_name not in models:
+                    raise CommandError(f'HBaseModel for {table_name} not found')
+                model_class = models[table_name]
+                if table_name not in tables:
+                    if not options['create']:
+                        self.stdout.write(f'{table_name}: missing')
+                        continue
+                    conn.create_table(
+                        table_name, model_class.get_column_families())
+                    self.stdout.write(f'{table_name}: created')
+                    continue
+                statements.extend(self.diff_table(
+                    table_name, conn.table(table_name), model_class))
+
+        if not statements:
+            self.stdout.write('All column families are up to date.')
+            return
+        # Thrift API不支持修改已经存在的column family，需要在hbase shell中执行
+        self.stdout.write('# run in hbase shell:')
+        for statement in statements:
+            self.stdout.write(statement)
+
+    def diff_table(self, table_name, table, model_class):
+        current_families = {
+            family.decode('utf-8'): descriptor
+            for family, descriptor in table.families().items()
+        }
+        statements = []
+        for family, desired in model_class.get_column_families().items():
+            current = current_families.get(family, {})
+            changes = {
+                option: value
+                for option, value in desired.items()
+                if normalize(current.get(option)) != normalize(value)
+            }
+            if not changes:
+                continue
+            for option, value in changes.items():
+                self.stdout.write(
+                    f'{table_name}.{family}.{option}: '
+                    f'{current.get(option)} => {value}')
+            attributes = ', '.join(
+                f'{COLUMN_FAMILY_OPTIONS[option]} => {to_shell_value(value)}'
+                for option, value in changes.items()
+            )
+            statements.append(
+                f"alter '{table_name}', {{NAME => '{family}', {attributes}}}")
+        return statements
@@ -0,0 +1,457 @@
+from happybase import NoConnectionsAvailable
+from happybase.util import bytes_increment, ensure_bytes
+# 和Thrift server返回的错误一致，而不是python内置的IOError(OSError)
+from Hbase_thrift import IOError as HBaseIOError
+
+import bisect
+import contextlib
+import queue
+import struct
+import threading
+import time
+
+# Thrift中ColumnDescriptor的默认值，create_table时没有指定的配置使用这些值
+DEFAULT_COLUMN_DESCRIPTOR = {
+    'max_versions': 3,
+    'compression': 'NONE',
+    'in_memory': False,
+    'bloom_filter_type': 'NONE',
+    'bloom_filter_vector_size': 0,
+    'bloom_filter_nb_hashes': 0,
+    'block_cache_enabled': False,
+    'time_to_live': 2147483647,
+}
+
+
+class MemoryStore:
+    """
+    内存中的HBase，同一个进程中所有的MemoryConnection共享这些数据
+    每个table用一个有序的row key list加一个dict存储，scan时用二分查找定位
+    rpc_count记录模拟的Thrift请求次数，用于比较不同写法产生的请求数
+    """
+    lock = threading.RLock()
+    # {table_name: {'families': {...}, 'keys': [row_key, ...], 'rows': {...}}}
+    tables = {}
+    rpc_count = 0
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.tables = {}
+            cls.rpc_count = 0
+
+    @classmethod
+    def get_table(cls, name):
+        table = cls.tables.get(name)
+        if table is None:
+            raise HBaseIOError(
+                message=f'table {name.decode("utf-8")} does not exist')
+        return table
+
+
+def select_columns(row_data, columns):
+    """
+    columns中可以是column family(b'cf')或者column(b'cf:name')
+    """
+    if columns is None:
+        return dict(row_data)
+    families = tuple(column + b':' for column in columns if b':' not in column)
+    return {
+        key: value
+        for key, value in row_data.items()
+        if key in columns or key.startswith(families)
+    }
+
+
+def apply_filter(row_data, filter_string):
+    """
+    只支持count中用到的FirstKeyOnlyFilter和KeyOnlyFilter
+    """
+    filters = [name.strip() for name in filter_string.split(b'AND')]
+    for name in filters:
+        if name == b'FirstKeyOnlyFilter()':
+            row_data = dict(sorted(row_data.items())[:1])
+        elif name == b'KeyOnlyFilter()':
+            row_data = {key: b'' for key in row_data}
+        else:
+            raise NotImplementedError(
+                f'filter {name.decode("utf-8")} is not supported')
+    return row_data
+
+
+class MemoryBatch:
+    """
+    和happybase.Batch一样，send时只算一次请求
+    """
+
+    def __init__(self, table, batch_size=None, transaction=False):
+        self.table = table
+        self.batch_size = batch_size
+        self.transaction = transaction
+        self.mutations = []
+
+    def put(self, row, data, wal=None):
+        self.mutations.append((ensure_bytes(row), data))
+        self.check_batch_size()
+
+    def delete(self, row, columns=None, wal=None):
+        self.mutations.append((ensure_bytes(row), columns))
+        self.check_batch_size()
+
+    def check_batch_size(self):
+        if self.batch_size and len(self.mutations) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        if not self.mutations:
+            return
+        self.table.connection.rpc()
+        with MemoryStore.lock:
+            # put的data是dict，delete的是columns
+            for row, mutation in self.mutations:
+                if isinstance(mutation, dict):
+                    self.table.put_row(row, mutation)
+                else:
+                    self.table.delete_row(row, mutation)
+        self.mutations = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.transaction:
+            return
+        self.send()
+
+
+class MemoryTable:
+    """
+    实现了happybase.Table中django_hbase用到的方法，参数和返回值保持一致
+    """
+
+    def __init__(self, name, connection):
+        self.name = ensure_bytes(name)
+        self.connection = connection
+
+    @property
+    def data(self):
+        return MemoryStore.get_table(self.name)
+
+    def families(self):
+        self.connection.rpc()
+        return {
+            family: dict(descriptor)
+            for family, descriptor in self.data['families'].items()
+        }
+
+    def regions(self):
+        self.connection.rpc()
+        return [{
+            'start_key': b'',
+            'end_key': b'',
+            'id': 1,
+            'name': self.name + b',,1',
+            'version': 1,
+        }]
+
+    def row(self, row, columns=None, timestamp=None,
+            include_timestamp=False):
+        self.connection.rpc()
+        with MemoryStore.lock:
+            row_data = self.data['rows'].get(ensure_bytes(row), {})
+            return select_columns(row_data, columns)
+
+    def rows(self, rows, columns=None, timestamp=None,
+             include_timestamp=False):
+        if not rows:
+            return []
+        self.connection.rpc()
+        results = []
+        with MemoryStore.lock:
+            for row in rows:
+                row = ensure_bytes(row)
+                row_data = select_columns(
+                    self.data['rows'].get(row, {}), columns)
+                if row_data:
+                    results.append((row, row_data))
+        return results
+
+    def scan(self, row_start=None, row_stop=None, row_prefix=None,
+             columns=None, filter=None, timestamp=None,
+             include_timestamp=False, batch_size=1000, scan_batching=None,
+             limit=None, sorted_columns=False, reverse=False):
+        """
+        open scanner和每次取回batch_size行数据都算一次请求，和happybase一致
+        """
+        if batch_size < 1:
+            raise ValueError("'batch_size' must be >= 1")
+        if limit is not None and limit < 1:
+            raise ValueError("'limit' must be >= 1")
+        if row_prefix is not None:
+            if row_start is not None or row_stop is not None:
+                raise TypeError(
+                    "'row_prefix' cannot be combined with 'row_start' "
+                    "or 'row_stop'")
+            row_prefix = ensure_bytes(row_prefix)
+            if reverse:
+                row_start, row_stop = bytes_increment(row_prefix), row_prefix
+            else:
+                row_start, row_stop = row_prefix, bytes_increment(row_prefix)
+
+        self.connection.rpc()
+        row_keys = self.scan_row_keys(row_start, row_stop, reverse)
+        returned = 0
+        index = 0
+        while True:
+            how_many = batch_size
+            if limit is not None:
+                how_many = min(batch_size, limit - returned)
+            self.connection.rpc()
+            items = []
+            with MemoryStore.lock:
+                rows = self.data['rows']
+                while index < len(row_keys) and len(items) < how_many:
+                    row = row_keys[index]
+                    index += 1
+                    # open scanner之后被删除的row
+                    if row not in rows:
+                        continue
+                    row_data = select_columns(rows[row], columns)
+                    if filter is not None:
+                        row_data = apply_filter(row_data, filter)
+                    if row_data:
+                        items.append((row, row_data))
+            if not items:
+                break
+            for item in items:
+                yield item
+                returned += 1
+            if limit is not None and returned >= limit:
+                break
+        # close scanner
+        self.connection.rpc()
+
+    def scan_row_keys(self, row_start, row_stop, reverse):
+        row_start = ensure_bytes(row_start) if row_start else None
+        row_stop = ensure_bytes(row_stop) if row_stop else None
+        with MemoryStore.lock:
+            keys = self.data['keys']
+            if not reverse:
+                # [row_start, row_stop)
+                low = bisect.bisect_left(keys, row_start) if row_start else 0
+                high = bisect.bisect_left(keys, row_stop) \
+                    if row_stop else len(keys)
+                return keys[low:high]
+            # 反向scan时从row_start开始(包含)，到row_stop结束(不包含)
+            high = bisect.bisect_right(keys, row_start) \
+                if row_start else len(keys)
+            low = bisect.bisect_right(keys, row_stop) if row_stop else 0
+            return keys[low:high][::-1]
+
+    def put(self, row, data, timestamp=None, wal=True):
+        self.connection.rpc()
+        with MemoryStore.lock:
+            self.put_row(ensure_bytes(row), data)
+
+    def delete(self, row, columns=None, timestamp=None, wal=True):
+        self.connection.rpc()
+        with MemoryStore.lock:
+            self.delete_row(ensure_bytes(row), columns)
+
+    def batch(self, timestamp=None, batch_size=None, transaction=False,
+              wal=True):
+        return MemoryBatch(self, batch_size, transaction)
+
+    def counter_get(self, row, column):
+        return self.counter_inc(row, column, value=0)
+
+    def counter_inc(self, row, column, value=1):
+        self.connection.rpc()
+        with MemoryStore.lock:
+            return self.increment_row(
+                ensure_bytes(row), ensure_bytes(column), value)
+
+    def counter_dec(self, row, column, value=1):
+        return self.counter_inc(row, column, -value)
+
+    def put_row(self, row, data):
+        table = self.data
+        if row not in table['rows']:
+            bisect.insort(table['keys'], row)
+            table['rows'][row] = {}
+        table['rows'][row].update({
+            ensure_bytes(key): ensure_bytes(value)
+            for key, value in data.items()
+        })
+
+    def delete_row(self, row, columns=None):
+        table = self.data
+        row_data = table['rows'].get(row)
+        if row_data is None:
+            return
+        if columns is not None:
+            for key in list(select_columns(row_data, [
+                ensure_bytes(column) for column in columns
+            ])):
+                del row_data[key]
+            if row_data:
+                return
+        del table['rows'][row]
+        table['keys'].pop(bisect.bisect_left(table['keys'], row))
+
+    def increment_row(self, row, column, value):
+        row_data = self.data['rows'].get(row, {})
+        current = 0
+        if column in row_data:
+            current = struct.unpack('>q', row_data[column])[0]
+        current += value
+        self.put_row(row, {column: struct.pack('>q', current)})
+        return current
+
+
+class MemoryClient:
+    """
+    模拟Thrift client中django_hbase直接调用的方法
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def checkAndPut(self, tableName, row, column, value, mput, attributes):
+        self.connection.rpc()
+        table = self.connection.table(tableName, use_prefix=False)
+        row = ensure_bytes(row)
+        with MemoryStore.lock:
+            current = table.data['rows'].get(row, {}).get(ensure_bytes(column))
+            # value为None表示column不存在
+            expected = ensure_bytes(value) if value else None
+            if current != expected:
+                return False
+            if mput.isDelete:
+                table.delete_row(row, [mput.column])
+            else:
+                table.put_row(row, {mput.column: mput.value})
+            return True
+
+    def incrementRows(self, increments):
+        self.connection.rpc()
+        with MemoryStore.lock:
+            for increment in increments:
+                table = self.connection.table(
+                    increment.table, use_prefix=False)
+                table.increment_row(
+                    ensure_bytes(increment.row),
+                    ensure_bytes(increment.column),
+                    increment.ammount,
+                )
+
+
+class MemoryConnection:
+    """
+    实现了happybase.Connection中django_hbase用到的方法，数据存在MemoryStore中
+    latency: 每次请求额外等待的时间(in seconds)，模拟Thrift的网络往返，
+    这样在本地就可以比较减少请求次数的优化
+    """
+
+    def __init__(self, latency=0, table_prefix=None,
+                 table_prefix_separator=b'_', **kwargs):
+        self.latency = latency
+        self.table_prefix = table_prefix
+        self.table_prefix_separator = ensure_bytes(table_prefix_separator)
+        self.client = MemoryClient(self)
+
+    def rpc(self):
+        with MemoryStore.lock:
+            MemoryStore.rpc_count += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def table_name(self, name):
+        name = ensure_bytes(name)
+        if self.table_prefix is None:
+            return name
+        return ensure_bytes(self.table_prefix) \
+            + self.table_prefix_separator + name
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def table(self, name, use_prefix=True):
+        if use_prefix:
+            name = self.table_name(name)
+        return MemoryTable(name, self)
+
+    def tables(self):
+        self.rpc()
+        names = sorted(MemoryStore.tables)
+        if self.table_prefix is None:
+            return names
+        prefix = self.table_name(b'')
+        return [
+            name[len(prefix):] for name in names if name.startswith(prefix)
+        ]
+
+    def create_table(self, name, families):
+        if not families:
+            raise ValueError(
+                f'Cannot create table {name} (no column families specified)')
+        self.rpc()
+        name = self.table_name(name)
+        with MemoryStore.lock:
+            if name in MemoryStore.tables:
+                raise HBaseIOError(
+                    message=f'table {name.decode("utf-8")} already exists')
+            MemoryStore.tables[name] = {
+                'families': {
+                    ensure_bytes(family): {
+                        'name': ensure_bytes(family) + b':',
+                        **DEFAULT_COLUMN_DESCRIPTOR,
+                        **(options or {}),
+                    }
+                    for family, options in families.items()
+                },
+                'keys': [],
+                'rows': {},
+            }
+
+    def delete_table(self, name, disable=False):
+        self.rpc()
+        name = self.table_name(name)
+        with MemoryStore.lock:
+            MemoryStore.get_table(name)
+            del MemoryStore.tables[name]
+
+
+class MemoryConnectionPool:
+    """
+    和happybase.ConnectionPool的用法一样，同一个线程中嵌套的with会拿到同一个
+    connection，最多同时借出size个connection
+    """
+
+    def __init__(self, size, **kwargs):
+        self.queue = queue.LifoQueue(maxsize=size)
+        self.thread_connections = threading.local()
+        for _ in range(size):
+            self.queue.put(MemoryConnection(**kwargs))
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        connection = getattr(self.thread_connections, 'current', None)
+        if connection is not None:
+            yield connection
+            return
+
+        try:
+            connection = self.queue.get(True, timeout)
+        except queue.Empty:
+            raise NoConnectionsAvailable(
+                'No connection available from pool within specified timeout')
+        self.thread_connections.current = connection
+        try:
+            yield connection
+        finally:
+            del self.thread_connections.current
+            self.queue.put(connection)
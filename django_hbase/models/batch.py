@@ -0,0 +1,87 @@
+# happybase在import时才会加载Hbase.thrift，生成Hbase_thrift这个module，
+# 所以必须先import happybase
+import happybase  # noqa: F401
+from Hbase_thrift import TIncrement
+from django_hbase.cache import HBaseScanCache
+
+
+class HBaseBatch:
+    """
+    可以同时写入多个表的batch，通过HBaseModel.batch()来使用
+    with HBaseModel.batch(batch_size=1000) as batch:
+        HBaseFollowing.create(batch=batch, ...)
+        HBaseFollower.delete(batch=batch, ...)
+    put/delete不会立刻产生HBase请求，而是按table分组缓存起来，
+    攒够batch_size个mutation时自动send，每个table只产生一次Thrift请求(mutateRows)
+    CounterField的increment会在本地合并同一个counter的增量，所有表的increment
+    只产生一次Thrift请求(incrementRows)
+    这样fanout很大时内存中最多只有batch_size个mutation
+    with中抛出异常时，还没有send的mutation会被丢弃，已经自动send的不会回滚
+    """
+
+    def __init__(self, connection, batch_size=None):
+        self.connection = connection
+        self.batch_size = batch_size
+        # {table_name: happybase.Batch}，按第一次写入的顺序send
+        self.batches = {}
+        # {(table, row_key, column): delta}
+        self.increments = {}
+        # send之后让scan cache失效，{(model_class, partition): data}
+        # 相同前缀的只需要失效一次，所有的version token在一次redis请求中删除
+        self.scan_cache_invalidations = {}
+        self.size = 0
+
+    def get_batch(self, table_name):
+        batch = self.batches.get(table_name)
+        if batch is None:
+            batch = self.connection.table(table_name).batch()
+            self.batches[table_name] = batch
+        return batch
+
+    def put(self, table_name, row_key, row_data):
+        self.get_batch(table_name).put(row_key, row_data)
+        self.add_mutation()
+
+    def delete(self, table_name, row_key, columns=None):
+        self.get_batch(table_name).delete(row_key, columns=columns)
+        self.add_mutation()
+
+    def increment(self, table_name, row_key, column, delta):
+        key = (table_name, row_key, column)
+        self.increments[key] = self.increments.get(key, 0) + delta
+        self.add_mutation()
+
+    def invalidate_scan_cache(self, model_class, data):
+        partition = data.get(model_class._schema.row_key[0])
+        self.scan_cache_invalidations[(model_class, partition)] = data
+
+    def add_mutation(self):
+        self.size += 1
+        if self.batch_size is not None and self.size >= self.batch_size:
+            self.send()
+
+    def send(self):
+        for batch in self.batches.values():
+            batch.send()
+        increments = [
+            TIncrement(
+                # 和happybase.Batch一样，table name需要加上table_prefix
+                table=self.connection.table(table_name).name,
+                row=row_key,
+                column=column,
+                ammount=delta,
+            )
+            for (table_name, row_key, column), delta in self.increments.items()
+            if delta != 0
+        ]
+        if increments:
+            self.connection.client.incrementRows(increments)
+        invalidations = [
+            (model_class, data)
+            for (model_class, _), data in self.scan_cache_invalidations.items()
+        ]
+        self.batches = {}
+        self.increments = {}
+        self.scan_cache_invalidations = {}
+        self.size = 0
+        HBaseScanCache.invalidate_many(invalidations)
@@ -0,0 +1,171 @@
+from django.core.exceptions import ImproperlyConfigured
+from django_hbase.models.exceptions import BadRowKeyError
+
+# 每个byte按bit反转后的值，例如 0b00000001 => 0b10000000
+REVERSED_BITS = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+
+def get_salt_split_keys(buckets, alphabet_size, width, encode):
+    """
+    第一个field是reverse=True的int时，row key的前几位是均匀分布的，相当于
+    天然的salt，按前缀平均切分成buckets段，返回buckets - 1个切分点
+    alphabet_size: 每一位可能的取值个数，width: 最多用前几位
+    """
+    if buckets < 1:
+        raise ValueError('buckets must be >= 1')
+    digits = 1
+    while alphabet_size ** digits < buckets and digits < width:
+        digits += 1
+    total = alphabet_size ** digits
+    split_keys = [encode(index * total // buckets, digits)
+                  for index in range(1, buckets)]
+    # buckets超过total时会有重复的切分点
+    return sorted(set(split_keys))
+
+
+class StringRowKeyCodec:
+    """
+    默认的row key编码方式
+    int补齐为16位的十进制字符串，reverse=True时把字符串反转，多个值用':'连接
+    {from_user_id: 1, created_at: 1635000000000000}
+    => b'1000000000000000:1635000000000000'
+    """
+    name = 'string'
+
+    def __init__(self, model_name, fields, row_key):
+        self.row_key_fields = tuple(
+            (key, fields[key].serialize, fields[key].deserialize)
+            for key in row_key
+        )
+        first_field = fields[row_key[0]] if row_key else None
+        self.salted = first_field is not None and first_field.reverse \
+            and first_field.field_type == 'int'
+
+    def get_salt_split_keys(self, buckets):
+        """
+        反转之后的十进制字符串以id的个位开头，'0'-'9'是均匀分布的
+        """
+        if not self.salted:
+            raise ValueError(
+                'the first field of row key should be a reversed IntegerField')
+        return get_salt_split_keys(
+            buckets, 10, 16,
+            lambda value, digits: bytes(
+                str(value).rjust(digits, '0'), encoding='utf-8'),
+        )
+
+    def serialize(self, data, is_prefix=False):
+        values = []
+        for key, encode, _ in self.row_key_fields:
+            value = data.get(key)
+            if value is None:
+                # 如果value为None，但是有前缀，也是允许行的
+                if not is_prefix:
+                    raise BadRowKeyError(f'{key} is missing in row key')
+                break
+            value = encode(value)
+            if ':' in value:
+                raise BadRowKeyError(
+                    f'{key} should not contain ":" in value: {value}')
+            values.append(value)
+        return bytes(':'.join(values), encoding='utf-8')
+
+    def deserialize(self, row_key):
+        data = {}
+        if isinstance(row_key, bytes):
+            row_key = row_key.decode('utf-8')
+
+        # val1:val2 => [val1, val2]，zip会在较短的一方结束时停止
+        values = row_key.split(':')
+        for (key, _, decode), value in zip(self.row_key_fields, values):
+            data[key] = decode(value)
+        return data
+
+
+class BinaryRowKeyCodec:
+    """
+    定长的二进制row key，在Meta中设置 row_key_codec = 'binary' 开启
+    每个int都编码为8 bytes的big-endian无符号整数，直接拼接，不需要':'分隔
+    big-endian保证了字节序和数值大小的顺序一致，范围查询依然有效
+    reverse=True时不再反转十进制字符串，而是把64个bit整体反转，连续的id
+    会被打散到整个key空间，同样可以避免hot region，并且仍然可以做前缀查询
+    两个字段的row key从33 bytes缩小到16 bytes，编解码也不需要字符串操作
+
+    为了兼容已经存在的字符串格式的数据，deserialize时如果长度和定长不一致，
+    就按照StringRowKeyCodec来解析，迁移参考HBaseModel.migrate_row_keys
+    """
+    name = 'binary'
+    width = 8
+
+    def __init__(self, model_name, fields, row_key):
+        for key in row_key:
+            if fields[key].field_type not in ('int', 'timestamp'):
+                raise ImproperlyConfigured(
+                    f'{model_name}.{key}: binary row key only supports '
+                    f'IntegerField and TimestampField')
+        self.row_key_fields = tuple(
+            (key, fields[key].reverse) for key in row_key
+        )
+        self.row_key_length = self.width * len(row_key)
+        self.salted = bool(row_key) and fields[row_key[0]].reverse
+        self.legacy_codec = StringRowKeyCodec(model_name, fields, row_key)
+
+    @classmethod
+    def encode_int(cls, value, reverse=False):
+        value = int(value)
+        if value < 0 or value >= 1 << 64:
+            raise BadRowKeyError(f'{value} is out of range of uint64')
+        value = value.to_bytes(cls.width, 'big')
+        if reverse:
+            # 反转字节的顺序，再反转每个字节中bit的顺序，等价于反转全部64个bit
+            value = value[::-1].translate(REVERSED_BITS)
+        return value
+
+    @classmethod
+    def decode_int(cls, value, reverse=False):
+        if reverse:
+            value = value[::-1].translate(REVERSED_BITS)
+        return int.from_bytes(value, 'big')
+
+    def serialize(self, data, is_prefix=False):
+        values = []
+        for key, reverse in self.row_key_fields:
+            value = data.get(key)
+            if value is None:
+                if not is_prefix:
+                    raise BadRowKeyError(f'{key} is missing in row key')
+                break
+            values.append(self.encode_int(value, reverse))
+        return b''.join(values)
+
+    def get_salt_split_keys(self, buckets):
+        """
+        bit反转之后id的最低位在最前面，每个byte都是均匀分布的
+        """
+        if not self.salted:
+            raise ValueError(
+                'the first field of row key should be a reversed IntegerField')
+        return get_salt_split_keys(
+            buckets, 256, self.width,
+            lambda value, digits: value.to_bytes(digits, 'big'),
+        )
+
+    def is_legacy(self, row_key):
+        return len(row_key) != self.row_key_length
+
+    def deserialize(self, row_key):
+        if isinstance(row_key, str):
+            row_key = bytes(row_key, encoding='utf-8')
+        if self.is_legacy(row_key):
+            return self.legacy_codec.deserialize(row_key)
+
+        data = {}
+        for index, (key, reverse) in enumerate(self.row_key_fields):
+            value = row_key[index * self.width: (index + 1) * self.width]
+            data[key] = self.decode_int(value, reverse)
+        return data
+
+
+ROW_KEY_CODECS = {
+    codec.name: codec for codec in [StringRowKeyCodec, BinaryRowKeyCodec]
+}
@@ -4,3 +4,7 @@ class BadRowKeyError(Exception):
 
 class EmptyColumnError(Exception):
     pass
+
+
+class NotCounterFieldError(Exception):
+    pass
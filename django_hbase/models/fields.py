@@ -1,3 +1,6 @@
+import struct
+
+
 class HBaseField:
     field_type = None
 
@@ -5,6 +8,23 @@ class HBaseField:
         self.reverse = reverse
         self.column_family = column_family
 
+    def serialize(self, value):
+        """
+        把python中的值序列化为存储到HBase中的str
+        """
+        value = str(value)
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        """
+        把从HBase中读取的值(row key中的str或者column中的bytes)反序列化
+        """
+        if self.reverse:
+            value = value[::-1]
+        return value
+
 
 class IntegerField(HBaseField):
     field_type = 'int'
@@ -12,9 +32,43 @@ class IntegerField(HBaseField):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+    def serialize(self, value):
+        # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
+        # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
+        value = str(value).rjust(16, '0')
+        if self.reverse:
+            value = value[::-1]
+        return value
+
+    def deserialize(self, value):
+        return int(super().deserialize(value))
+
 
 class TimestampField(HBaseField):
     field_type = 'timestamp'
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+    # TimestampField不需要补位，因为它存储的是一个非常大的整数
+    # 最高位很难发生进位(下辈子都不会)，不会因为长度影响排序
+    def deserialize(self, value):
+        return int(super().deserialize(value))
+
+
+class CounterField(HBaseField):
+    """
+    HBase的原子计数器，值是8字节big-endian的signed long，和HBase中
+    Increment的格式一致，通过HBaseModel.increment原子的加减，不需要先读再写
+    必须指定column_family，不能作为row key
+    """
+    field_type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def serialize(self, value):
+        return struct.pack('>q', int(value))
+
+    def deserialize(self, value):
+        return struct.unpack('>q', value)[0]
@@ -1,24 +1,111 @@
-from django_hbase.models import HBaseField, IntegerField, TimestampField
-from django_hbase.client import HBaseClient
+from contextlib import contextmanager
+from django_hbase.models.fields import HBaseField
+from django_hbase.models.schema import HBaseModelSchema
+from django_hbase.models.batch import HBaseBatch
+from Hbase_thrift import Mutation
+from concurrent.futures import Future, ThreadPoolExecutor
+from django_hbase.cache import HBaseScanCache
+from django_hbase.client import HBaseClient, retry_on_thrift_error
+from django_hbase.writer import HBaseBufferedWriter
 from django.conf import settings
-from django_hbase.models.exceptions import BadRowKeyError, EmptyColumnError
+from thriftpy2.thrift import TApplicationException
+from django_hbase.models.exceptions import (
+    EmptyColumnError,
+    NotCounterFieldError,
+)
 
 
-class HBaseModel:
+class HBaseModelMeta(type):
+    """
+    在定义HBaseModel的子类时，把所有的HBaseField收集起来，编译成cls._schema
+    父类中定义的field也会被子类继承
+    同时根据field生成__slots__，instance中不再有__dict__，只用固定的slot存储
+    每个field的值，扫描几千行数据或者缓存newsfeed list时占用的内存更少
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = {}
+        for base in reversed(bases):
+            base_schema = getattr(base, '_schema', None)
+            if base_schema is not None:
+                fields.update(base_schema.fields)
+        meta = attrs.get('Meta') or next(
+            base.Meta for base in bases if hasattr(base, 'Meta'))
+        slots = []
+        for key, value in list(attrs.items()):
+            if not isinstance(value, HBaseField):
+                continue
+            # field已经保存在schema中，class attribute和同名的slot会冲突
+            del attrs[key]
+            if key not in fields:
+                slots.append(key)
+            fields[key] = value
+        # 父类中定义过的field已经有slot了，只需要增加新的field
+        attrs.setdefault('__slots__', tuple(slots))
+        # 先编译schema再创建class，这样定义有误的model不会出现在
+        # HBaseModel.__subclasses__()中
+        attrs['_schema'] = HBaseModelSchema(
+            name, fields, meta.row_key,
+            getattr(meta, 'row_key_codec', 'string'),
+            getattr(meta, 'indexes', ()),
+            getattr(meta, 'column_families', None),
+        )
+        return super().__new__(mcs, name, bases, attrs)
+
+
+class HBaseModel(metaclass=HBaseModelMeta):
+    # 从HBase读取(或者上一次save)时每个column field的值，用于判断哪些field
+    # 被修改过，新构造的instance为None
+    __slots__ = ('_original',)
 
     class Meta:
         table_name = None
         row_key = ()
+        # 'string' 或 'binary'，参考django_hbase.models.codecs
+        row_key_codec = 'string'
+        # 二级索引表，每个都是一个HBaseModel，它的field必须是当前model的field
+        # save和delete时会自动同步写入/删除索引表中对应的行
+        indexes = ()
+        # 每个column family的配置，例如
+        # {'cf': {'compression': 'GZ', 'time_to_live': 86400}}
+        # 参考django_hbase.models.schema.COLUMN_FAMILY_OPTIONS
+        column_families = {}
+        # 是否缓存filter的结果，参考django_hbase.cache.HBaseScanCache
+        scan_cache = False
 
     @classmethod
+    @contextmanager
     def get_table(cls):
-        conn = HBaseClient.get_connection()
+        """
+        从连接池中借一个connection，并返回对应的table，需要用with的方式来使用
+        with cls.get_table() as table:
+            table.put(...)
+        with结束后connection会自动归还给连接池，所以不要在with外面使用table
+        """
+        with HBaseClient.connection() as conn:
+            yield conn.table(cls.get_table_name())
 
-        return conn.table(cls.get_table_name())
+    @classmethod
+    @contextmanager
+    def batch(cls, batch_size=None):
+        """
+        返回一个HBaseBatch，可以把多个model(多个表)的create/save/delete放在一起，
+        with结束时一次性写入，with中抛出异常时不写入
+        with HBaseModel.batch(batch_size=1000) as batch:
+            HBaseFollowing.create(batch=batch, ...)
+            HBaseFollower.create(batch=batch, ...)
+        每batch_size个mutation会自动写入一次，默认是settings.HBASE_BATCH_SIZE
+        """
+        if batch_size is None:
+            batch_size = settings.HBASE_BATCH_SIZE
+        with HBaseClient.connection() as conn:
+            batch = HBaseBatch(conn, batch_size)
+            yield batch
+            batch.send()
 
     @property
     def row_key(self):
-        return self.serialize_row_key(self.__dict__)
+        return self.serialize_row_key(self.to_dict())
 
     @classmethod
     def get_table_name(cls):
@@ -33,8 +120,8 @@ class HBaseModel:
     def drop_table(cls):
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        conn.delete_table(cls.get_table_name(), True)
+        with HBaseClient.connection() as conn:
+            conn.delete_table(cls.get_table_name(), True)
 
     @classmethod
     def create_table(cls):
@@ -43,40 +130,80 @@ class HBaseModel:
         """
         if not settings.TESTING:
             raise Exception('You can not create table outside of unit tests')
-        conn = HBaseClient.get_connection()
-        # decode将bytes转换为str
-        tables = [table.decode('utf-8') for table in conn.tables()]
-        if cls.get_table_name() in tables:
-            # 已经存在
-            return
+        with HBaseClient.connection() as conn:
+            # decode将bytes转换为str
+            tables = [table.decode('utf-8') for table in conn.tables()]
+            if cls.get_table_name() in tables:
+                # 已经存在
+                return
+            conn.create_table(
+                cls.get_table_name(), cls.get_column_families())
+
+    @classmethod
+    def get_column_families(cls):
+        """
+        create_table接收的参数，{family: options}
+        """
         # 字典解析式，create_table接收的参数就是这样
-        column_families = {
-            field.column_family: dict()
-            for key, field in cls.get_field_hash().items()
-            if field.column_family is not None
+        return {
+            family: dict(options)
+            for family, options in cls._schema.column_families.items()
         }
-        conn.create_table(cls.get_table_name(), column_families)
 
     @classmethod
     def get_field_hash(cls):
         """
         key为field的名称,value为HBaseField对象的dict
+        在定义model时就已经编译好了，不需要每次遍历cls.__dict__
         """
-        field_hash = {}
-        for field in cls.__dict__:
-            field_obj = getattr(cls, field)
-            if isinstance(field_obj, HBaseField):
-                field_hash[field] = field_obj
-        return field_hash
+        return cls._schema.fields
+
+    def to_dict(self):
+        """
+        instance没有__dict__，需要一个{field: value}的dict时使用
+        """
+        return {key: getattr(self, key) for key in self._schema.fields}
 
     def __init__(self, **kwargs):
         """
         构造函数，把kwargs中key-value赋给Model中对应的key-value
         setattr方法用的很巧妙
         """
-        for key, field in self.get_field_hash().items():
+        for key in self._schema.fields:
             value = kwargs.get(key)
             setattr(self, key, value)
+        self._original = None
+
+    def get_column_values(self):
+        return tuple(
+            getattr(self, key) for key, _, _ in self._schema.column_fields)
+
+    def get_dirty_fields(self):
+        """
+        返回从HBase读取(或者上一次save)之后被修改过的column field
+        新构造的instance，所有的column field都算被修改过
+        row key中的field不算，修改row key相当于另外一行数据
+        """
+        column_fields = self._schema.column_fields
+        if self._original is None:
+            return [key for key, _, _ in column_fields]
+        return [
+            key
+            for (key, _, _), original in zip(column_fields, self._original)
+            if getattr(self, key) != original
+        ]
+
+    def get_original_data(self):
+        """
+        读取时的{field: value}，新构造的instance返回None
+        """
+        if self._original is None:
+            return None
+        data = self.to_dict()
+        for (key, _, _), original in zip(
+                self._schema.column_fields, self._original):
+            data[key] = original
+        return data
 
     @classmethod
     def init_from_row(cls, row_key, row_data):
@@ -86,12 +213,18 @@ class HBaseModel:
         if not row_data:
             return None
         data = cls.deserialize_row_key(row_key)
+        columns = cls._schema.columns
         for column_key, column_value in row_data.items():
-            column_key = column_key.decode('utf-8')
-            # remove column family
-            key = column_key[column_key.find(':') + 1:]
-            data[key] = cls.deserialize_field(key, column_value)
-        return cls(**data)
+            # b'cf:name' => (name, decode)
+            column = columns.get(column_key)
+            if column is None:
+                # model中没有定义的column，直接忽略
+                continue
+            key, decode = column
+            data[key] = decode(column_value)
+        instance = cls(**data)
+        instance._original = instance.get_column_values()
+        return instance
 
     @classmethod
     def serialize_row_key(cls, data, is_prefix=False):
@@ -104,115 +237,340 @@ class HBaseModel:
         {key1: val1} => b"val1"
         {key1: val1, key2: val2} => b"val1:val2"
         {key1: val1, key2: val2, key3: val3} => b"val1:val2:val3"
+        如果Meta.row_key_codec = 'binary'，则是定长的二进制编码
         """
-        field_hash = cls.get_field_hash()
-        values = []
-        for key, field in field_hash.items():
-            # field为column key
-            if field.column_family:
-                continue
-            value = data.get(key)
-            if value is None:
-                # 如果value为None，但是有前缀，也是允许行的
-                if not is_prefix:
-                    raise BadRowKeyError(f'{key} is missing in row key')
-                break
-            value = cls.serialize_field(field, value)
-            if ':' in value:
-                raise BadRowKeyError(
-                    f'{key} should not contain ":" in value: {value}')
-            values.append(value)
-        return bytes(':'.join(values), encoding='utf-8')
+        return cls._schema.row_key_codec.serialize(data, is_prefix)
 
     @classmethod
     def deserialize_row_key(cls, row_key):
-        data = {}
-        if isinstance(row_key, bytes):
-            row_key = row_key.decode('utf-8')
-
-        # val1:val2 => val1:val2: 方便每次 find(':') 都能找到一个 val
-        row_key = row_key + ':'
-        for key in cls.Meta.row_key:
-            index = row_key.find(':')
-            if index == -1:
-                break
-            data[key] = cls.deserialize_field(key, row_key[:index])
-            row_key = row_key[index + 1:]
-        return data
+        return cls._schema.row_key_codec.deserialize(row_key)
 
     @classmethod
     def serialize_field(cls, field, value):
-        value = str(value)
-        # TimestampField不需要补位，因为它存储的是一个非常大的整数
-        # 最高位很难发生进位(下辈子都不会)，不会因为长度影响排序
-        if isinstance(field, IntegerField):
-            # 因为排序规则是按照字典序排序，那么就可能出现 1 10 2 这样的排序
-            # 解决的办法是固定 int 的位数为 16 位（8的倍数更容易利用空间），不足位补 0
-            value = str(value)
-            while len(value) < 16:
-                value = '0' + value
-        if field.reverse:
-            value = value[::-1]
-        return value
+        return field.serialize(value)
 
     @classmethod
     def deserialize_field(cls, key, value):
-        field = cls.get_field_hash()[key]
-        if field.reverse:
-            value = value[::-1]
-        if field.field_type in [IntegerField.field_type,
-                                TimestampField.field_type]:
-            return int(value)
-        return value
+        return cls._schema.fields[key].deserialize(value)
 
     @classmethod
-    def serialize_row_data(cls, data):
+    def serialize_row_data(cls, data, include_counters=True):
         """
         序列化除row key之外的值，也就是row data，列中的值
         它是一个dict，其key就是column key
+        include_counters为False时不包含CounterField
         """
         row_data = {}
-        field_hash = cls.get_field_hash()
-        for key, field in field_hash.items():
-            # 如果是row key
-            if not field.column_family:
+        for key, column_key, encode in cls._schema.column_fields:
+            if not include_counters and key in cls._schema.counters:
                 continue
-            column_key = '{}:{}'.format(field.column_family, key)
             column_value = data.get(key)
             if column_value is None:
                 continue
-            row_data[column_key] = cls.serialize_field(field, column_value)
+            row_data[column_key] = encode(column_value)
         return row_data
 
-    def save(self, batch=None):
-        row_data = self.serialize_row_data(self.__dict__)
+    def save(self, batch=None, buffered=False, update_fields=None):
+        """
+        buffered=True时交给后台的HBaseBufferedWriter批量写入，不等待Thrift请求，
+        返回一个Future，需要读到这次写入时调用future.result()
+        settings.HBASE_BUFFERED_WRITES为False时，会直接写入并返回一个已完成的Future
+        update_fields: 只写入这些column field中被修改过的cell，修改为None的cell
+        会被删除，没有被修改过的field不会产生请求，参考save_fields
+        CounterField只在新构造的instance第一次save时写入，之后只能通过increment
+        修改，否则save会用内存中旧的值覆盖掉其它进程的increment
+        """
+        if update_fields is not None:
+            if buffered:
+                raise ValueError('update_fields can not be buffered')
+            return self.save_fields(update_fields, batch=batch)
+
+        is_new = self._original is None
+        row_data = self.serialize_row_data(
+            self.to_dict(), include_counters=is_new)
         # 如果 row_data 为空，即没有任何 column key values 需要存储 hbase 会直接不存储
         # 这个 row_key, 因此我们可以 raise 一个 exception 提醒调用者，避免存储空值
         if len(row_data) == 0:
-            raise EmptyColumnError
+            if is_new:
+                raise EmptyColumnError
+            # 读取出来的instance只有CounterField，没有需要写入的数据
+            if not buffered:
+                return None
+            future = Future()
+            future.set_result(True)
+            return future
+        # 先写索引再写数据，如果中途失败，最多是索引中多了一条指向不存在的
+        # 数据的记录，之后delete时可以被清理掉，而不会出现查不到索引的数据
+        self.save_indexes(batch=batch, buffered=buffered)
+        self._original = self.get_column_values()
         if batch:
             # batch.put()不会立刻产生一个HBase的数据库请求
             # 而是会等到batch.send()执行后，一次性把所有的批量数据都写入到HBase
             # batch的好处是：通常情况下HBase和Web Server不在同一台机器上，这样每次写
             # HBase都会产生一个类似request的请求，而batch只会产生一次请求，
             # 可以节省时间
-            batch.put(self.row_key, row_data)
-        else:
-            table = self.get_table()
-            table.put(self.row_key, row_data)
+            batch.put(self.get_table_name(), self.row_key, row_data)
+            self.invalidate_scan_cache(self.to_dict(), batch=batch)
+            return None
+
+        if buffered and settings.HBASE_BUFFERED_WRITES:
+            writer = HBaseBufferedWriter.get_writer()
+            invalidation = None
+            if self.has_scan_cache():
+                invalidation = (self.__class__, self.to_dict())
+            return writer.put(
+                self.get_table_name(), self.row_key, row_data, invalidation)
+
+        self.put_row(self.row_key, row_data)
+        self.invalidate_scan_cache(self.to_dict())
+        if not buffered:
+            return None
+        future = Future()
+        future.set_result(True)
+        return future
+
+    def save_fields(self, update_fields, batch=None):
+        column_keys = {
+            key: column_key
+            for key, column_key, _ in self._schema.column_fields
+        }
+        for key in update_fields:
+            if key not in column_keys:
+                raise ValueError(
+                    f'{self.__class__.__name__}.{key} is not a column field')
+            # CounterField只能删除，修改要用increment
+            if key in self._schema.counters and getattr(self, key) is not None:
+                raise ValueError(
+                    f'{self.__class__.__name__}.{key} is a CounterField, '
+                    'use increment instead')
+        dirty_fields = [
+            key for key in self.get_dirty_fields() if key in update_fields
+        ]
+        if not dirty_fields:
+            return None
+
+        data = {key: getattr(self, key) for key in dirty_fields}
+        row_data = self.serialize_row_data(data)
+        deleted_columns = [
+            column_keys[key] for key, value in data.items() if value is None
+        ]
+        self.save_indexes(batch=batch, fields=dirty_fields)
+        self._original = self.get_column_values()
+        if batch:
+            if row_data:
+                batch.put(self.get_table_name(), self.row_key, row_data)
+            if deleted_columns:
+                batch.delete(
+                    self.get_table_name(), self.row_key, deleted_columns)
+            self.invalidate_scan_cache(self.to_dict(), batch=batch)
+            return None
+        if row_data:
+            self.put_row(self.row_key, row_data)
+        if deleted_columns:
+            self.delete_row(self.row_key, columns=deleted_columns)
+        self.invalidate_scan_cache(self.to_dict())
+        return None
+
+    def save_indexes(self, batch=None, buffered=False, fields=None):
+        """
+        fields不为None时，只写入包含这些field的索引表
+        索引表row key中的field被修改过时，会先删除旧的索引
+        """
+        original = self.get_original_data()
+        dirty_fields = set(self.get_dirty_fields())
+        for index_model in self._schema.indexes:
+            schema = index_model._schema
+            if fields is not None and not set(fields) & set(schema.fields):
+                continue
+            if original is not None and dirty_fields & set(schema.row_key):
+                index_model.delete(batch=batch, **{
+                    key: original[key] for key in schema.row_key
+                })
+            index_model.create(batch=batch, buffered=buffered, **{
+                key: getattr(self, key) for key in schema.fields
+            })
+
+    @classmethod
+    @retry_on_thrift_error
+    def put_row(cls, row_key, row_data):
+        """
+        写入一行已经序列化的数据，put是幂等的，网络错误时会重试
+        """
+        with cls.get_table() as table:
+            table.put(row_key, row_data)
+
+    @classmethod
+    @retry_on_thrift_error
+    def delete_row(cls, row_key, columns=None):
+        with cls.get_table() as table:
+            table.delete(row_key, columns=columns)
 
     @classmethod
-    def get(cls, **kwargs):
+    @retry_on_thrift_error
+    def get(cls, columns=None, **kwargs):
         """
         获取指定的一行数据，并初始化为一个instance
+        columns: 只读取指定的field，例如['to_user_id']，没有读取的field为None
         """
         # 这里直接传kwargs，就是传一个dict进去
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        row = table.row(row_key)
+        with cls.get_table() as table:
+            row = table.row(row_key, columns=cls.serialize_columns(columns))
         return cls.init_from_row(row_key, row)
 
-    # <HOMEWORK> 实现一个 get_or_create 的方法，返回 (instance, created)
+    @classmethod
+    @retry_on_thrift_error
+    def get_many(cls, keys, batch_size=None, columns=None):
+        """
+        批量获取多行数据，keys是row key的dict组成的list
+        [{'from_user_id': 1, 'created_at': ts1}, {...}, ...]
+        每batch_size个row key只产生一次Thrift请求(table.rows)，而不是每个key一次
+        返回的instance list和keys的顺序一致，不存在的key对应None
+        columns: 和get一样，只读取指定的field
+        """
+        if batch_size is None:
+            batch_size = settings.HBASE_GET_MANY_BATCH_SIZE
+        row_keys = [cls.serialize_row_key(key) for key in keys]
+        column_keys = cls.serialize_columns(columns)
+
+        rows = {}
+        with cls.get_table() as table:
+            for index in range(0, len(row_keys), batch_size):
+                # 相同的row key只需要读取一次
+                batch_row_keys = list(dict.fromkeys(
+                    row_keys[index: index + batch_size]))
+                for row_key, row_data in table.rows(
+                        batch_row_keys, columns=column_keys):
+                    rows[row_key] = row_data
+
+        return [
+            cls.init_from_row(row_key, rows[row_key])
+            if row_key in rows else None
+            for row_key in row_keys
+        ]
+
+    @classmethod
+    def create_if_absent(cls, **kwargs):
+        """
+        row key不存在时才创建，返回(instance, created)
+        instance总是用kwargs构造的，created为False时说明这一行已经存在，
+        HBase中的数据没有被修改，需要读取已经存在的数据时使用get_or_create
+        用Thrift的checkAndPut在region server上原子的判断并写入第一个column，
+        不需要先get再put，多个进程同时创建时只有一个会成功，重试的fanout和
+        follow不会重复写入
+        checkAndPut一次只能写一个column，其余的column在成功之后再put一次，
+        所以极短的时间内可能读到只有第一个column的数据
+        如果Thrift server不支持checkAndPut，退化为先get再put，此时不是原子的
+        有索引表时，成功之后才写入索引，和save的顺序相反，如果中途失败需要
+        rebuild_indexes
+        """
+        instance = cls(**kwargs)
+        row_data = instance.serialize_row_data(instance.to_dict())
+        if len(row_data) == 0:
+            raise EmptyColumnError
+        row_key = instance.row_key
+        # 用第一个column作为判断条件，它不存在说明这一行不存在
+        column_key, column_value = next(iter(row_data.items()))
+
+        with cls.get_table() as table:
+            try:
+                created = table.connection.client.checkAndPut(
+                    table.name,
+                    row_key,
+                    bytes(column_key, encoding='utf-8'),
+                    None,
+                    Mutation(column=column_key, value=column_value),
+                    {},
+                )
+            except TApplicationException as e:
+                if e.type != TApplicationException.UNKNOWN_METHOD:
+                    raise
+                created = not table.row(row_key)
+                if created:
+                    table.put(row_key, {column_key: column_value})
+            if not created:
+                return instance, False
+            instance._original = instance.get_column_values()
+            del row_data[column_key]
+            if row_data:
+                table.put(row_key, row_data)
+
+        cls.invalidate_scan_cache(kwargs)
+        instance.save_indexes()
+        return instance, True
+
+    @classmethod
+    def get_or_create(cls, **kwargs):
+        """
+        返回(instance, created)，row key已经存在时返回HBase中已有的数据
+        只有已经存在时才需要多读取一次，参考create_if_absent
+        """
+        instance, created = cls.create_if_absent(**kwargs)
+        if created:
+            return instance, True
+        existing = cls.get(**kwargs)
+        # 极少数情况下，读取之前被别人删除了，返回kwargs构造的instance
+        return existing or instance, False
+
+    @classmethod
+    def get_counter_column(cls, field):
+        column_key = cls._schema.counters.get(field)
+        if column_key is None:
+            raise NotCounterFieldError(
+                f'{cls.__name__}.{field} is not a CounterField')
+        return column_key
+
+    @classmethod
+    def increment(cls, field, delta=1, batch=None, **kwargs):
+        """
+        原子的给CounterField加上delta(可以为负数)，返回加完之后的值
+        HBase在region server上完成加法，不需要先读再写，多个进程同时increment
+        也不会丢失更新，这一行不存在时从0开始
+        kwargs中需要包含row key
+        传入batch(HBaseModel.batch())时只是记录下来，同一个counter的增量会合并，
+        batch写入时再一起increment，此时返回None
+        注意：increment不会同步写入索引表
+        """
+        row_key = cls.serialize_row_key(kwargs)
+        column_key = cls.get_counter_column(field)
+        if batch:
+            batch.increment(cls.get_table_name(), row_key, column_key, delta)
+            cls.invalidate_scan_cache(kwargs, batch=batch)
+            return None
+        with cls.get_table() as table:
+            value = table.counter_inc(row_key, column_key, delta)
+        cls.invalidate_scan_cache(kwargs)
+        return value
+
+    @classmethod
+    @retry_on_thrift_error
+    def get_counter(cls, field, **kwargs):
+        """
+        只读取一个CounterField的值，这一行不存在时返回0
+        """
+        row_key = cls.serialize_row_key(kwargs)
+        column_key = cls.get_counter_column(field)
+        with cls.get_table() as table:
+            return table.counter_get(row_key, column_key)
+
+    @classmethod
+    def has_scan_cache(cls):
+        return getattr(cls.Meta, 'scan_cache', False)
+
+    @classmethod
+    def invalidate_scan_cache(cls, data, batch=None):
+        """
+        写入HBase之后让HBaseScanCache中包含这一行的结果失效
+        batch和buffered的写入要等真正写入之后再失效，否则在这之前scan到的旧数据
+        会被缓存在新的version token下，buffered的写入参考HBaseBufferedWriter.put
+        """
+        if not cls.has_scan_cache():
+            return
+        if batch:
+            # 同一个batch中相同前缀的写入只需要失效一次
+            batch.invalidate_scan_cache(cls, data)
+        else:
+            HBaseScanCache.invalidate(cls, data)
 
     @classmethod
     def serialize_row_key_from_tuple(cls, row_key_tuple):
@@ -225,8 +583,39 @@ class HBaseModel:
         return cls.serialize_row_key(data, is_prefix=True)
 
     @classmethod
-    def filter(cls, start=None, stop=None, prefix=None,
-               limit=None, reverse=False):
+    def serialize_columns(cls, columns):
+        """
+        把field的名称转换为HBase中的column key，用于只读取部分column
+        ['to_user_id'] => [b'cf:to_user_id']
+        row key中的field总是会返回，不需要读取column，所以被忽略
+        如果最后没有任何column，返回None，表示读取所有的column
+        """
+        if columns is None:
+            return None
+        fields = cls._schema.fields
+        column_keys = []
+        for key in columns:
+            field = fields[key]
+            if field.column_family is None:
+                continue
+            column_keys.append(
+                bytes(f'{field.column_family}:{key}', encoding='utf-8'))
+        return column_keys or None
+
+    @classmethod
+    def iter_filter(cls, start=None, stop=None, prefix=None,
+                    limit=None, reverse=False, columns=None,
+                    batch_size=1000, scan_batching=None):
+        """
+        和filter的参数一样，但返回的是一个generator，一边从HBase读取一边
+        构造instance，不会把所有的数据都放在内存中，第一条数据也能更快的返回
+        - batch_size: 每次Thrift请求从scanner中取回多少行
+        - scan_batching: 对应Java中的Scan.setBatching()，一行数据有很多column时
+          可以把一行拆成多次返回
+        - columns: 只读取指定的field，例如['to_user_id']
+        注意：在generator遍历结束(或被销毁)之前，会一直占用连接池中的一个connection，
+        所以不要在同一个线程中交叉遍历多个generator
+        """
         # serialize tuple to str
         # start, stop, prefix可以直接传一个tuple进来，类似(1, ts)
         # 表示from_user_id=1,timestamp=ts的row_key
@@ -239,40 +628,182 @@ class HBaseModel:
         row_prefix = cls.serialize_row_key_from_tuple(prefix)
 
         # scan table
-        table = cls.get_table()
-        rows = table.scan(
-            row_start, row_stop, row_prefix,
-            limit=limit, reverse=reverse)
+        # table.scan返回的是一个generator，必须在归还connection之前遍历完
+        with cls.get_table() as table:
+            rows = table.scan(
+                row_start, row_stop, row_prefix,
+                columns=cls.serialize_columns(columns),
+                limit=limit, reverse=reverse,
+                batch_size=batch_size, scan_batching=scan_batching)
 
-        # deserialize to instance list
-        results = []
-        for row_key, row_data in rows:
-            instance = cls.init_from_row(row_key, row_data)
-            results.append(instance)
-        return results
+            # deserialize to instance
+            for row_key, row_data in rows:
+                yield cls.init_from_row(row_key, row_data)
+
+    @classmethod
+    def filter(cls, start=None, stop=None, prefix=None,
+               limit=None, reverse=False, lazy=False, **kwargs):
+        """
+        返回instance list
+        lazy=True时返回iter_filter的generator，kwargs会传递给iter_filter
+        Meta.scan_cache = True时(lazy=False)，结果会被缓存，参考HBaseScanCache
+        """
+        if not lazy and cls.has_scan_cache():
+            return HBaseScanCache.filter(
+                cls, start=start, stop=stop, prefix=prefix,
+                limit=limit, reverse=reverse, **kwargs)
+        if lazy:
+            return cls.iter_filter(
+                start=start, stop=stop, prefix=prefix,
+                limit=limit, reverse=reverse, **kwargs)
+        return cls.list_filter(
+            start=start, stop=stop, prefix=prefix,
+            limit=limit, reverse=reverse, **kwargs)
+
+    @classmethod
+    @retry_on_thrift_error
+    def list_filter(cls, **kwargs):
+        """
+        一次性读完iter_filter，scan中途断开时从头重新scan
+        lazy的generator已经返回过一部分数据，不能重试
+        """
+        return list(cls.iter_filter(**kwargs))
 
     @classmethod
-    def delete(cls, **kwargs):
+    def filter_many(cls, prefixes, limit_per_prefix=None, reverse=False,
+                    max_workers=None, **kwargs):
+        """
+        同时scan多个prefix，返回{prefix: instance list}，顺序和prefixes一致
+        每个prefix的scan在线程池中执行，各自从连接池借一个connection，
+        总耗时接近最慢的那一个scan，而不是所有scan的耗时之和
+        kwargs会传递给filter，例如columns, batch_size
+        线程数最多为max_workers(默认为settings.HBASE_FILTER_MANY_WORKERS)，
+        并且不超过连接池的大小，否则多出来的线程只能等待connection
+        """
+        prefixes = list(dict.fromkeys(prefixes))
+        if max_workers is None:
+            max_workers = settings.HBASE_FILTER_MANY_WORKERS
+        max_workers = min(max_workers, settings.HBASE_POOL_SIZE, len(prefixes))
+
+        def scan(prefix):
+            return cls.filter(
+                prefix=prefix, limit=limit_per_prefix, reverse=reverse,
+                **kwargs)
+
+        if max_workers <= 1:
+            results = [scan(prefix) for prefix in prefixes]
+        else:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(scan, prefixes))
+        return dict(zip(prefixes, results))
+
+    @classmethod
+    @retry_on_thrift_error
+    def count(cls, start=None, stop=None, prefix=None, batch_size=1000):
+        """
+        统计满足条件的行数，参数和filter一样
+        FirstKeyOnlyFilter只返回每行的第一个cell，KeyOnlyFilter再把cell的value
+        去掉，这些filter在region server上执行，通过Thrift传回来的只有row key，
+        也不需要反序列化和构造instance
+        """
+        row_start = cls.serialize_row_key_from_tuple(start)
+        row_stop = cls.serialize_row_key_from_tuple(stop)
+        row_prefix = cls.serialize_row_key_from_tuple(prefix)
+
+        with cls.get_table() as table:
+            rows = table.scan(
+                row_start, row_stop, row_prefix,
+                filter=b'FirstKeyOnlyFilter() AND KeyOnlyFilter()',
+                batch_size=batch_size)
+            return sum(1 for _ in rows)
+
+    @classmethod
+    def delete(cls, batch=None, **kwargs):
+        """
+        kwargs中需要包含row key，如果有索引表，最好同时提供索引表row key需要的
+        field，否则需要先读取一次这一行数据，才知道要删除哪一条索引
+        传入batch(HBaseModel.batch())时，数据和索引的删除都放在batch中
+        """
         row_key = cls.serialize_row_key(kwargs)
-        table = cls.get_table()
-        return table.delete(row_key)
+        data = kwargs
+        indexes = cls._schema.indexes
+        index_keys = {
+            key
+            for index_model in indexes
+            for key in index_model._schema.row_key
+        }
+        if not index_keys.issubset(kwargs):
+            instance = cls.get(**kwargs)
+            if instance is not None:
+                kwargs = {key: getattr(instance, key) for key in index_keys}
+
+        if batch:
+            result = batch.delete(cls.get_table_name(), row_key)
+            cls.invalidate_scan_cache(data, batch=batch)
+        else:
+            result = cls.delete_row(row_key)
+            cls.invalidate_scan_cache(data)
+        # 先删数据再删索引，和save的顺序相反
+        if index_keys.issubset(kwargs):
+            for index_model in indexes:
+                index_model.delete(batch=batch, **kwargs)
+        return result
+
+    @classmethod
+    def rebuild_indexes(cls, batch_size=1000):
+        """
+        扫描全表，重新写入所有的索引，用于给已经存在的数据建立索引
+        返回扫描的行数
+        """
+        count = 0
+        for instance in cls.iter_filter(batch_size=batch_size):
+            instance.save_indexes()
+            count += 1
+        return count
 
     # step 1：创建HBaseModel
     @classmethod
-    def create(cls, batch=None, **kwargs):
+    def create(cls, batch=None, buffered=False, **kwargs):
         # 类似django ORM的写法
         # 调用__init__构造函数
         instance = cls(**kwargs)
-        instance.save(batch=batch)
+        instance.save(batch=batch, buffered=buffered)
         return instance
 
     @classmethod
-    def batch_create(cls, batch_data):
-        table = cls.get_table()
-        batch = table.batch()
+    def migrate_row_keys(cls, batch_size=1000):
+        """
+        把表中旧的字符串格式的row key重写为Meta.row_key_codec指定的二进制格式
+        旧的row会被删除，column中的数据原样复制，返回迁移的行数
+        可以重复执行，已经是二进制格式的row会被跳过
+        注意：迁移完成之前，新格式的前缀查询是查不到旧数据的，所以应该在切换
+        row_key_codec之后、开放读写之前执行
+        """
+        codec = cls._schema.row_key_codec
+        if not hasattr(codec, 'legacy_codec'):
+            raise Exception(
+                f'{cls.__name__} does not use a binary row key codec')
+
+        migrated = 0
+        with cls.get_table() as table:
+            with table.batch(batch_size=batch_size) as batch:
+                for row_key, row_data in table.scan(batch_size=batch_size):
+                    if not codec.is_legacy(row_key):
+                        continue
+                    data = codec.legacy_codec.deserialize(row_key)
+                    batch.put(codec.serialize(data), row_data)
+                    batch.delete(row_key)
+                    migrated += 1
+        # 所有的row key都变了，每个前缀的token也要失效
+        if cls.has_scan_cache():
+            HBaseScanCache.invalidate_table(cls)
+        return migrated
+
+    @classmethod
+    def batch_create(cls, batch_data, batch_size=None):
         results = []
-        for data in batch_data:
-            results.append(cls.create(batch=batch, **data))
-        batch.send()
+        with cls.batch(batch_size=batch_size) as batch:
+            for data in batch_data:
+                results.append(cls.create(batch=batch, **data))
         return results
 
@@ -0,0 +1,120 @@
+from django.core.exceptions import ImproperlyConfigured
+from django_hbase.models.codecs import ROW_KEY_CODECS
+from types import MappingProxyType
+
+# column family的默认配置，Meta.column_families中的配置会覆盖它们
+# Thrift中ColumnDescriptor的默认值是保留3个版本、不开启block cache、
+# 不开启bloom filter，都不适合我们的读写方式
+DEFAULT_COLUMN_FAMILY_OPTIONS = {
+    # 我们从来不读取历史版本
+    'max_versions': 1,
+    'block_cache_enabled': True,
+    # get/exists时可以跳过不包含这个row key的HFile
+    'bloom_filter_type': 'ROW',
+}
+
+# happybase create_table支持的配置，对应HBase shell中的名称
+COLUMN_FAMILY_OPTIONS = {
+    'max_versions': 'VERSIONS',
+    'compression': 'COMPRESSION',
+    'in_memory': 'IN_MEMORY',
+    'bloom_filter_type': 'BLOOMFILTER',
+    'block_cache_enabled': 'BLOCKCACHE',
+    # in seconds
+    'time_to_live': 'TTL',
+}
+
+
+class HBaseModelSchema:
+    """
+    每个HBaseModel在定义时(由HBaseModelMeta)编译一次的schema，之后不可修改
+    之前每次序列化/反序列化一行数据，都要遍历cls.__dict__去找HBaseField，
+    scan 1000行数据就要重复构建几千次，现在只需要查dict就可以了
+    - fields: {name: field}，按照定义的顺序
+    - row_key: Meta.row_key
+    - row_key_codec: row key的编解码器，由Meta.row_key_codec指定，默认为'string'
+    - column_fields: ((name, 'cf:name', encode), ...)
+    - columns: {b'cf:name': (name, decode)}，用于解析HBase返回的row data
+    - counters: {name: b'cf:name'}，CounterField对应的column
+    - indexes: Meta.indexes，二级索引表的model
+    - column_families: {family: options}，创建table时使用
+    """
+    __slots__ = (
+        'fields', 'row_key', 'row_key_codec', 'column_fields', 'columns',
+        'indexes', 'column_families', 'counters',
+    )
+
+    def __init__(self, model_name, fields, row_key, row_key_codec='string',
+                 indexes=(), column_families=None):
+        for key in row_key:
+            if key not in fields:
+                raise ImproperlyConfigured(
+                    f'{model_name}.Meta.row_key: {key} is not a HBaseField')
+            if fields[key].column_family is not None:
+                raise ImproperlyConfigured(
+                    f'{model_name}.Meta.row_key: {key} is a column')
+        for key, field in fields.items():
+            if field.column_family is None and key not in row_key:
+                raise ImproperlyConfigured(
+                    f'{model_name}.{key} should be either in Meta.row_key '
+                    f'or have a column_family')
+            if field.field_type == 'counter' and field.column_family is None:
+                raise ImproperlyConfigured(
+                    f'{model_name}.{key}: CounterField should have a '
+                    f'column_family')
+
+        for index_model in indexes:
+            for key in index_model._schema.fields:
+                if key not in fields:
+                    raise ImproperlyConfigured(
+                        f'{model_name}.Meta.indexes: {key} of '
+                        f'{index_model.__name__} is not a HBaseField')
+
+        if row_key_codec not in ROW_KEY_CODECS:
+            raise ImproperlyConfigured(
+                f'{model_name}.Meta.row_key_codec should be one of '
+                f'{list(ROW_KEY_CODECS)}')
+
+        self.fields = MappingProxyType(dict(fields))
+        self.row_key = tuple(row_key)
+        self.indexes = tuple(indexes)
+        self.row_key_codec = ROW_KEY_CODECS[row_key_codec](
+            model_name, fields, row_key)
+        self.column_fields = tuple(
+            (key, '{}:{}'.format(field.column_family, key), field.serialize)
+            for key, field in fields.items()
+            if field.column_family is not None
+        )
+        self.columns = MappingProxyType({
+            bytes(column_key, encoding='utf-8'): (key, fields[key].deserialize)
+            for key, column_key, _ in self.column_fields
+        })
+        self.counters = MappingProxyType({
+            key: bytes(column_key, encoding='utf-8')
+            for key, column_key, _ in self.column_fields
+            if fields[key].field_type == 'counter'
+        })
+        self.column_families = self.compile_column_families(
+            model_name, fields, column_families or {})
+
+    @classmethod
+    def compile_column_families(cls, model_name, fields, column_families):
+        families = {}
+        for field in fields.values():
+            if field.column_family and field.column_family not in families:
+                families[field.column_family] = MappingProxyType(
+                    DEFAULT_COLUMN_FAMILY_OPTIONS)
+        for family, options in column_families.items():
+            if family not in families:
+                raise ImproperlyConfigured(
+                    f'{model_name}.Meta.column_families: {family} is not '
+                    f'used by any field')
+            for option in options:
+                if option not in COLUMN_FAMILY_OPTIONS:
+                    raise ImproperlyConfigured(
+                        f'{model_name}.Meta.column_families: unknown option '
+                        f'{option}, should be one of '
+                        f'{list(COLUMN_FAMILY_OPTIONS)}')
+            families[family] = MappingProxyType(
+                {**DEFAULT_COLUMN_FAMILY_OPTIONS, **options})
+        return MappingProxyType(families)
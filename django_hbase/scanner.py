@@ -0,0 +1,185 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from utils.redis_client import RedisClient
+
+import django
+import operator
+import pickle
+
+
+def setup_worker():
+    # spawn/forkserver启动的子进程需要重新初始化django，fork的子进程什么都不用做
+    # HBase的连接池和redis的连接池都会按pid重新创建
+    if not apps.ready:
+        django.setup()
+
+
+def scan_range(scanner, range_index, row_start, row_stop,
+               callback, reducer, initial):
+    """
+    在worker进程中执行，scan一个range，返回(range_index, count, result)
+    有checkpoint时从上一次记录的row key之后继续
+    """
+    count, result = 0, initial
+    checkpoint = scanner.get_checkpoint(range_index)
+    if checkpoint is not None:
+        if checkpoint['done']:
+            return range_index, checkpoint['count'], checkpoint['result']
+        count, result = checkpoint['count'], checkpoint['result']
+        if checkpoint['last_row_key'] is not None:
+            # 紧跟在last_row_key之后的row key
+            row_start = checkpoint['last_row_key'] + b'\x00'
+
+    model_class = scanner.model_class
+    last_row_key = None
+    with model_class.get_table() as table:
+        rows = table.scan(
+            row_start=row_start or None,
+            row_stop=row_stop or None,
+            columns=model_class.serialize_columns(scanner.columns),
+            batch_size=scanner.batch_size,
+        )
+        for row_key, row_data in rows:
+            instance = model_class.init_from_row(row_key, row_data)
+            if callback is not None:
+                callback(instance)
+            if reducer is not None:
+                result = reducer(result, instance)
+            count += 1
+            last_row_key = row_key
+            if count % scanner.checkpoint_interval == 0:
+                scanner.save_checkpoint(
+                    range_index, last_row_key, count, result)
+    scanner.save_checkpoint(range_index, last_row_key, count, result, True)
+    return range_index, count, result
+
+
+class HBaseTableScanner:
+    """
+    把整张表的row key空间切分成多个range，在进程池中并行scan，用于backfill，
+    数据检查，重新计算count等离线任务
+    scanner = HBaseTableScanner(HBaseNewsFeed, split='salt', buckets=16)
+    total = scanner.run(reducer=count_tweets, initial=0)
+    - split='regions': 按region的边界切分，每个range只访问一个region server
+    - split='salt': row key第一个field是reverse=True的IntegerField时，
+      前缀是均匀分布的，按前缀平均切分为buckets段，不需要知道region的边界
+    callback(instance)和reducer(result, instance)都在worker进程中执行，
+    必须是module级别的函数(可以被pickle)，每个range的reducer都从initial开始，
+    结果在主进程中用combine(a, b)合并，默认是operator.add
+    job_name不为None时，每个range每scan checkpoint_interval行就在redis中记录
+    一次进度和reducer的结果，job中途失败时用相同的job_name重新执行，已经完成
+    的range会被跳过，没完成的从记录的row key之后继续，所以callback可能对
+    同一行执行多次，需要是幂等的
+    """
+
+    def __init__(self, model_class, split='regions', buckets=None,
+                 processes=None, columns=None, batch_size=1000,
+                 job_name=None, checkpoint_interval=1000):
+        if split not in ('regions', 'salt'):
+            raise ValueError("split should be 'regions' or 'salt'")
+        self.model_class = model_class
+        self.split = split
+        self.buckets = buckets or settings.HBASE_SCAN_PROCESSES
+        self.processes = processes or settings.HBASE_SCAN_PROCESSES
+        self.columns = columns
+        self.batch_size = batch_size
+        self.job_name = job_name
+        self.checkpoint_interval = checkpoint_interval
+
+    def get_ranges(self):
+        """
+        返回[(row_start, row_stop), ...]，b''表示没有边界，range之间没有重叠
+        """
+        if self.split == 'salt':
+            codec = self.model_class._schema.row_key_codec
+            split_keys = codec.get_salt_split_keys(self.buckets)
+            bounds = [b''] + split_keys + [b'']
+            return list(zip(bounds[:-1], bounds[1:]))
+        with self.model_class.get_table() as table:
+            regions = table.regions()
+        return sorted(
+            (region['start_key'], region['end_key']) for region in regions
+        )
+
+    def get_checkpoint_key(self):
+        return f'hbase_scan_job:{self.model_class.get_table_name()}:' \
+               f'{self.job_name}'
+
+    def get_checkpoint(self, range_index):
+        if self.job_name is None:
+            return None
+        data = RedisClient.get_connection().hget(
+            self.get_checkpoint_key(), range_index)
+        return None if data is None else pickle.loads(data)
+
+    def save_checkpoint(self, range_index, last_row_key, count, result,
+                        done=False):
+        if self.job_name is None:
+            return
+        checkpoint = {
+            'last_row_key': last_row_key,
+            'count': count,
+            'result': result,
+            'done': done,
+        }
+        previous = self.get_checkpoint(range_index)
+        if last_row_key is None and previous is not None:
+            # 从checkpoint继续之后没有再读到数据
+            checkpoint['last_row_key'] = previous['last_row_key']
+        conn = RedisClient.get_connection()
+        conn.hset(self.get_checkpoint_key(), range_index,
+                  pickle.dumps(checkpoint))
+        conn.expire(self.get_checkpoint_key(), settings.REDIS_KEY_EXPIRE_TIME)
+
+    def load_ranges(self):
+        """
+        region可能在两次执行之间分裂，重新执行同一个job时必须使用第一次的切分
+        """
+        if self.job_name is None:
+            return self.get_ranges()
+        conn = RedisClient.get_connection()
+        data = conn.hget(self.get_checkpoint_key(), 'ranges')
+        if data is not None:
+            return pickle.loads(data)
+        ranges = self.get_ranges()
+        conn.hset(self.get_checkpoint_key(), 'ranges', pickle.dumps(ranges))
+        conn.expire(self.get_checkpoint_key(), settings.REDIS_KEY_EXPIRE_TIME)
+        return ranges
+
+    def clear_checkpoint(self):
+        if self.job_name is not None:
+            RedisClient.get_connection().delete(self.get_checkpoint_key())
+
+    def run(self, callback=None, reducer=None, initial=None,
+            combine=operator.add):
+        """
+        返回所有range的reducer结果合并之后的值，没有reducer时返回scan的行数
+        """
+        ranges = self.load_ranges()
+        tasks = [
+            (self, range_index, row_start, row_stop,
+             callback, reducer, initial)
+            for range_index, (row_start, row_stop) in enumerate(ranges)
+        ]
+        if self.processes <= 1:
+            results = [scan_range(*task) for task in tasks]
+        else:
+            # 子进程不能和父进程共用数据库连接，fork之前先关掉，用到时会重新连接
+            connections.close_all()
+            with ProcessPoolExecutor(
+                    max_workers=min(self.processes, len(tasks)),
+                    initializer=setup_worker) as executor:
+                futures = [executor.submit(scan_range, *task) for task in tasks]
+                # 按range的顺序合并，不依赖完成的先后
+                results = [future.result() for future in futures]
+
+        if reducer is None:
+            return sum(count for _, count, _ in results)
+        if not results:
+            return initial
+        total = results[0][2]
+        for _, _, result in results[1:]:
+            total = combine(total, result)
+        return total
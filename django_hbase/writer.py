@@ -0,0 +1,169 @@
+from concurrent.futures import Future
+from django.conf import settings
+from django_hbase.cache import HBaseScanCache
+from django_hbase.client import HBaseClient, retry_on_thrift_error
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class HBaseBufferedWriter:
+    """
+    后台批量写入HBase，每个进程一个writer(一个后台线程)
+    调用put时只是把mutation放到队列中，立刻返回一个Future，不需要等待Thrift请求
+    后台线程把mutation按table分组，攒够buffer_size个或者等待flush_interval秒后，
+    每个table用一个batch一次性写入
+    需要读到自己刚写入的数据时，调用future.result()或者flush()等待写入完成
+    注意：进程崩溃或被强制退出(os._exit)时，还没有写入的数据会丢失，所以只适用于
+    允许丢失的写入
+    """
+    writer = None
+    pid = None
+    lock = threading.Lock()
+    # 进程退出时最多等待多少秒把剩下的mutation写入
+    exit_timeout = 5
+
+    @classmethod
+    def get_writer(cls):
+        pid = os.getpid()
+        if cls.writer is not None and cls.pid == pid:
+            return cls.writer
+
+        with cls.lock:
+            # fork之后子进程中没有父进程的后台线程，需要重新创建
+            if cls.writer is None or cls.pid != pid:
+                cls.writer = cls(
+                    buffer_size=settings.HBASE_WRITE_BUFFER_SIZE,
+                    flush_interval=settings.HBASE_WRITE_BUFFER_INTERVAL,
+                )
+                cls.pid = pid
+                # 在启动后台线程的进程中注册，fork出来的子进程会继承atexit，
+                # 但子进程中没有这个线程，flush_at_exit会直接跳过
+                atexit.register(cls.writer.flush_at_exit)
+        return cls.writer
+
+    def __init__(self, buffer_size, flush_interval):
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        # {table_name: [(row_key, row_data, future, invalidation), ...]}
+        self.mutations = {}
+        self.size = 0
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, table_name, row_key, row_data, invalidation=None):
+        """
+        invalidation: (model_class, data)，写入之后让HBaseScanCache失效，
+        同一次send中所有的失效在一次redis请求中完成
+        """
+        future = Future()
+        self.queue.put((table_name, row_key, row_data, future, invalidation))
+        return future
+
+    def flush(self, timeout=None):
+        """
+        等待调用flush之前放入队列的所有mutation都写入HBase
+        """
+        future = Future()
+        self.queue.put(future)
+        return future.result(timeout=timeout)
+
+    def flush_at_exit(self):
+        """
+        进程退出时最多等待exit_timeout秒，把剩下的mutation写入
+        """
+        if os.getpid() != self.pid or not self.thread.is_alive():
+            return
+        try:
+            self.flush(timeout=self.exit_timeout)
+        except Exception:
+            logger.exception('failed to flush hbase writes at exit')
+
+    def stop(self, timeout=None):
+        """
+        写入剩下的mutation之后结束后台线程
+        """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self):
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                # 到时间了，把攒的mutation写入
+                self.send()
+                deadline = None
+                continue
+
+            if item is None:
+                # stop
+                self.send()
+                return
+
+            if isinstance(item, Future):
+                # flush barrier
+                self.send()
+                deadline = None
+                item.set_result(True)
+                continue
+
+            table_name, *mutation = item
+            self.mutations.setdefault(table_name, []).append(mutation)
+            self.size += 1
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if self.size >= self.buffer_size:
+                self.send()
+                deadline = None
+
+    def send(self):
+        mutations, self.mutations, self.size = self.mutations, {}, 0
+        sent_futures = []
+        invalidations = []
+        for table_name, table_mutations in mutations.items():
+            try:
+                self.send_table(table_name, table_mutations)
+            except Exception as e:
+                # 大多数调用者不会读取future的结果，不记录的话写入失败就无从得知
+                logger.exception(
+                    'failed to write %d rows to %s',
+                    len(table_mutations), table_name,
+                )
+                for _, _, future, _ in table_mutations:
+                    future.set_exception(e)
+                continue
+            for _, _, future, invalidation in table_mutations:
+                sent_futures.append(future)
+                if invalidation is not None:
+                    invalidations.append(invalidation)
+        # 先让scan cache失效再通知调用者，future完成之后scan能读到新的数据
+        try:
+            HBaseScanCache.invalidate_many(invalidations)
+        except Exception:
+            logger.exception('failed to invalidate hbase scan cache')
+        for future in sent_futures:
+            future.set_result(True)
+
+    @staticmethod
+    @retry_on_thrift_error
+    def send_table(table_name, table_mutations):
+        # 只有put，重复写入的结果相同，网络错误时整个batch重试
+        with HBaseClient.connection() as conn:
+            with conn.table(table_name).batch() as batch:
+                for row_key, row_data, _, _ in table_mutations:
+                    batch.put(row_key, row_data)
@@ -0,0 +1,4 @@
+from django.conf import settings
+
+# 扫描粉丝列表时，每次Thrift请求从HBase取回多少行
+FOLLOWER_SCAN_BATCH_SIZE = 1000 if not settings.TESTING else 2
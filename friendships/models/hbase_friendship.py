@@ -1,6 +1,23 @@
 from django_hbase import models
 
 
+class HBaseFollowingIndex(models.HBaseModel):
+    """
+    HBaseFollowing的二级索引，row_key 为 from_user_id + to_user_id
+    用于判断 A 是否关注了 B，只需要一次 get，而不需要扫描 A 关注的所有人
+    created_at 用于找到 HBaseFollowing 中对应的那一行
+    由 HBaseFollowing 在 save/delete 时自动维护，不需要手动写入
+    """
+    from_user_id = models.IntegerField(reverse=True)
+    to_user_id = models.IntegerField()
+
+    created_at = models.TimestampField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_following_index'
+        row_key = ('from_user_id', 'to_user_id')
+
+
 class HBaseFollowing(models.HBaseModel):
     """
     存储 from_user_id follow 了哪些人，row_key 按照 from_user_id + created_at 排序
@@ -24,6 +41,9 @@ class HBaseFollowing(models.HBaseModel):
     class Meta:
         table_name = 'twitter_followings'
         row_key = ('from_user_id', 'created_at')
+        indexes = (HBaseFollowingIndex,)
+        # 关注列表的翻页会重复scan相同的范围
+        scan_cache = True
 
 
 class HBaseFollower(models.HBaseModel):
@@ -43,3 +63,4 @@ class HBaseFollower(models.HBaseModel):
     class Meta:
         row_key = ('to_user_id', 'created_at')
         table_name = 'twitter_followers'
+        scan_cache = True
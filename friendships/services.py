@@ -2,7 +2,14 @@ from django.conf import settings
 from django.core.cache import caches
 from twitter.cache import FOLLOWINGS_PATTERN
 from gatekeeper.models import GateKeeper
-from friendships.models import HBaseFollowing, HBaseFollower, Friendship
+from friendships.models import (
+    HBaseFollowing,
+    HBaseFollower,
+    HBaseFollowingIndex,
+    Friendship,
+)
+from friendships.constants import FOLLOWER_SCAN_BATCH_SIZE
+from django_hbase.models import HBaseModel
 
 import time
 
@@ -63,7 +70,13 @@ class FriendshipService:
     @classmethod
     def get_follower_ids(cls, to_user_id):
         if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = HBaseFollower.filter(prefix=(to_user_id, None))
+            # 粉丝可能有几百万，使用generator一边读一边取出from_user_id
+            # 不需要把所有的HBaseFollower都同时放在内存中
+            friendships = HBaseFollower.filter(
+                prefix=(to_user_id, None),
+                lazy=True,
+                batch_size=FOLLOWER_SCAN_BATCH_SIZE,
+            )
         else:
             friendships = Friendship.objects.filter(to_user_id=to_user_id)
 
@@ -91,7 +104,8 @@ class FriendshipService:
 
         # <TODO> cache in redis set
         if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
+            friendships = HBaseFollowing.filter(
+                prefix=(from_user_id, None), lazy=True)
 
         else:
             friendships = Friendship.objects.filter(from_user_id=from_user_id)
@@ -110,14 +124,36 @@ class FriendshipService:
         cache.delete(key)
 
     @classmethod
-    def get_follow_instance(cls, from_user_id, to_user_id):
+    def get_legacy_follow_instance(cls, from_user_id, to_user_id):
+        """
+        索引表上线之前写入的关注关系没有索引，在执行
+        manage.py rebuild_hbase_indexes twitter_followings并打开
+        switch_following_index_built之前，索引中找不到时还需要扫描一次
+        """
+        if GateKeeper.is_switch_on('switch_following_index_built'):
+            return None
         followings = HBaseFollowing.filter(prefix=(from_user_id, None))
         # 通常关注的人的数量是很有限的，不会出现一个人关注一百万人的情况
         for follow in followings:
             if follow.to_user_id == to_user_id:
+                # 顺便补上索引，下一次就不需要再扫描了
+                follow.save_indexes()
                 return follow
         return None
 
+    @classmethod
+    def get_follow_instance(cls, from_user_id, to_user_id):
+        # 通过索引表一次get就可以找到，不需要扫描from_user_id关注的所有人
+        index = HBaseFollowingIndex.get(
+            from_user_id=from_user_id, to_user_id=to_user_id)
+        if index is None:
+            return cls.get_legacy_follow_instance(from_user_id, to_user_id)
+        return HBaseFollowing(
+            from_user_id=from_user_id,
+            to_user_id=to_user_id,
+            created_at=index.created_at,
+        )
+
     @classmethod
     def has_followed(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
@@ -146,17 +182,40 @@ class FriendshipService:
 
         # create data in hbase
         now = int(time.time() * 1000000)
-        HBaseFollower.create(
+        # 先用索引表(from_user_id, to_user_id)原子的判断是否已经关注过，
+        # 重复点击或者重试的请求不会写入两条不同created_at的关注关系
+        index, created = HBaseFollowingIndex.get_or_create(
             from_user_id=from_user_id,
             to_user_id=to_user_id,
             created_at=now,
         )
+        # 索引已经存在时，之前的请求可能在写入关注关系之前失败了，用索引中的
+        # created_at再写入一次，put是幂等的，已经写入过也不会多出一条
+        created_at = now if created else index.created_at
+        if created:
+            # 没有索引的旧数据，沿用之前的created_at，下面会覆盖刚写入的索引
+            legacy_instance = cls.get_legacy_follow_instance(
+                from_user_id, to_user_id)
+            if legacy_instance is not None:
+                created_at = legacy_instance.created_at
 
-        return HBaseFollowing.create(
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            created_at=now,
-        )
+        # HBaseFollowing(和它的索引)、HBaseFollower在一个batch中同步写入
+        # (索引已经存在，这里写入的是相同的值)
+        # HBaseFollower不能交给后台线程写入，否则关注之后马上取关时，unfollow的
+        # 删除会先于排队中的写入执行，留下一条没有关注关系的粉丝记录
+        with HBaseModel.batch() as batch:
+            HBaseFollower.create(
+                batch=batch,
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=created_at,
+            )
+            return HBaseFollowing.create(
+                batch=batch,
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=created_at,
+            )
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -181,17 +240,32 @@ class FriendshipService:
         instance = cls.get_follow_instance(from_user_id, to_user_id)
         if instance is None:
             return 0
-        HBaseFollowing.delete(
-            from_user_id=from_user_id, created_at=instance.created_at)
-        HBaseFollower.delete(
-            to_user_id=to_user_id, created_at=instance.created_at
-        )
+        # 传入to_user_id，删除索引时不需要再读取一次HBaseFollowing
+        # 三个表的删除放在一个batch中，每个表只产生一次请求
+        with HBaseModel.batch() as batch:
+            HBaseFollowing.delete(
+                batch=batch,
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=instance.created_at,
+            )
+            HBaseFollower.delete(
+                batch=batch,
+                to_user_id=to_user_id,
+                created_at=instance.created_at,
+            )
         return 1
 
     @classmethod
     def get_following_count(cls, from_user_id):
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             return Friendship.objects.filter(from_user_id=from_user_id).count()
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        return len(followings)
+        return HBaseFollowing.count(prefix=(from_user_id, None))
+
+    @classmethod
+    def get_follower_count(cls, to_user_id):
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            return Friendship.objects.filter(to_user_id=to_user_id).count()
+        return HBaseFollower.count(
+            prefix=(to_user_id, None), batch_size=FOLLOWER_SCAN_BATCH_SIZE)
 
@@ -1,11 +1,89 @@
 from friendships.services import FriendshipService
+from gatekeeper.models import GateKeeper
 from testing.testcases import TestCase
-from django_hbase.models import EmptyColumnError, BadRowKeyError
-from friendships.models import HBaseFollower, HBaseFollowing
+from django_hbase.models import (
+    EmptyColumnError,
+    BadRowKeyError,
+    NotCounterFieldError,
+)
+from friendships.models import (
+    HBaseFollower,
+    HBaseFollowing,
+    HBaseFollowingIndex,
+)
+from django_hbase.cache import HBaseScanCache
+from django_hbase.client import HBaseClient, retry_on_thrift_error
+from django_hbase.writer import HBaseBufferedWriter
+from django_hbase.memory import MemoryConnectionPool, MemoryStore
+from django_hbase.scanner import HBaseTableScanner
+from django_hbase.models.codecs import StringRowKeyCodec
+from happybase import NoConnectionsAvailable
+from django_hbase import models
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import override_settings
+from thriftpy2.transport import TTransportException
+from io import StringIO
 
+import threading
 import time
 
 
+class HBaseBinaryFollowing(models.HBaseModel):
+    """
+    和HBaseFollowing相同，只是使用二进制的row key，用于测试
+    """
+    from_user_id = models.IntegerField(reverse=True)
+    created_at = models.TimestampField()
+    to_user_id = models.IntegerField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_binary_followings'
+        row_key = ('from_user_id', 'created_at')
+        row_key_codec = 'binary'
+
+
+class HBaseFriendshipCounter(models.HBaseModel):
+    """
+    每个用户的关注数和粉丝数，用于测试CounterField
+    """
+    user_id = models.IntegerField(reverse=True)
+    followings_count = models.CounterField(column_family='cf')
+    followers_count = models.CounterField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_friendship_counters'
+        row_key = ('user_id',)
+
+
+
+class HBaseAvatar(models.HBaseModel):
+    """
+    column中是bytes，用于测试HBaseScanCache的序列化
+    """
+    user_id = models.IntegerField(reverse=True)
+    content = models.HBaseField(column_family='cf')
+
+    class Meta:
+        table_name = 'twitter_avatars'
+        row_key = ('user_id',)
+        scan_cache = True
+
+
+class ScanInterrupted(Exception):
+    pass
+
+
+# HBaseTableScanner的callback和reducer需要可以被pickle，所以定义在module中
+def collect_to_user_ids(to_user_ids, following):
+    return to_user_ids + [following.to_user_id]
+
+
+def interrupt_scan(following):
+    if following.to_user_id == 5:
+        raise ScanInterrupted
+
+
 class FriendshipServiceTests(TestCase):
 
     def setUp(self):
@@ -33,15 +111,94 @@ class FriendshipServiceTests(TestCase):
             .get_following_user_id_set(self.linghu.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id, self.dongxie.id})
 
+        count = FriendshipService.get_following_count(self.linghu.id)
+        self.assertEqual(count, 3)
+        count = FriendshipService.get_follower_count(self.dongxie.id)
+        self.assertEqual(count, 1)
+
         FriendshipService.unfollow(self.linghu.id, self.dongxie.id)
+        count = FriendshipService.get_following_count(self.linghu.id)
+        self.assertEqual(count, 2)
+        count = FriendshipService.get_follower_count(self.dongxie.id)
+        self.assertEqual(count, 0)
         # FriendshipService.invalidate_following_cache(self.linghu.id)
         user_id_set = FriendshipService\
             .get_following_user_id_set(self.linghu.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
+        # 重复follow不会写入第二条关注关系
+        following = FriendshipService.follow(self.linghu.id, user1.id)
+        self.assertEqual(following.to_user_id, user1.id)
+        count = FriendshipService.get_following_count(self.linghu.id)
+        self.assertEqual(count, 2)
+
+        # 打开buffered writes时，关注之后马上取关也不会留下粉丝记录
+        with self.settings(HBASE_BUFFERED_WRITES=True):
+            FriendshipService.follow(self.dongxie.id, self.linghu.id)
+            FriendshipService.unfollow(self.dongxie.id, self.linghu.id)
+        HBaseBufferedWriter.get_writer().flush()
+        self.assertEqual(
+            FriendshipService.get_follower_ids(self.linghu.id), [])
+
+    def test_follow_repairs_missing_rows(self):
+        following = FriendshipService.follow(self.linghu.id, self.dongxie.id)
+        # 模拟之前的请求只写入了索引，关注关系没有写入
+        HBaseFollowing.delete_row(following.row_key)
+        HBaseFollower.delete_row(HBaseFollower(
+            to_user_id=self.dongxie.id,
+            created_at=following.created_at,
+        ).row_key)
+        self.assertEqual(HBaseFollowing.count(prefix=(self.linghu.id, None)), 0)
+
+        # 重试时用索引中的created_at重新写入
+        retried = FriendshipService.follow(self.linghu.id, self.dongxie.id)
+        self.assertEqual(retried.created_at, following.created_at)
+        self.assertEqual(HBaseFollowing.count(prefix=(self.linghu.id, None)), 1)
+        self.assertEqual(HBaseFollower.count(prefix=(self.dongxie.id, None)), 1)
+
+
+    def test_follow_without_index(self):
+        # 索引表上线之前写入的关注关系，没有索引
+        following = HBaseFollowing(
+            from_user_id=self.linghu.id,
+            to_user_id=self.dongxie.id,
+            created_at=int(time.time() * 1000000),
+        )
+        with HBaseFollowing.get_table() as table:
+            table.put(
+                following.row_key,
+                following.serialize_row_data(following.to_dict()))
+
+        # 重复follow不会写入第二条不同created_at的关注关系
+        self.assertTrue(
+            FriendshipService.has_followed(self.linghu.id, self.dongxie.id))
+        retried = FriendshipService.follow(self.linghu.id, self.dongxie.id)
+        self.assertEqual(retried.created_at, following.created_at)
+        self.assertEqual(HBaseFollowing.count(prefix=(self.linghu.id, None)), 1)
+        # 索引被补上了
+        index = HBaseFollowingIndex.get(
+            from_user_id=self.linghu.id, to_user_id=self.dongxie.id)
+        self.assertEqual(index.created_at, following.created_at)
+
+        # 执行rebuild_hbase_indexes之后打开开关，只查询索引
+        GateKeeper.turn_on('switch_following_index_built')
+        HBaseFollowingIndex.delete(
+            from_user_id=self.linghu.id, to_user_id=self.dongxie.id)
+        self.assertFalse(
+            FriendshipService.has_followed(self.linghu.id, self.dongxie.id))
 
 class HBaseTests(TestCase):
 
+    def setUp(self):
+        super().setUp()
+        self.writers = []
+
+    def tearDown(self):
+        # 结束测试中创建的writer的后台线程
+        for writer in self.writers:
+            writer.stop(timeout=5)
+        super().tearDown()
+
     @property
     def ts_now(self):
         return int(time.time() * 1000000)
@@ -141,6 +298,12 @@ class HBaseTests(TestCase):
         self.assertEqual(results[0].to_user_id, 3)
         self.assertEqual(results[1].to_user_id, 4)
 
+        # test count
+        self.assertEqual(HBaseFollowing.count(prefix=(1, None)), 3)
+        self.assertEqual(HBaseFollowing.count(prefix=(2, None)), 0)
+        self.assertEqual(
+            HBaseFollowing.count(start=(1, results[0].created_at)), 2)
+
         # test reverse
         results = HBaseFollowing.filter(
             prefix=(1, None, None), limit=2, reverse=True)
@@ -153,3 +316,725 @@ class HBaseTests(TestCase):
         self.assertEqual(len(results), 2)
         self.assertEqual(results[0].to_user_id, 3)
         self.assertEqual(results[1].to_user_id, 2)
+
+    def test_iter_filter(self):
+        for to_user_id in range(5):
+            HBaseFollowing.create(
+                from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+
+        followings = HBaseFollowing.iter_filter(prefix=(1, None), batch_size=2)
+        self.assertEqual(next(followings).to_user_id, 0)
+        self.assertEqual([f.to_user_id for f in followings], [1, 2, 3, 4])
+
+        followings = HBaseFollowing.filter(
+            prefix=(1, None), limit=3, reverse=True, lazy=True)
+        self.assertFalse(isinstance(followings, list))
+        self.assertEqual([f.to_user_id for f in followings], [4, 3, 2])
+
+        followings = HBaseFollowing.filter(
+            prefix=(1, None), columns=['to_user_id'], batch_size=1)
+        self.assertEqual([f.to_user_id for f in followings], [0, 1, 2, 3, 4])
+
+    def test_filter_many(self):
+        ts_now = self.ts_now
+        for from_user_id in range(1, 4):
+            for to_user_id in range(from_user_id + 1):
+                HBaseFollowing.create(
+                    from_user_id=from_user_id,
+                    to_user_id=to_user_id,
+                    created_at=ts_now + to_user_id,
+                )
+
+        prefixes = [(3, None), (1, None), (4, None), (2, None), (1, None)]
+        results = HBaseFollowing.filter_many(
+            prefixes, limit_per_prefix=2, reverse=True)
+        self.assertEqual(
+            list(results), [(3, None), (1, None), (4, None), (2, None)])
+        for prefix, followings in results.items():
+            self.assertEqual(
+                [following.to_user_id for following in followings],
+                [
+                    following.to_user_id
+                    for following in HBaseFollowing.filter(
+                        prefix=prefix, limit=2, reverse=True)
+                ],
+            )
+        self.assertEqual(
+            [f.to_user_id for f in results[(3, None)]], [3, 2])
+        self.assertEqual(results[(4, None)], [])
+
+        results = HBaseFollowing.filter_many([(2, None)], max_workers=1)
+        self.assertEqual(len(results[(2, None)]), 3)
+        self.assertEqual(HBaseFollowing.filter_many([]), {})
+
+    def test_get_many(self):
+        timestamps = [self.ts_now for _ in range(3)]
+        for to_user_id, timestamp in enumerate(timestamps):
+            HBaseFollowing.create(
+                from_user_id=1, to_user_id=to_user_id, created_at=timestamp)
+
+        keys = [
+            {'from_user_id': 1, 'created_at': timestamps[2]},
+            {'from_user_id': 1, 'created_at': self.ts_now},
+            {'from_user_id': 1, 'created_at': timestamps[0]},
+            {'from_user_id': 2, 'created_at': timestamps[1]},
+            {'from_user_id': 1, 'created_at': timestamps[2]},
+        ]
+        for batch_size in [1, 2, 100]:
+            followings = HBaseFollowing.get_many(keys, batch_size=batch_size)
+            self.assertEqual(len(followings), 5)
+            self.assertEqual(followings[0].to_user_id, 2)
+            self.assertEqual(followings[1], None)
+            self.assertEqual(followings[2].to_user_id, 0)
+            self.assertEqual(followings[3], None)
+            self.assertEqual(followings[4].to_user_id, 2)
+        self.assertEqual(HBaseFollowing.get_many([]), [])
+
+        try:
+            HBaseFollowing.get_many([{'from_user_id': 1}])
+            exception_raised = False
+        except BadRowKeyError:
+            exception_raised = True
+        self.assertEqual(exception_raised, True)
+
+    def test_indexes(self):
+        ts = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts)
+        index = HBaseFollowingIndex.get(from_user_id=1, to_user_id=2)
+        self.assertEqual(index.created_at, ts)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=2, to_user_id=1), None)
+
+        # 没有提供to_user_id，会先读取一次数据再删除索引
+        HBaseFollowing.delete(from_user_id=1, created_at=ts)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=2), None)
+
+        HBaseFollowing.create(from_user_id=1, to_user_id=3, created_at=ts)
+        HBaseFollowing.delete(from_user_id=1, to_user_id=3, created_at=ts)
+        self.assertEqual(
+            HBaseFollowing.get(from_user_id=1, created_at=ts), None)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=3), None)
+
+        # 给已经存在的数据建立索引
+        with HBaseFollowing.get_table() as table:
+            for to_user_id in range(3):
+                following = HBaseFollowing(
+                    from_user_id=1, to_user_id=to_user_id,
+                    created_at=self.ts_now)
+                table.put(
+                    following.row_key,
+                    following.serialize_row_data(following.to_dict()))
+        self.assertEqual(HBaseFollowingIndex.count(prefix=(1, None)), 0)
+        self.assertEqual(HBaseFollowing.rebuild_indexes(), 3)
+        self.assertEqual(HBaseFollowingIndex.count(prefix=(1, None)), 3)
+        self.assertTrue(FriendshipService.has_followed(1, 2))
+        self.assertFalse(FriendshipService.has_followed(1, 4))
+
+    def test_connection_pool(self):
+        pool = HBaseClient.get_pool()
+        self.assertEqual(HBaseClient.get_pool(), pool)
+
+        # 多个线程同时写，每个线程从pool中借不同的connection
+        def create_followings(from_user_id):
+            for to_user_id in range(5):
+                HBaseFollowing.create(
+                    from_user_id=from_user_id,
+                    to_user_id=to_user_id,
+                    created_at=self.ts_now,
+                )
+        threads = [
+            threading.Thread(target=create_followings, args=(user_id,))
+            for user_id in range(1, 5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for user_id in range(1, 5):
+            followings = HBaseFollowing.filter(prefix=(user_id, None))
+            self.assertEqual(len(followings), 5)
+
+        # 模拟fork之后在子进程中访问，pid变化了需要重新创建pool
+        HBaseClient.pid = -1
+        self.assertNotEqual(HBaseClient.get_pool(), pool)
+        followings = HBaseFollowing.filter(prefix=(1, None), limit=1)
+        self.assertEqual(followings[0].from_user_id, 1)
+
+    def test_buffered_writer(self):
+        writer = HBaseBufferedWriter(buffer_size=3, flush_interval=60)
+        self.writers.append(writer)
+        table_name = HBaseFollower.get_table_name()
+
+        def put(from_user_id):
+            instance = HBaseFollower(
+                to_user_id=1,
+                created_at=self.ts_now + from_user_id,
+                from_user_id=from_user_id,
+            )
+            return writer.put(
+                table_name,
+                instance.row_key,
+                instance.serialize_row_data(instance.to_dict()),
+            )
+
+        # 没有flush之前读不到，直接写入的数据不会让scan cache失效，所以用count
+        put(1)
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 0)
+        writer.flush()
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 1)
+
+        # 攒够buffer_size个之后自动写入
+        futures = [put(user_id) for user_id in range(2, 5)]
+        for future in futures:
+            self.assertEqual(future.result(timeout=1), True)
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 4)
+
+        # 超过flush_interval之后自动写入
+        writer = HBaseBufferedWriter(buffer_size=100, flush_interval=0.01)
+        self.writers.append(writer)
+        self.assertEqual(put(5).result(timeout=1), True)
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 5)
+
+        # fork出来的子进程中没有后台线程，flush_at_exit直接跳过，不会等到超时
+        writer = HBaseBufferedWriter(buffer_size=100, flush_interval=60)
+        self.writers.append(writer)
+        writer.pid = -1
+        put(6)
+        writer.flush_at_exit()
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 5)
+
+        # stop之前写入剩下的mutation，之后结束后台线程
+        writer.stop(timeout=1)
+        self.assertEqual(writer.thread.is_alive(), False)
+        self.assertEqual(HBaseFollower.count(prefix=(1, None)), 6)
+
+        # HBASE_BUFFERED_WRITES为False，直接写入
+        future = HBaseFollower(
+            to_user_id=2,
+            created_at=self.ts_now,
+            from_user_id=1,
+        ).save(buffered=True)
+        self.assertEqual(future.result(), True)
+        self.assertEqual(HBaseFollower.count(prefix=(2, None)), 1)
+
+    def test_batch(self):
+        ts_now = self.ts_now
+        with models.HBaseModel.batch(batch_size=3) as batch:
+            # HBaseFollowing和它的索引是2个mutation
+            HBaseFollowing.create(
+                batch=batch, from_user_id=1, to_user_id=2,
+                created_at=ts_now,
+            )
+            HBaseFollower.create(
+                batch=batch, from_user_id=1, to_user_id=2,
+                created_at=ts_now,
+            )
+            # 攒够3个mutation之后自动写入
+            self.assertEqual(HBaseFollower.count(prefix=(2, None)), 1)
+            self.assertNotEqual(
+                HBaseFollowingIndex.get(from_user_id=1, to_user_id=2), None)
+            HBaseFollower.create(
+                batch=batch, from_user_id=3, to_user_id=2,
+                created_at=ts_now + 1,
+            )
+            self.assertEqual(HBaseFollower.count(prefix=(2, None)), 1)
+        self.assertEqual(HBaseFollower.count(prefix=(2, None)), 2)
+
+        # 抛出异常时，还没有写入的mutation会被丢弃
+        with self.assertRaises(ValueError):
+            with models.HBaseModel.batch() as batch:
+                HBaseFollower.delete(
+                    batch=batch, to_user_id=2, created_at=ts_now)
+                raise ValueError
+        self.assertEqual(HBaseFollower.count(prefix=(2, None)), 2)
+
+        # 多个表的删除，索引也会在batch中删除
+        with models.HBaseModel.batch() as batch:
+            HBaseFollowing.delete(
+                batch=batch, from_user_id=1, to_user_id=2,
+                created_at=ts_now,
+            )
+            HBaseFollower.delete(
+                batch=batch, to_user_id=2, created_at=ts_now)
+            self.assertEqual(HBaseFollowing.count(prefix=(1, None)), 1)
+        self.assertEqual(HBaseFollowing.count(prefix=(1, None)), 0)
+        self.assertEqual(
+            HBaseFollowingIndex.get(from_user_id=1, to_user_id=2), None)
+        self.assertEqual(HBaseFollower.count(prefix=(2, None)), 1)
+
+        followers = HBaseFollower.batch_create([
+            {'from_user_id': user_id, 'to_user_id': 3, 'created_at': user_id}
+            for user_id in range(5)
+        ], batch_size=2)
+        self.assertEqual(len(followers), 5)
+        self.assertEqual(HBaseFollower.count(prefix=(3, None)), 5)
+
+    def test_counter_field(self):
+        self.assertEqual(
+            HBaseFriendshipCounter.get_counter('followers_count', user_id=1),
+            0,
+        )
+        self.assertEqual(
+            HBaseFriendshipCounter.increment('followers_count', user_id=1), 1)
+        self.assertEqual(HBaseFriendshipCounter.increment(
+            'followers_count', delta=5, user_id=1), 6)
+        self.assertEqual(HBaseFriendshipCounter.increment(
+            'followers_count', delta=-2, user_id=1), 4)
+        counter = HBaseFriendshipCounter.get(user_id=1)
+        self.assertEqual(counter.followers_count, 4)
+        self.assertEqual(counter.followings_count, None)
+
+        # save写入的值也可以继续increment
+        HBaseFriendshipCounter.create(user_id=2, followings_count=10)
+        self.assertEqual(HBaseFriendshipCounter.increment(
+            'followings_count', user_id=2), 11)
+
+        # batch中同一个counter的增量会合并
+        with models.HBaseModel.batch() as batch:
+            for user_id in [1, 2, 1]:
+                HBaseFriendshipCounter.increment(
+                    'followers_count', batch=batch, user_id=user_id)
+            HBaseFriendshipCounter.increment(
+                'followings_count', delta=-1, batch=batch, user_id=2)
+            self.assertEqual(len(batch.increments), 3)
+        self.assertEqual(
+            HBaseFriendshipCounter.get_counter('followers_count', user_id=1),
+            6,
+        )
+        counter = HBaseFriendshipCounter.get(user_id=2)
+        self.assertEqual(counter.followers_count, 1)
+        self.assertEqual(counter.followings_count, 10)
+
+        # save不会用读取时的旧值覆盖之后的increment
+        counter = HBaseFriendshipCounter.get(user_id=1)
+        HBaseFriendshipCounter.increment(
+            'followers_count', delta=5, user_id=1)
+        counter.save()
+        self.assertEqual(
+            HBaseFriendshipCounter.get_counter('followers_count', user_id=1),
+            11,
+        )
+        counter.followings_count = 3
+        with self.assertRaises(ValueError):
+            counter.save(update_fields=['followings_count'])
+
+        with self.assertRaises(NotCounterFieldError):
+            HBaseFollowing.increment(
+                'to_user_id', from_user_id=1, created_at=self.ts_now)
+        with self.assertRaises(ImproperlyConfigured):
+            class BadCounterModel(models.HBaseModel):
+                user_id = models.IntegerField()
+                count = models.CounterField()
+
+                class Meta:
+                    table_name = 'bad_counters'
+                    row_key = ('user_id', 'count')
+
+    def test_get_or_create(self):
+        ts_now = self.ts_now
+        index, created = HBaseFollowingIndex.create_if_absent(
+            from_user_id=1, to_user_id=2, created_at=ts_now)
+        self.assertTrue(created)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=2).created_at, ts_now)
+
+        # 已经存在时不会覆盖
+        index, created = HBaseFollowingIndex.create_if_absent(
+            from_user_id=1, to_user_id=2, created_at=ts_now + 1)
+        self.assertFalse(created)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=2).created_at, ts_now)
+        index, created = HBaseFollowingIndex.get_or_create(
+            from_user_id=1, to_user_id=2, created_at=ts_now + 1)
+        self.assertFalse(created)
+        self.assertEqual(index.created_at, ts_now)
+
+        # 多个column和索引表
+        following, created = HBaseFollowing.get_or_create(
+            from_user_id=1, to_user_id=3, created_at=ts_now)
+        self.assertTrue(created)
+        self.assertEqual(following.to_user_id, 3)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=3).created_at, ts_now)
+
+        with self.assertRaises(EmptyColumnError):
+            HBaseFollowingIndex.create_if_absent(
+                from_user_id=1, to_user_id=4)
+
+    def test_memory_backend(self):
+        pool = MemoryConnectionPool(size=1, latency=0.01)
+        with pool.connection() as conn:
+            conn.create_table('test_memory_backend', {'cf': {}})
+            table = conn.table('test_memory_backend')
+            rpc_count = MemoryStore.rpc_count
+            with table.batch() as batch:
+                for row_key in [b'1:a', b'1:b', b'1:c', b'2:a']:
+                    batch.put(row_key, {b'cf:name': row_key})
+            self.assertEqual(MemoryStore.rpc_count, rpc_count + 1)
+
+            # 每次请求都会等待latency
+            start = time.time()
+            rows = table.rows([b'1:c', b'3:a', b'1:a'])
+            self.assertGreaterEqual(time.time() - start, 0.01)
+            self.assertEqual([row_key for row_key, _ in rows], [b'1:c', b'1:a'])
+
+            rows = table.scan(row_prefix=b'1:', reverse=True, limit=2)
+            self.assertEqual(
+                [row_key for row_key, _ in rows], [b'1:c', b'1:b'])
+            rows = table.scan(row_start=b'1:b', row_stop=b'2:a')
+            self.assertEqual(
+                [row_key for row_key, _ in rows], [b'1:b', b'1:c'])
+            self.assertEqual(table.counter_inc(b'1:a', b'cf:count', 2), 2)
+            self.assertEqual(table.counter_get(b'1:a', b'cf:count'), 2)
+            table.delete(b'1:a')
+            self.assertEqual(table.row(b'1:a'), {})
+
+            # 同一个线程中嵌套的with拿到同一个connection，其他线程借不到
+            with pool.connection() as nested_conn:
+                self.assertIs(nested_conn, conn)
+            errors = []
+
+            def borrow():
+                try:
+                    with pool.connection(timeout=0.01):
+                        pass
+                except NoConnectionsAvailable as e:
+                    errors.append(e)
+            thread = threading.Thread(target=borrow)
+            thread.start()
+            thread.join()
+            self.assertEqual(len(errors), 1)
+            conn.delete_table('test_memory_backend', disable=True)
+
+    @override_settings(HBASE_RETRIES=2, HBASE_RETRY_BACKOFF=0.001)
+    def test_retry_on_thrift_error(self):
+        calls = []
+
+        @retry_on_thrift_error
+        def flaky(failures):
+            calls.append(1)
+            if len(calls) <= failures:
+                raise TTransportException(message='timed out')
+            return len(calls)
+
+        self.assertEqual(flaky(2), 3)
+        calls.clear()
+        with self.assertRaises(TTransportException):
+            flaky(3)
+        self.assertEqual(len(calls), 3)
+        # HBase返回的错误不会重试
+        calls.clear()
+        with self.assertRaises(BadRowKeyError):
+            retry_on_thrift_error(
+                lambda: calls.append(1) or HBaseFollowing.get(from_user_id=1)
+            )()
+        self.assertEqual(len(calls), 1)
+
+        out = StringIO()
+        call_command(
+            'benchmark_hbase', '--users', '2', '--rows-per-user', '3',
+            '--rounds', '1', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('buffered:binary newsfeeds: put'))
+
+    def test_update_fields(self):
+        ts_now = self.ts_now
+        HBaseFollowing.create(from_user_id=1, to_user_id=2, created_at=ts_now)
+        following = HBaseFollowing.get(from_user_id=1, created_at=ts_now)
+        self.assertEqual(following.get_dirty_fields(), [])
+        self.assertEqual(HBaseFollowing(from_user_id=1).get_dirty_fields(), [
+            'to_user_id',
+        ])
+
+        # 修改索引表row key中的field，旧的索引会被删除
+        following.to_user_id = 3
+        self.assertEqual(following.get_dirty_fields(), ['to_user_id'])
+        following.save(update_fields=['to_user_id'])
+        self.assertEqual(following.get_dirty_fields(), [])
+        self.assertEqual(
+            HBaseFollowing.get(from_user_id=1, created_at=ts_now).to_user_id,
+            3,
+        )
+        self.assertEqual(
+            HBaseFollowingIndex.get(from_user_id=1, to_user_id=2), None)
+        self.assertEqual(HBaseFollowingIndex.get(
+            from_user_id=1, to_user_id=3).created_at, ts_now)
+
+        with self.assertRaises(ValueError):
+            following.save(update_fields=['created_at'])
+        with self.assertRaises(ValueError):
+            following.save(update_fields=['to_user_id'], buffered=True)
+
+        # 只写入update_fields中的cell，修改为None的cell会被删除
+        HBaseFriendshipCounter.create(
+            user_id=1, followings_count=1, followers_count=2)
+        counter = HBaseFriendshipCounter.get(user_id=1)
+        counter.followings_count = 10
+        counter.followers_count = None
+        counter.save(update_fields=['followers_count'])
+        counter = HBaseFriendshipCounter.get(user_id=1)
+        self.assertEqual(counter.followings_count, 1)
+        self.assertEqual(counter.followers_count, None)
+
+        # 只读取部分column
+        counter = HBaseFriendshipCounter.get(
+            user_id=1, columns=['followings_count'])
+        self.assertEqual(counter.followings_count, 1)
+        counter = HBaseFriendshipCounter.get(
+            user_id=1, columns=['followers_count'])
+        self.assertEqual(counter, None)
+        followings = HBaseFollowing.get_many(
+            [{'from_user_id': 1, 'created_at': ts_now}],
+            columns=['to_user_id'],
+        )
+        self.assertEqual(followings[0].to_user_id, 3)
+
+    def test_scan_cache(self):
+        HBaseScanCache.clear_local()
+        ts_now = self.ts_now
+        for from_user_id in range(3):
+            HBaseFollower.create(
+                from_user_id=from_user_id, to_user_id=1,
+                created_at=ts_now + from_user_id)
+
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 3)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 3)
+        # str和int的前缀是同一个scan
+        self.assertEqual(len(HBaseFollower.filter(prefix=('1', None))), 3)
+        stats = HBaseScanCache.get_stats(HBaseFollower)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['local_hits'], 2)
+
+        # 其它进程从redis中读取
+        HBaseScanCache.clear_local()
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 3)
+        stats = HBaseScanCache.get_stats(HBaseFollower)
+        self.assertEqual(stats['redis_hits'], 1)
+
+        # 写入其它前缀不会让这个前缀失效，写入这个前缀会
+        HBaseFollower.create(from_user_id=1, to_user_id=2, created_at=ts_now)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 3)
+        HBaseFollower.create(
+            from_user_id=3, to_user_id=1, created_at=ts_now + 3)
+        followers = HBaseFollower.filter(
+            start=(1, ts_now + 1), stop=(1, ts_now + 3))
+        self.assertEqual([f.from_user_id for f in followers], [1, 2])
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 4)
+
+        # batch写入之后才会失效
+        with models.HBaseModel.batch() as batch:
+            HBaseFollower.create(
+                batch=batch, from_user_id=4, to_user_id=1,
+                created_at=ts_now + 4)
+            self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 4)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 5)
+
+        HBaseFollower.delete(to_user_id=1, created_at=ts_now)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 4)
+        # 不限定前缀的scan，任何写入都会让它失效
+        self.assertEqual(len(HBaseFollower.filter()), 5)
+        HBaseFollower.delete(to_user_id=2, created_at=ts_now)
+        self.assertEqual(len(HBaseFollower.filter()), 4)
+        self.assertEqual(
+            HBaseScanCache.get_stats(HBaseFollower)['invalidations'], 5)
+
+        # batch中不同前缀的写入一起失效
+        self.assertEqual(len(HBaseFollower.filter(prefix=(5, None))), 0)
+        with models.HBaseModel.batch() as batch:
+            for to_user_id in [1, 5, 1]:
+                HBaseFollower.create(
+                    batch=batch, from_user_id=6, to_user_id=to_user_id,
+                    created_at=ts_now + 6)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(1, None))), 5)
+        self.assertEqual(len(HBaseFollower.filter(prefix=(5, None))), 1)
+        self.assertEqual(
+            HBaseScanCache.get_stats(HBaseFollower)['invalidations'], 7)
+
+        # invalidate_table让每个前缀的缓存都失效
+        misses = HBaseScanCache.get_stats(HBaseFollower)['misses']
+        HBaseScanCache.invalidate_table(HBaseFollower)
+        HBaseFollower.filter(prefix=(1, None))
+        HBaseFollower.filter(prefix=(5, None))
+        self.assertEqual(
+            HBaseScanCache.get_stats(HBaseFollower)['misses'], misses + 2)
+
+    def test_scan_cache_bytes(self):
+        HBaseScanCache.clear_local()
+        HBaseAvatar.create(user_id=1, content='avatar_é.png')
+        # column中读取的是bytes，json不支持
+        content = 'avatar_é.png'.encode('utf-8')
+        # 第一次从HBase读取并写入cache，之后从redis中读取
+        for _ in range(2):
+            HBaseScanCache.clear_local()
+            avatars = HBaseAvatar.filter(prefix=(1,))
+            self.assertEqual(avatars[0].content, content)
+        self.assertEqual(
+            HBaseScanCache.get_stats(HBaseAvatar)['redis_hits'], 1)
+
+    def test_model_schema(self):
+        schema = HBaseFollowing._schema
+        self.assertEqual(schema.row_key, ('from_user_id', 'created_at'))
+        self.assertEqual(
+            [column_key for _, column_key, _ in schema.column_fields],
+            ['cf:to_user_id'],
+        )
+        self.assertEqual(schema.columns[b'cf:to_user_id'][0], 'to_user_id')
+        self.assertEqual(
+            list(HBaseFollowing.get_field_hash()),
+            ['from_user_id', 'created_at', 'to_user_id'],
+        )
+
+        # instance只有field对应的slot，没有__dict__
+        following = HBaseFollowing(from_user_id=1, to_user_id=2)
+        self.assertEqual(
+            HBaseFollowing.__slots__,
+            ('from_user_id', 'created_at', 'to_user_id'),
+        )
+        self.assertFalse(hasattr(following, '__dict__'))
+        self.assertEqual(following.to_dict(), {
+            'from_user_id': 1, 'created_at': None, 'to_user_id': 2,
+        })
+        with self.assertRaises(AttributeError):
+            following.unknown_field = 1
+
+        self.assertEqual(HBaseFollowing.get_column_families(), {
+            'cf': {
+                'max_versions': 1,
+                'block_cache_enabled': True,
+                'bloom_filter_type': 'ROW',
+            },
+        })
+        out = StringIO()
+        call_command('sync_hbase_tables', stdout=out)
+        self.assertEqual(
+            out.getvalue(), 'All column families are up to date.\n')
+
+        # 使用默认配置创建的table，需要alter
+        HBaseFollowing.drop_table()
+        with HBaseClient.connection() as conn:
+            conn.create_table(HBaseFollowing.get_table_name(), {'cf': dict()})
+        out = StringIO()
+        call_command(
+            'sync_hbase_tables', HBaseFollowing.get_table_name(), stdout=out)
+        self.assertIn(
+            "alter 'test_twitter_followings', {NAME => 'cf', VERSIONS => 1, "
+            "BLOCKCACHE => true, BLOOMFILTER => 'ROW'}",
+            out.getvalue(),
+        )
+
+        # 既不是row key也不是column的field，在定义model时就会报错
+        with self.assertRaises(ImproperlyConfigured):
+            class BadModel(models.HBaseModel):
+                user_id = models.IntegerField()
+                tweet_id = models.IntegerField()
+
+                class Meta:
+                    table_name = 'bad_model'
+                    row_key = ('user_id',)
+
+        with self.assertRaises(ImproperlyConfigured):
+            class BadColumnFamilyModel(models.HBaseModel):
+                user_id = models.IntegerField()
+                tweet_id = models.IntegerField(column_family='cf')
+
+                class Meta:
+                    table_name = 'bad_column_family_model'
+                    row_key = ('user_id',)
+                    column_families = {'cf': {'ttl': 100}}
+
+    def test_binary_row_key(self):
+        ts = self.ts_now
+        row_key = HBaseBinaryFollowing.serialize_row_key(
+            {'from_user_id': 1, 'created_at': ts})
+        self.assertEqual(len(row_key), 16)
+        # from_user_id按bit反转，1 => 最高位为1
+        self.assertEqual(row_key[:8], b'\x80' + b'\x00' * 7)
+        self.assertEqual(row_key[8:], ts.to_bytes(8, 'big'))
+        self.assertEqual(
+            HBaseBinaryFollowing.deserialize_row_key(row_key),
+            {'from_user_id': 1, 'created_at': ts},
+        )
+
+        for to_user_id in range(3):
+            HBaseBinaryFollowing.create(
+                from_user_id=1, to_user_id=to_user_id, created_at=self.ts_now)
+        HBaseBinaryFollowing.create(
+            from_user_id=2, to_user_id=10, created_at=self.ts_now)
+        followings = HBaseBinaryFollowing.filter(prefix=(1, None))
+        self.assertEqual([f.to_user_id for f in followings], [0, 1, 2])
+        followings = HBaseBinaryFollowing.filter(
+            prefix=(1, None), limit=2, reverse=True)
+        self.assertEqual([f.to_user_id for f in followings], [2, 1])
+        followings = HBaseBinaryFollowing.filter(
+            start=(1, followings[1].created_at), limit=2)
+        self.assertEqual([f.to_user_id for f in followings], [1, 2])
+
+        # 兼容旧的字符串格式的row key，并迁移为二进制格式
+        legacy_row_key = HBaseFollowing.serialize_row_key(
+            {'from_user_id': 3, 'created_at': ts})
+        self.assertEqual(
+            HBaseBinaryFollowing.deserialize_row_key(legacy_row_key),
+            {'from_user_id': 3, 'created_at': ts},
+        )
+        with HBaseBinaryFollowing.get_table() as table:
+            table.put(legacy_row_key, {'cf:to_user_id': '0000000000000004'})
+        self.assertEqual(len(HBaseBinaryFollowing.filter(prefix=(3, None))), 0)
+        self.assertEqual(HBaseBinaryFollowing.migrate_row_keys(), 1)
+        self.assertEqual(HBaseBinaryFollowing.migrate_row_keys(), 0)
+        followings = HBaseBinaryFollowing.filter(prefix=(3, None))
+        self.assertEqual(len(followings), 1)
+        self.assertEqual(followings[0].to_user_id, 4)
+        self.assertEqual(followings[0].created_at, ts)
+
+    def test_table_scanner(self):
+        codec = HBaseFollowing._schema.row_key_codec
+        self.assertEqual(codec.get_salt_split_keys(4), [b'2', b'5', b'7'])
+        self.assertEqual(len(codec.get_salt_split_keys(16)), 15)
+        self.assertEqual(
+            HBaseBinaryFollowing._schema.row_key_codec.get_salt_split_keys(4),
+            [b'\x40', b'\x80', b'\xc0'],
+        )
+        # 没有reverse的row key前缀不是均匀分布的
+        codec = StringRowKeyCodec(
+            'HBaseTimeline', {'created_at': models.TimestampField()},
+            ('created_at',))
+        with self.assertRaises(ValueError):
+            codec.get_salt_split_keys(4)
+
+        ts_now = self.ts_now
+        for user_id in range(1, 13):
+            HBaseFollowing.create(
+                from_user_id=user_id, to_user_id=user_id, created_at=ts_now)
+
+        scanner = HBaseTableScanner(HBaseFollowing, processes=1)
+        self.assertEqual(len(scanner.get_ranges()), 1)
+        self.assertEqual(scanner.run(), 12)
+        # 每个salt bucket在一个子进程中scan，结果在主进程中合并
+        scanner = HBaseTableScanner(
+            HBaseFollowing, split='salt', buckets=4, processes=2)
+        self.assertEqual(len(scanner.get_ranges()), 4)
+        to_user_ids = scanner.run(reducer=collect_to_user_ids, initial=[])
+        self.assertEqual(sorted(to_user_ids), list(range(1, 13)))
+
+        # 中途失败之后用相同的job_name继续，每一行只被reduce一次
+        scanner = HBaseTableScanner(
+            HBaseFollowing, split='salt', buckets=2, processes=1,
+            job_name='test', checkpoint_interval=2)
+        with self.assertRaises(ScanInterrupted):
+            scanner.run(
+                callback=interrupt_scan, reducer=collect_to_user_ids,
+                initial=[])
+        self.assertIsNotNone(scanner.get_checkpoint(0))
+        to_user_ids = scanner.run(reducer=collect_to_user_ids, initial=[])
+        self.assertEqual(sorted(to_user_ids), list(range(1, 13)))
+        scanner.clear_checkpoint()
+        self.assertIsNone(scanner.get_checkpoint(0))
+
+        out = StringIO()
+        call_command(
+            'count_hbase_rows', 'twitter_followings', '--split', 'salt',
+            '--processes', '1', stdout=out)
+        self.assertEqual(out.getvalue(), 'twitter_followings: 12 rows\n')
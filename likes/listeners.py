@@ -1,4 +1,5 @@
 from utils.redis_helper import RedisHelper
+from utils.write_behind_counters import WriteBehindCounter
 
 
 def incr_likes_count(sender, instance, created, **kwargs):
@@ -13,6 +14,13 @@ def incr_likes_count(sender, instance, created, **kwargs):
     if model_class != Tweet and model_class != Comment:
         return
 
+    # write-behind模式下只修改redis，由flush_counts_task批量写入数据库
+    # 只需要id，不用加载content_object
+    if WriteBehindCounter.is_enabled():
+        WriteBehindCounter.incr_count(
+            model_class(id=instance.object_id), 'likes_count')
+        return
+
     # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式
     # 因此这个操作不是原子操作，必须使用 update 语句才是原子操作
     # mysql有row lock行锁，保证原子操作
@@ -37,9 +45,30 @@ def decr_likes_count(sender, instance, **kwargs):
     if model_class != Tweet and model_class != Comment:
         return
 
+    if WriteBehindCounter.is_enabled():
+        WriteBehindCounter.decr_count(
+            model_class(id=instance.object_id), 'likes_count')
+        return
+
     # 不可以使用 tweet.likes_count += 1; tweet.save() 的方式
     # 因此这个操作不是原子操作，必须使用 update 语句才是原子操作
     model_class.objects.filter(id=instance.object_id) \
         .update(likes_count=F('likes_count') - 1)
 
     RedisHelper.decr_count(instance.content_object, 'likes_count')
+
+
+def count_likes(model_class, object_ids):
+    """
+    实际的likes数量，用于WriteBehindCounter.reconcile
+    一次GROUP BY查询，返回{object_id: likes_count}
+    """
+    from likes.models import Like
+    from django.contrib.contenttypes.models import ContentType
+    from django.db.models import Count
+
+    rows = Like.objects.filter(
+        content_type=ContentType.objects.get_for_model(model_class),
+        object_id__in=object_ids,
+    ).values('object_id').annotate(count=Count('id'))
+    return {row['object_id']: row['count'] for row in rows}
@@ -3,8 +3,13 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from utils.memcached_helper import MemcachedHelper
-from likes.listeners import incr_likes_count, decr_likes_count
+from likes.listeners import (
+    count_likes,
+    decr_likes_count,
+    incr_likes_count,
+)
 from django.db.models.signals import pre_delete, post_save
+from utils.write_behind_counters import WriteBehindCounter
 
 
 class Like(models.Model):
@@ -62,3 +67,6 @@ class Like(models.Model):
 
 pre_delete.connect(decr_likes_count, sender=Like)
 post_save.connect(incr_likes_count, sender=Like)
+
+WriteBehindCounter.register('tweets.Tweet', 'likes_count', count_likes)
+WriteBehindCounter.register('comments.Comment', 'likes_count', count_likes)
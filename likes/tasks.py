@@ -0,0 +1,19 @@
+from celery import shared_task
+from utils.time_constants import ONE_HOUR
+from utils.write_behind_counters import WriteBehindCounter
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def flush_counts_task():
+    """
+    write-behind模式下定期把redis中likes_count, comments_count的增量写入数据库
+    comments_count也在这里一起flush
+    """
+    rows = WriteBehindCounter.flush()
+    return '{} rows flushed'.format(rows)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_counts_task():
+    rows = WriteBehindCounter.reconcile()
+    return '{} rows reconciled'.format(rows)
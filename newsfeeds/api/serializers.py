@@ -1,14 +1,24 @@
 from rest_framework import serializers
 from tweets.api.serializers import TweetSerializer
+from tweets.models import Tweet
+from utils.count_serializers import (
+    CountsListSerializer,
+    CountsSerializerMixin,
+)
 
 
-class NewsFeedSerializer(serializers.Serializer):
+class NewsFeedSerializer(CountsSerializerMixin, serializers.Serializer):
     tweet = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
     # # TweetSerializer需要使用request，但这里无法添加
     # # 需要往NewsFeedSerializer中传递context={'request': request}
     # # 它会向下传递给TweetSerializer
     # tweet = TweetSerializer(source='cached_tweet')
+    # 批量获取的是tweet的count，TweetSerializer从共享的context中读取
+    count_attrs = TweetSerializer.count_attrs
+
+    class Meta:
+        list_serializer_class = CountsListSerializer
 
     def update(self, instance, validated_data):
         pass
@@ -16,6 +26,10 @@ class NewsFeedSerializer(serializers.Serializer):
     def create(self, validated_data):
         pass
 
+    def get_count_objects(self, objects):
+        # get_counts只需要model和id，不需要从cache中获取完整的tweet
+        return [Tweet(id=obj.tweet_id) for obj in objects]
+
     def get_tweet(self, obj):
         # 要手动指定context，通过SerializerMethodField调用，不会自动往下传递context
         return TweetSerializer(obj.cached_tweet, context=self.context).data
@@ -8,6 +8,8 @@ from newsfeeds.services import NewsFeedService
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
+import functools
+
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
     # 新鲜事只能当前登录用户查看，所以要验证登录
@@ -29,8 +31,11 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
     def list(self, request):
         # 不像之前的Serializer都是提供request.data，这次序列化的数据不是
         # 从request中传递的，而是需要从数据库中查找
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        page = self.paginator.paginate_cached_list(cached_newsfeeds, request)
+        page = self.paginator.paginate_cached_timeline(
+            functools.partial(
+                NewsFeedService.get_cached_newsfeeds_page, request.user.id),
+            request,
+        )
         if page is None:
             if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
                 # HBaseNewsFeed的Row Key是('user_id, 'created_at')
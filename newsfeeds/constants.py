@@ -1,3 +1,8 @@
 from django.conf import settings
+from utils.time_constants import ONE_DAY
 
 FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# HBase中newsfeed的存活时间，超过这个时间的newsfeed会在compaction时被自动删除
+# 这么久之前的新鲜事几乎不会被翻到，没有必要一直占用存储空间
+NEWSFEED_HBASE_TTL = 180 * ONE_DAY
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from django_hbase import models
+from newsfeeds.constants import NEWSFEED_HBASE_TTL
 from tweets.models import Tweet
 from utils.memcached_helper import MemcachedHelper
 
@@ -16,6 +17,15 @@ class HBaseNewsFeed(models.HBaseModel):
     class Meta:
         table_name = 'twitter_newsfeeds'
         row_key = ('user_id', 'created_at')
+        # 超出redis中缓存的newsfeed之后，翻页会重复scan相同的范围
+        scan_cache = True
+        column_families = {
+            'cf': {
+                # newsfeed的数据量是最大的，压缩可以节省大量存储空间
+                'compression': 'GZ',
+                'time_to_live': NEWSFEED_HBASE_TTL,
+            },
+        }
 
     def __str__(self):
         return '{} inbox of {}: {}'.format(
@@ -3,7 +3,10 @@ from newsfeeds.tasks import fanout_newsfeeds_main_task
 from twitter.cache import USER_NEWSFEEDS_PATTERN
 from utils.redis_helper import RedisHelper
 from gatekeeper.models import GateKeeper
-from utils.redis_serializers import DjangoModelSerializer, HBaseSerializer
+from utils.redis_serializers import TimelineSerializer
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
+from django_hbase.writer import HBaseBufferedWriter
+from django.conf import settings
 
 
 # 很有意思的懒惰加载，当调用lazy_load_newsfeeds(user_id=1)时
@@ -17,6 +20,9 @@ from utils.redis_serializers import DjangoModelSerializer, HBaseSerializer
 def lazy_load_newsfeeds(user_id):
     def _lazy_load(limit):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            if settings.HBASE_BUFFERED_WRITES:
+                # 等待后台线程中还没有写入的newsfeed写入完成，保证能读到刚写入的数据
+                HBaseBufferedWriter.get_writer().flush()
             return HBaseNewsFeed.filter(
                 prefix=(user_id, None), limit=limit, reverse=True)
         return NewsFeed.objects.filter(
@@ -24,6 +30,54 @@ def lazy_load_newsfeeds(user_id):
     return _lazy_load
 
 
+class NewsFeedTimelineSerializer(TimelineSerializer):
+    """
+    (created_at, id, user_id, tweet_id)，不需要读取数据库就可以还原NewsFeed，
+    tweet在渲染时通过cached_tweet获取
+    """
+    format = '>qqqq'
+
+    @classmethod
+    def get_values(cls, newsfeed):
+        return (
+            datetime_to_timestamp(newsfeed.created_at),
+            newsfeed.id,
+            newsfeed.user_id,
+            newsfeed.tweet_id,
+        )
+
+    @classmethod
+    def from_values_list(cls, values_list):
+        return [
+            NewsFeed(
+                id=newsfeed_id,
+                user_id=user_id,
+                tweet_id=tweet_id,
+                created_at=timestamp_to_datetime(created_at),
+            )
+            for created_at, newsfeed_id, user_id, tweet_id in values_list
+        ]
+
+
+class HBaseNewsFeedTimelineSerializer(TimelineSerializer):
+    """
+    (created_at, user_id, tweet_id)，就是HBaseNewsFeed的全部数据
+    """
+    format = '>qqq'
+
+    @classmethod
+    def get_values(cls, newsfeed):
+        return newsfeed.created_at, newsfeed.user_id, newsfeed.tweet_id
+
+    @classmethod
+    def from_values_list(cls, values_list):
+        return [
+            HBaseNewsFeed(
+                created_at=created_at, user_id=user_id, tweet_id=tweet_id)
+            for created_at, user_id, tweet_id in values_list
+        ]
+
+
 class NewsFeedService:
 
     @classmethod
@@ -48,23 +102,41 @@ class NewsFeedService:
         # queryset = NewsFeed.objects.filter(user_id=user_id)\
         #     .order_by('-created_at')
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_timeline(
+            key, lazy_load_newsfeeds(user_id), cls.get_timeline_serializer())
+
+    @classmethod
+    def get_cached_newsfeeds_page(cls, user_id, **kwargs):
+        """
+        只从cache中读取一页，参数和返回值参考RedisHelper.load_timeline_page
+        """
+        key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_timeline_page(
+            key, lazy_load_newsfeeds(user_id), cls.get_timeline_serializer(),
+            **kwargs)
+
+    @classmethod
+    def get_timeline_serializer(cls):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            serializer = HBaseSerializer
-        else:
-            serializer = DjangoModelSerializer
-        return RedisHelper.load_objects(
-            key, lazy_load_newsfeeds(user_id), serializer=serializer)
+            return HBaseNewsFeedTimelineSerializer
+        return NewsFeedTimelineSerializer
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
         key = USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id)
-        RedisHelper.push_object(
-            key, newsfeed, lazy_load_newsfeeds(newsfeed.user_id))
+        if isinstance(newsfeed, HBaseNewsFeed):
+            serializer = HBaseNewsFeedTimelineSerializer
+        else:
+            serializer = NewsFeedTimelineSerializer
+        RedisHelper.push_timeline_object(
+            key, newsfeed, lazy_load_newsfeeds(newsfeed.user_id), serializer)
 
     @classmethod
     def create(cls, **kwargs):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            newsfeed = HBaseNewsFeed.create(**kwargs)
+            # 交给后台线程写入，如果cache不存在需要从HBase加载，
+            # lazy_load_newsfeeds中会先等待写入完成
+            newsfeed = HBaseNewsFeed.create(buffered=True, **kwargs)
             # 需要手动触发 cache 更改，因为没有 listener 监听 hbase create
             cls.push_newsfeed_to_cache(newsfeed)
         else:
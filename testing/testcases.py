@@ -1,4 +1,4 @@
-from django.test import TestCase as DjangoTestCase
+from django.test import TestCase as DjangoTestCase, override_settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from tweets.models import Tweet
@@ -12,6 +12,9 @@ from django_hbase.models import HBaseModel
 from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
 
+import shutil
+import tempfile
+
 
 class TestCase(DjangoTestCase):
     hbase_tables_created = False
@@ -109,3 +112,13 @@ class TestCase(DjangoTestCase):
             created_at = tweet.created_at
         return NewsFeedService.create(
             user_id=user.id, tweet_id=tweet.id, created_at=created_at)
+
+    def use_temporary_media_root(self):
+        """
+        上传的文件写入临时目录，test结束后删除，不会留在项目的media文件夹中
+        """
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
@@ -7,10 +7,13 @@ from likes.api.serializers import LikeSerializer
 from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
 from rest_framework.exceptions import ValidationError
 from tweets.services import TweetService
-from utils.redis_helper import RedisHelper
+from utils.count_serializers import (
+    CountsListSerializer,
+    CountsSerializerMixin,
+)
 
 
-class TweetSerializer(serializers.ModelSerializer):
+class TweetSerializer(CountsSerializerMixin, serializers.ModelSerializer):
     # 使用缓存中的user object
     user = UserSerializerForTweet(source='cached_user')
     # 是否被赞， 需要实现一个get_has_liked()方法
@@ -20,9 +23,12 @@ class TweetSerializer(serializers.ModelSerializer):
     comments_count = serializers.SerializerMethodField()
     likes_count = serializers.SerializerMethodField()
     photo_urls = serializers.SerializerMethodField()
+    count_attrs = ('likes_count', 'comments_count')
 
     class Meta:
         model = Tweet
+        # many=True时一页的count批量获取
+        list_serializer_class = CountsListSerializer
         fields = (
             'id',
             'user',
@@ -38,11 +44,12 @@ class TweetSerializer(serializers.ModelSerializer):
         # N + Queries
         # N如果是db queries-->不可接受
         # N如果是redis/memached queries-->可以接受
-        return RedisHelper.get_count(obj, 'likes_count')
+        # 列表中的count已经通过CountsListSerializer批量获取了
+        return self.get_count(obj, 'likes_count')
 
     def get_comments_count(self, obj):
         # comment_set是django定义的反查机制
-        return RedisHelper.get_count(obj, 'comments_count')
+        return self.get_count(obj, 'comments_count')
 
     def get_has_liked(self, obj):
         return LikeService.has_liked(self.context["request"].user, obj)
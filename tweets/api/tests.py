@@ -81,6 +81,7 @@ class TweetApiTests(TestCase):
         self.assertEqual(Tweet.objects.count(), tweets_count + 1)
 
     def test_create_with_files(self):
+        self.use_temporary_media_root()
         # 上传的data没有files,兼容就的客户端
         response = self.user1_client.post(TWEET_CREATE_API, {
             'content': 'a selfie no files',
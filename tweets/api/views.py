@@ -16,6 +16,8 @@ from utils.memcached_helper import MemcachedHelper
 from django.utils.decorators import method_decorator
 from ratelimit.decorators import ratelimit
 
+import functools
+
 
 class TweetViewSet(viewsets.GenericViewSet,
                    viewsets.mixins.CreateModelMixin,
@@ -53,10 +55,12 @@ class TweetViewSet(viewsets.GenericViewSet,
 
         # 从Redis缓存中读取tweets
         user_id = request.query_params['user_id']
-        cached_tweets = TweetService.get_cached_tweets(user_id)
-        # 这里要使用self.paginator，因为paginate_cached_list是自定义的函数
+        # 这里要使用self.paginator，因为paginate_cached_timeline是自定义的函数
         # ViewSet中没有相应的函数
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
+        page = self.paginator.paginate_cached_timeline(
+            functools.partial(TweetService.get_cached_tweets_page, user_id),
+            request,
+        )
         # 直接从数据库读取
         if page is None:
             # 这句查询会被翻译为
@@ -1,6 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
-from utils.time_helpers import utc_now
+from utils.time_helpers import datetime_to_timestamp, utc_now
 from likes.models import Like
 from django.contrib.contenttypes.models import ContentType
 from utils.listeners import invalidate_object_cache
@@ -80,7 +80,7 @@ class Tweet(models.Model):
 
     @property
     def timestamp(self):
-        return int(self.created_at.timestamp() * 1000000)
+        return datetime_to_timestamp(self.created_at)
 
 
 post_save.connect(invalidate_object_cache, sender=Tweet)
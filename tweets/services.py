@@ -1,7 +1,10 @@
 from tweets.models import TweetPhoto
 from tweets.models import Tweet
 from twitter.cache import USER_TWEETS_PATTERN
+from utils.memcached_helper import MemcachedHelper
 from utils.redis_helper import RedisHelper
+from utils.redis_serializers import TimelineSerializer
+from utils.time_helpers import datetime_to_timestamp
 
 
 def lazy_load_tweets(user_id):
@@ -11,6 +14,23 @@ def lazy_load_tweets(user_id):
     return _lazy_load
 
 
+class TweetTimelineSerializer(TimelineSerializer):
+    """
+    (created_at, tweet_id)，读取时tweet从memcached中批量获取
+    """
+    format = '>qq'
+
+    @classmethod
+    def get_values(cls, tweet):
+        return datetime_to_timestamp(tweet.created_at), tweet.id
+
+    @classmethod
+    def from_values_list(cls, values_list):
+        tweets = MemcachedHelper.get_objects_through_cache(
+            Tweet, [tweet_id for _, tweet_id in values_list])
+        return [tweet for tweet in tweets if tweet is not None]
+
+
 class TweetService:
     @classmethod
     def create_photos_from_files(cls, tweet, files):
@@ -29,9 +49,21 @@ class TweetService:
     def get_cached_tweets(cls, user_id):
         # 懒惰加载，此时并不会执行sql query去访问数据库
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
-        return RedisHelper.load_objects(key, lazy_load_tweets(user_id))
+        return RedisHelper.load_timeline(
+            key, lazy_load_tweets(user_id), TweetTimelineSerializer)
+
+    @classmethod
+    def get_cached_tweets_page(cls, user_id, **kwargs):
+        """
+        只从cache中读取一页，参数和返回值参考RedisHelper.load_timeline_page
+        """
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.load_timeline_page(
+            key, lazy_load_tweets(user_id), TweetTimelineSerializer, **kwargs)
 
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
-        RedisHelper.push_object(key, tweet, lazy_load_tweets(tweet.user_id))
+        RedisHelper.push_timeline_object(
+            key, tweet, lazy_load_tweets(tweet.user_id),
+            TweetTimelineSerializer)
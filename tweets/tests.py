@@ -5,7 +5,10 @@ from utils.time_helpers import utc_now
 from tweets.constants import TweetPhotoStatus
 from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer
-from tweets.services import TweetService
+from tweets.services import TweetService, TweetTimelineSerializer
+from tweets.models import Tweet
+from utils.memcached_helper import MemcachedHelper
+from utils.redis_helper import RedisHelper
 from twitter.cache import USER_TWEETS_PATTERN
 
 
@@ -54,6 +57,29 @@ class TweetTests(TestCase):
         cache_tweet = DjangoModelSerializer.deserialize(data)
         self.assertEqual(tweet, cache_tweet)
 
+    def test_get_counts(self):
+        tweet = self.create_tweet(self.linghu)
+        self.create_like(self.linghu, self.tweet)
+        self.create_comment(self.linghu, self.tweet)
+        RedisClient.clear()
+
+        # cache miss时只需要一次数据库查询
+        with self.assertNumQueries(1):
+            counts = RedisHelper.get_counts(
+                [self.tweet, tweet], ['likes_count', 'comments_count'])
+        self.assertEqual(counts, {
+            f'Tweet.likes_count:{self.tweet.id}': 1,
+            f'Tweet.comments_count:{self.tweet.id}': 1,
+            f'Tweet.likes_count:{tweet.id}': 0,
+            f'Tweet.comments_count:{tweet.id}': 0,
+        })
+        # 已经回填到cache中
+        with self.assertNumQueries(0):
+            self.assertEqual(RedisHelper.get_counts(
+                [self.tweet, tweet], ['likes_count', 'comments_count']),
+                counts)
+        self.assertEqual(RedisHelper.get_counts([], ['likes_count']), {})
+
 
 class TweetServiceTests(TestCase):
 
@@ -99,3 +125,47 @@ class TweetServiceTests(TestCase):
 
         tweets = TweetService.get_cached_tweets(self.linghu.id)
         self.assertEqual([t.id for t in tweets], [tweet2.id, tweet1.id])
+
+    def test_cached_tweets_timeline(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(2)]
+        RedisClient.clear()
+        self.clear_cache()
+        TweetService.get_cached_tweets(self.linghu.id)
+
+        # list中只存(created_at, tweet_id)
+        conn = RedisClient.get_connection()
+        key = USER_TWEETS_PATTERN.format(user_id=self.linghu.id)
+        serialized_list = conn.zrevrange(key, 0, -1)
+        self.assertEqual([len(data) for data in serialized_list], [16, 16])
+        self.assertEqual(
+            TweetTimelineSerializer.deserialize(serialized_list[0]), tweets[1])
+
+        # cache miss的tweet只需要一次查询，不存在的为None
+        with self.assertNumQueries(1):
+            cached_tweets = MemcachedHelper.get_objects_through_cache(
+                Tweet, [tweets[1].id, 0, tweets[0].id])
+        self.assertEqual(cached_tweets, [tweets[1], None, tweets[0]])
+        with self.assertNumQueries(0):
+            cached_tweets = TweetService.get_cached_tweets(self.linghu.id)
+        self.assertEqual(cached_tweets, tweets[::-1])
+        self.assertEqual(cached_tweets[0].created_at, tweets[1].created_at)
+
+    def test_get_cached_tweets_page(self):
+        tweets = [self.create_tweet(self.linghu) for _ in range(3)][::-1]
+        RedisClient.clear()
+        # cache miss时从数据库加载整个timeline，再从中取出一页
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.linghu.id, page_size=2)
+        self.assertEqual(page, tweets[:2])
+        self.assertTrue(has_next_page)
+
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.linghu.id, page_size=2,
+            created_at__lt=tweets[1].timestamp)
+        self.assertEqual(page, tweets[2:])
+        self.assertFalse(has_next_page)
+        page, has_next_page = TweetService.get_cached_tweets_page(
+            self.linghu.id, page_size=1,
+            created_at__gt=tweets[2].timestamp)
+        self.assertEqual(page, tweets[:2])
+        self.assertFalse(has_next_page)
@@ -5,5 +5,6 @@ FOLLOWINGS_PATTERN = 'followings:{user_id}'
 USER_PROFILE_PATTER = 'userprofile:{user_id}'
 
 # Redis
-USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
-USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+# v3: sorted set，member是TimelineSerializer打包的整数，score是created_at
+USER_TWEETS_PATTERN = 'user_tweets:v3:{user_id}'
+USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:v3:{user_id}'
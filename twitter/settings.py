@@ -57,6 +57,7 @@ INSTALLED_APPS = [
     'comments',
     'likes',
     'inbox',
+    'django_hbase',
 ]
 
 REST_FRAMEWORK = {
@@ -220,6 +221,14 @@ REDIS_DB = 0 if TESTING else 1
 # 超时时间
 REDIS_KEY_EXPIRE_TIME = 7 * 86400  # in seconds
 REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
+# cache失效时只有拿到锁的一个进程重新加载，其它进程最多等待SINGLE_FLIGHT_WAIT秒，
+# 参考utils.single_flight
+SINGLE_FLIGHT_LEASE = 3  # in seconds
+SINGLE_FLIGHT_WAIT = 0.5  # in seconds
+# probabilistic early refresh的参数，越大越早刷新，1是论文中推荐的默认值
+CACHE_EARLY_REFRESH_BETA = 1
+# 重新加载一个timeline大约需要的时间，用于决定提前多久刷新
+TIMELINE_REBUILD_TIME = 1  # in seconds
 
 # Celery配置选项
 # 使用如下命令把worker进程(只执行异步任务的进程，可以不与web server在同一台机器上)
@@ -239,6 +248,28 @@ CELERY_QUEUES = (
     Queue('newsfeeds', routing_key='newsfeeds'),
 )
 
+# write-behind模式下的count，参考utils.write_behind_counters
+# 多久把redis中的增量flush到数据库一次(in seconds)
+WRITE_BEHIND_FLUSH_INTERVAL = 5
+WRITE_BEHIND_RECONCILE_INTERVAL = 60
+# 每次最多reconcile多少个count
+WRITE_BEHIND_RECONCILE_BATCH_SIZE = 1000
+# flush和reconcile不会同时执行，进程挂掉之后锁最多持有多久(in seconds)
+WRITE_BEHIND_LOCK_LEASE = 60
+
+# 定期执行的任务，使用如下命令启动
+# celery -A twitter beat -l INFO
+CELERY_BEAT_SCHEDULE = {
+    'flush-counts': {
+        'task': 'likes.tasks.flush_counts_task',
+        'schedule': WRITE_BEHIND_FLUSH_INTERVAL,
+    },
+    'reconcile-counts': {
+        'task': 'likes.tasks.reconcile_counts_task',
+        'schedule': WRITE_BEHIND_RECONCILE_INTERVAL,
+    },
+}
+
 # Rate Limiter
 RATELIMIT_USE_CACHE = 'ratelimit'
 RATELIMIT_CACHE_PREFIX = 'rl:'   # 避免和其他的 key 冲突
@@ -246,6 +277,43 @@ RATELIMIT_ENABLE = not TESTING  # 在某些环境下，比如内部测试等环
 
 # HBase Database
 HBASE_HOST = '127.0.0.1'
+HBASE_PORT = 9090
+# 'buffered'或'framed'，'binary'或'compact'，需要和Thrift server的配置一致
+HBASE_TRANSPORT = 'buffered'
+HBASE_PROTOCOL = 'binary'
+# Thrift socket的超时时间(in milliseconds)
+HBASE_TIMEOUT = 5000
+# 所有table名称的前缀，例如'twitter'，None表示没有前缀
+HBASE_TABLE_PREFIX = None
+# 网络错误时最多重试几次，第n次重试前等待HBASE_RETRY_BACKOFF * 2^n秒
+HBASE_RETRIES = 2
+HBASE_RETRY_BACKOFF = 0.05
+HBASE_RETRY_MAX_BACKOFF = 1
+# 'happybase'连接Thrift server，'memory'使用进程内的HBase，用于本地benchmark
+HBASE_BACKEND = 'happybase'
+# memory backend中每次请求额外等待的时间(in seconds)，模拟网络往返
+HBASE_MEMORY_LATENCY = 0
+# 每个进程中HBase连接池的大小，一般和web server每个进程的线程数保持一致
+HBASE_POOL_SIZE = 10
+# 从连接池中借connection的超时时间，in seconds
+HBASE_POOL_TIMEOUT = 3
+# HBaseModel.get_many每次Thrift请求最多读取多少行
+HBASE_GET_MANY_BATCH_SIZE = 100
+# HBaseModel.batch()中每多少个mutation自动写入一次
+HBASE_BATCH_SIZE = 1000
+# HBaseModel.filter_many中同时scan的线程数
+HBASE_FILTER_MANY_WORKERS = 8
+# HBaseTableScanner默认的进程数，按salt切分时也是默认的range数
+HBASE_SCAN_PROCESSES = 4
+# Meta.scan_cache = True的HBaseModel，filter结果在redis中缓存的时间(in seconds)
+HBASE_SCAN_CACHE_TIMEOUT = 300
+# 每个进程中最多缓存多少个filter结果
+HBASE_SCAN_CACHE_LOCAL_SIZE = 1000
+# save(buffered=True)时是否交给后台线程批量写入，默认关闭，直接同步写入
+HBASE_BUFFERED_WRITES = False
+# 后台线程攒够多少个mutation，或者等待多少秒(in seconds)之后写入HBase
+HBASE_WRITE_BUFFER_SIZE = 500
+HBASE_WRITE_BUFFER_INTERVAL = 0.1
 
 try:
     from .local_settings import *
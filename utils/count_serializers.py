@@ -0,0 +1,48 @@
+from django.db import models
+from rest_framework import serializers
+from utils.redis_helper import RedisHelper
+
+
+class CountsListSerializer(serializers.ListSerializer):
+    """
+    many=True时使用，序列化之前先用RedisHelper.get_counts批量获取这一页所有的count，
+    每个object再单独调用RedisHelper.get_count时，一页需要2N次redis round trip，
+    cache miss时还有N次数据库查询
+    child需要继承CountsSerializerMixin
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        objects = list(iterable)
+        self.child.prefetch_counts(objects)
+        return super().to_representation(objects)
+
+
+class CountsSerializerMixin:
+    """
+    count_attrs: 需要批量获取的count，例如('likes_count', 'comments_count')
+    批量获取的结果放在context['counts']中，context在嵌套的serializer之间是共享的，
+    NewsFeedSerializer中的TweetSerializer也可以使用
+    """
+    count_attrs = ()
+
+    def get_count_objects(self, objects):
+        """
+        哪些objects的count需要批量获取，例如newsfeed需要获取的是tweet的count
+        """
+        return objects
+
+    def prefetch_counts(self, objects):
+        counts = RedisHelper.get_counts(
+            self.get_count_objects(objects),
+            self.count_attrs,
+        )
+        self.context.setdefault('counts', {}).update(counts)
+
+    def get_count(self, obj, attr):
+        key = RedisHelper.get_count_key(obj, attr)
+        counts = self.context.get('counts', {})
+        if key in counts:
+            return counts[key]
+        # 没有批量获取过，例如单个object的序列化
+        return RedisHelper.get_count(obj, attr)
@@ -1,30 +1,116 @@
 from django.conf import settings
 from django.core.cache import caches
+from utils.single_flight import NOT_CACHED, SingleFlight
+
+import time
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
 
 class MemcachedHelper:
+    """
+    cache中存的是(obj, expire_at, delta)
+    - expire_at: 什么时候过期，memcached不能查询剩余的过期时间，所以自己记录
+    - delta: 从数据库加载花费的时间
+    用于probabilistic early refresh，参考SingleFlight.should_refresh_early
+    """
 
     @classmethod
     def get_key(cls, model_class, object_id):
-        return '{}:{}'.format(model_class.__name__, object_id)
+        # v2: cache中的值从obj变成了(obj, expire_at, delta)
+        return '{}:v2:{}'.format(model_class.__name__, object_id)
 
     @classmethod
-    def get_object_through_cache(cls, model_class, object_id):
-        key = cls.get_key(model_class, object_id)
-        # cache hit
-        obj = cache.get(key)
-        if obj:
-            # print('get {} from cache'.format(key))
-            return obj
+    def get_ttl(cls, expire_at):
+        if expire_at is None:
+            return None
+        return expire_at - time.time()
 
-        # cache miss
+    @classmethod
+    def make_entry(cls, obj, delta):
+        timeout = cache.default_timeout
+        expire_at = None if timeout is None else time.time() + timeout
+        return obj, expire_at, delta
+
+    @classmethod
+    def load_object(cls, model_class, object_id, key):
+        start = time.time()
         obj = model_class.objects.filter(id=object_id).first()
         # print('set {} in cache'.format(key))
-        cache.set(key, obj)
+        cache.set(key, cls.make_entry(obj, time.time() - start))
         return obj
 
+    @classmethod
+    def get_object_through_cache(cls, model_class, object_id):
+        key = cls.get_key(model_class, object_id)
+        # cache hit
+        entry = cache.get(key)
+        if entry is not None and entry[0]:
+            obj, expire_at, delta = entry
+            if not SingleFlight.should_refresh_early(
+                    cls.get_ttl(expire_at), delta):
+                # print('get {} from cache'.format(key))
+                return obj
+            # 快要过期了，只有拿到锁的请求重新加载，其它请求继续使用旧的数据
+            token = SingleFlight.acquire(key)
+            if token is None:
+                return obj
+            try:
+                return cls.load_object(model_class, object_id, key)
+            finally:
+                SingleFlight.release(key, token)
+
+        # cache miss，热门的tweet失效时只有一个请求去数据库加载
+        # 不存在的object也会被缓存为None，等待的进程不需要再等到超时
+        def get_cached():
+            entry = cache.get(key)
+            return NOT_CACHED if entry is None else entry[0]
+
+        return SingleFlight.run(
+            key,
+            lambda: cls.load_object(model_class, object_id, key),
+            get_cached,
+        )
+
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版的get_object_through_cache，返回的list和object_ids的顺序一致，
+        不存在的object为None
+        只需要一次get_many，cache miss的object用一次id__in查询，再一次set_many
+        批量加载本身就把N次查询合并成了一次，所以不再加锁
+        """
+        keys = {
+            object_id: cls.get_key(model_class, object_id)
+            for object_id in object_ids
+        }
+        cached_entries = cache.get_many(list(keys.values()))
+        objects = {}
+        for object_id, key in keys.items():
+            entry = cached_entries.get(key)
+            if entry is None or not entry[0]:
+                continue
+            obj, expire_at, delta = entry
+            if SingleFlight.should_refresh_early(
+                    cls.get_ttl(expire_at), delta):
+                continue
+            objects[object_id] = obj
+
+        missing_ids = [
+            object_id for object_id in keys if object_id not in objects
+        ]
+        if missing_ids:
+            start = time.time()
+            loaded_objects = list(
+                model_class.objects.filter(id__in=missing_ids))
+            delta = time.time() - start
+            cache.set_many({
+                keys[obj.id]: cls.make_entry(obj, delta)
+                for obj in loaded_objects
+            })
+            objects.update({obj.id: obj for obj in loaded_objects})
+        return [objects.get(object_id) for object_id in object_ids]
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
@@ -3,6 +3,9 @@ from rest_framework.response import Response
 from dateutil import parser
 from django.conf import settings
 from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import datetime_to_timestamp
+
+import pytz
 
 
 class EndlessPagination(BasePagination):
@@ -79,6 +82,38 @@ class EndlessPagination(BasePagination):
         # 需要直接去数据库查询
         return None
 
+    def get_timestamp_param(self, request, name):
+        """
+        把created_at__gt/lt转换为in micro seconds的timestamp，和HBase中的一致
+        """
+        if name not in request.query_params:
+            return None
+        value = request.query_params[name]
+        # 兼容iso格式和int格式，先尝试iso格式，20210101这样的值是日期
+        try:
+            created_at = parser.isoparse(value)
+        except ValueError:
+            return int(value)
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=pytz.utc)
+        return datetime_to_timestamp(created_at)
+
+    def paginate_cached_timeline(self, load_page, request):
+        """
+        和paginate_cached_list一样，cache中没有这一页时返回None
+        但不需要读取整个list，load_page只从redis的sorted set中读取这一页，
+        参考RedisHelper.load_timeline_page
+        """
+        result = load_page(
+            page_size=self.page_size,
+            created_at__lt=self.get_timestamp_param(request, 'created_at__lt'),
+            created_at__gt=self.get_timestamp_param(request, 'created_at__gt'),
+        )
+        if result is None:
+            return None
+        page, self.has_next_page = result
+        return page
+
     def paginate_queryset(self, queryset, request, view=None):
 
         if 'created_at__gt' in request.query_params:
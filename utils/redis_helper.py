@@ -1,78 +1,221 @@
 from django.conf import settings
 from utils.redis_client import RedisClient
-from django_hbase.models import HBaseModel
-from utils.redis_serializers import DjangoModelSerializer, HBaseSerializer
+from utils.single_flight import NOT_CACHED, SingleFlight
+
+# Lua脚本在redis中原子的执行，多个命令只需要一次round trip
+# 多个进程同时load时只有第一个会写入，避免timeline中出现重复的数据
+# timeline用sorted set存储，score是created_at(in micro seconds)
+# KEYS[1]: timeline的key，ARGV[1]: 超时时间，ARGV[2:]是score, member交替的序列
+LOAD_TIMELINE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+'''
+
+# ARGV[1]: 长度上限，ARGV[2]: score，ARGV[3]: member
+# 超过长度上限时删除score最小(最旧)的那些
+PUSH_TIMELINE_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+return 1
+'''
+
+# write-behind模式下还没有写入数据库的count的增量，field是count的key，
+# 参考utils.write_behind_counters
+DIRTY_COUNTS_KEY = 'dirty_counts'
+# 正在写入数据库的增量
+FLUSHING_COUNTS_KEY = 'dirty_counts:flushing'
+
+# count的key不存在时用数据库中的值回填，write-behind模式下数据库中的值还缺少
+# 没有flush的增量，需要加上
+# KEYS[1]: count的key，KEYS[2], KEYS[3]: DIRTY_COUNTS_KEY, FLUSHING_COUNTS_KEY
+# ARGV[1]: 数据库中的值，ARGV[2]: 超时时间
+BACKFILL_COUNT_SCRIPT = '''
+local count = tonumber(ARGV[1]) +
+    tonumber(redis.call('HGET', KEYS[2], KEYS[1]) or 0) +
+    tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or 0)
+if redis.call('SET', KEYS[1], count, 'EX', ARGV[2], 'NX') then
+    return count
+end
+return tonumber(redis.call('GET', KEYS[1]))
+'''
 
 
 class RedisHelper:
+    # {script: redis.commands.core.Script}，第一次执行之后redis中缓存了脚本，
+    # 之后只需要发送sha1(EVALSHA)
+    scripts = {}
 
     @classmethod
-    def _load_objects_to_cache(cls, key, objects, serializer):
+    def get_script(cls, script):
         conn = RedisClient.get_connection()
+        registered_script = cls.scripts.get(script)
+        if registered_script is None or \
+                registered_script.registered_client is not conn:
+            registered_script = conn.register_script(script)
+            cls.scripts[script] = registered_script
+        return registered_script
 
-        serialized_list = []
-        # objects已经被截断了
+    @classmethod
+    def run_script(cls, script, keys, args, client=None):
+        """
+        client可以是pipeline，脚本在pipeline.execute()时执行
+        """
+        return cls.get_script(script)(keys=keys, args=args, client=client)
+
+    @classmethod
+    def _load_timeline_to_cache(cls, key, objects, serializer):
+        args = []
         for obj in objects:
-            serialized_data = serializer.serialize(obj)
-            serialized_list.append(serialized_data)
+            args.extend([serializer.get_score(obj), serializer.serialize(obj)])
+        if args:
+            cls.run_script(
+                LOAD_TIMELINE_SCRIPT,
+                keys=[key],
+                args=[settings.REDIS_KEY_EXPIRE_TIME, *args],
+            )
 
+    @classmethod
+    def _rebuild_timeline(cls, key, lazy_load_objects, serializer):
+        """
+        cache miss时只有一个进程从数据库加载，其它进程等待加载完成之后从cache读取
+        返回按created_at降序排列的所有objects
+        """
+        def load():
+            objects = list(lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT))
+            cls._load_timeline_to_cache(key, objects, serializer)
+            if not objects:
+                # 例如新用户的timeline，redis中不会有这个key
+                SingleFlight.mark_empty(key)
+            return objects
+
+        def get_cached():
+            serialized_list = RedisClient.get_connection().zrevrange(key, 0, -1)
+            if serialized_list:
+                return serializer.deserialize_list(serialized_list)
+            return [] if SingleFlight.is_empty(key) else NOT_CACHED
+
+        return SingleFlight.run(key, load, get_cached)
+
+    @classmethod
+    def _refresh_timeline_early(cls, key, pttl):
+        """
+        timeline在写入时已经同步更新了，内容不会过时，提前刷新只需要延长过期时间，
+        访问频繁的timeline就不会过期，也就不会有大量请求同时去数据库加载
+        """
+        if pttl > 0 and SingleFlight.should_refresh_early(
+                pttl / 1000, settings.TIMELINE_REBUILD_TIME):
+            RedisClient.get_connection().expire(
+                key, settings.REDIS_KEY_EXPIRE_TIME)
+
+    @classmethod
+    def load_timeline(cls, key, lazy_load_objects, serializer):
+        """
+        返回按created_at降序排列的所有缓存的objects
+        serializer需要是TimelineSerializer，提供score
+        """
+        pipeline = RedisClient.get_connection().pipeline(transaction=False)
+        pipeline.zrevrange(key, 0, -1)
+        pipeline.pttl(key)
+        serialized_list, pttl = pipeline.execute()
         if serialized_list:
-            # 在尾部插入serialized_list中的所有元素到key对应的list中
-            # rpush, lpush可以接受list值，也可以是单个值
-            conn.rpush(key, *serialized_list)
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)  # 设置超时时间
+            cls._refresh_timeline_early(key, pttl)
+            return serializer.deserialize_list(serialized_list)
+        return cls._rebuild_timeline(key, lazy_load_objects, serializer)
 
     @classmethod
-    def load_objects(
-            cls, key, lazy_load_objects, serializer=DjangoModelSerializer):
-        conn = RedisClient.get_connection()
+    def load_timeline_page(cls, key, lazy_load_objects, serializer,
+                           page_size, created_at__lt=None,
+                           created_at__gt=None):
+        """
+        只读取一页，返回(objects, has_next_page)，created_at__lt/gt是
+        in micro seconds的timestamp，不包含边界
+        - created_at__gt: 比它新的所有objects，不分页
+        - 其它情况：page_size + 1个，多取的一个用于判断是否有下一页
+        cache中的数据不够一页，并且cache已经存满时，剩下的数据可能在数据库中，
+        返回None
+        ZREVRANGEBYSCORE, ZCARD和PTTL在一个pipeline中，只需要一次round trip
+        """
+        max_score = '+inf' if created_at__lt is None else f'({created_at__lt}'
+        min_score = '-inf' if created_at__gt is None else f'({created_at__gt}'
+        limit = {} if created_at__gt is not None else {
+            'start': 0, 'num': page_size + 1,
+        }
 
-        # 如果在cache里，就直接拿出来
-        if conn.exists(key):
-            # 从左往右全部取出来
-            serialized_list = conn.lrange(key, 0, -1)
-            objects = []
-            for serialized_data in serialized_list:
-                serialized_obj = serializer.deserialize(serialized_data)
-                objects.append(serialized_obj)
-            return objects
+        pipeline = RedisClient.get_connection().pipeline(transaction=False)
+        pipeline.zrevrangebyscore(key, max_score, min_score, **limit)
+        pipeline.zcard(key)
+        pipeline.pttl(key)
+        items, size, pttl = pipeline.execute()
 
-        # 如果key不存在，就存入cache中
-        # 最多只 cache REDIS_LIST_LENGTH_LIMIT 那么多个 objects
-        # 超过这个限制的 objects，就去数据库里读取。
-        # 一般这个限制会比较大，比如 1000
-        # 因此翻页翻到 1000 的用户访问量会比较少，从数据库读取也不是大问题
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
-        # 这里没有再去从cache中获取tweets，而是采用list
-        # 此时list方法不会再次产生query查询，因为在_load_objects_to_cache
-        # 中遍历了queryset并产生了query查询，queryset会缓存查询结果
-        return list(objects)
+        cache_hit = size > 0
+        if cache_hit:
+            cls._refresh_timeline_early(key, pttl)
+        else:
+            # cache miss，整个timeline从数据库加载到cache中，这一页直接从中选出来
+            objects = cls._rebuild_timeline(key, lazy_load_objects, serializer)
+            size = len(objects)
+            items = [
+                obj for obj in objects
+                if (created_at__lt is None or
+                    serializer.get_score(obj) < created_at__lt) and
+                (created_at__gt is None or
+                 serializer.get_score(obj) > created_at__gt)
+            ]
 
-    @classmethod
-    def push_object(cls, key, obj, lazy_load_objects):
-        if isinstance(obj, HBaseModel):
-            serializer = HBaseSerializer
+        if created_at__gt is not None:
+            has_next_page = False
+        elif len(items) > page_size:
+            items, has_next_page = items[:page_size], True
+        elif size < settings.REDIS_LIST_LENGTH_LIMIT:
+            has_next_page = False
         else:
-            serializer = DjangoModelSerializer
+            return None
+        if cache_hit:
+            # 多取的一个不需要反序列化
+            items = serializer.deserialize_list(items)
+        return items, has_next_page
 
-        conn = RedisClient.get_connection()
-        if conn.exists(key):
-            # 这里使用lpush，添加到头部，保证是按时间降序的
-            serialized_data = serializer.serialize(obj)
-            conn.lpush(key, serialized_data)
-            conn.ltrim(key, 0, settings.REDIS_LIST_LENGTH_LIMIT - 1)
+    @classmethod
+    def push_timeline_object(cls, key, obj, lazy_load_objects, serializer):
+        args = [
+            settings.REDIS_LIST_LENGTH_LIMIT,
+            serializer.get_score(obj),
+            serializer.serialize(obj),
+        ]
+        if cls.run_script(PUSH_TIMELINE_SCRIPT, keys=[key], args=args):
             return
-
-        # 如果key不存在，就直接从数据库load
-        # 不走单个push的方式加到cache里了
-        objects = lazy_load_objects(settings.REDIS_LIST_LENGTH_LIMIT)
-        cls._load_objects_to_cache(key, objects, serializer)
+        cls._rebuild_timeline(key, lazy_load_objects, serializer)
+        # 其它进程可能在obj写入数据库之前就开始加载了，再push一次，
+        # sorted set中相同的member不会重复
+        cls.run_script(PUSH_TIMELINE_SCRIPT, keys=[key], args=args)
 
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
 
+    @classmethod
+    def backfill_count(cls, obj, attr, count, client=None):
+        """
+        count是数据库中的值，key已经存在时不覆盖，返回cache中的count
+        """
+        return cls.run_script(
+            BACKFILL_COUNT_SCRIPT,
+            keys=[
+                cls.get_count_key(obj, attr),
+                DIRTY_COUNTS_KEY,
+                FLUSHING_COUNTS_KEY,
+            ],
+            args=[count, settings.REDIS_KEY_EXPIRE_TIME],
+            client=client,
+        )
+
     @classmethod
     def incr_count(cls, obj, attr):
         conn = RedisClient.get_connection()
@@ -82,9 +225,7 @@ class RedisHelper:
             # 不执行+1操作，因为调用incr_count之前，已经在数据库中执行了+1
             # 并且obj重新从数据库加载了
             obj.refresh_from_db()
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+            return cls.backfill_count(obj, attr, getattr(obj, attr))
         return conn.incr(key)
 
     @classmethod
@@ -94,9 +235,7 @@ class RedisHelper:
         if not conn.exists(key):
             obj.refresh_from_db()
             # 不执行-1操作
-            conn.set(key, getattr(obj, attr))
-            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
-            return getattr(obj, attr)
+            return cls.backfill_count(obj, attr, getattr(obj, attr))
         return conn.decr(key)
 
     @classmethod
@@ -109,6 +248,51 @@ class RedisHelper:
 
         # obj有可能是从cache中获取的，要重新从数据库中加载
         obj.refresh_from_db()
-        count = getattr(obj, attr)
-        conn.set(key, count)
-        return count
+        return cls.backfill_count(obj, attr, getattr(obj, attr))
+
+    @classmethod
+    def get_counts(cls, objects, attrs):
+        """
+        批量版的get_count，一页的objects只需要一次MGET
+        cache miss的用一次id__in查询从数据库加载，再用一个pipeline回填到cache
+        返回{count_key: count}，count_key参考get_count_key
+        """
+        keys = [
+            (obj, attr, cls.get_count_key(obj, attr))
+            for obj in objects
+            for attr in attrs
+        ]
+        if not keys:
+            return {}
+        conn = RedisClient.get_connection()
+        cached_counts = conn.mget([key for _, _, key in keys])
+
+        counts = {}
+        # {model_class: {object_id: obj}}
+        missing_objects = {}
+        for (obj, attr, key), count in zip(keys, cached_counts):
+            if count is not None:
+                counts[key] = int(count)
+            else:
+                missing_objects.setdefault(obj.__class__, {})[obj.id] = obj
+        if not missing_objects:
+            return counts
+
+        pipeline = conn.pipeline(transaction=False)
+        backfilled_keys = []
+        for model_class, objects_by_id in missing_objects.items():
+            # obj有可能是从cache中获取的，count要从数据库中加载
+            rows = model_class.objects.filter(
+                id__in=objects_by_id.keys(),
+            ).values('id', *attrs)
+            for row in rows:
+                obj = objects_by_id[row['id']]
+                for attr in attrs:
+                    key = cls.get_count_key(obj, attr)
+                    if key in counts:
+                        continue
+                    cls.backfill_count(obj, attr, row[attr], client=pipeline)
+                    backfilled_keys.append(key)
+        # 返回的是回填之后cache中的值，write-behind模式下包含没有flush的增量
+        counts.update(zip(backfilled_keys, pipeline.execute()))
+        return counts
@@ -3,6 +3,7 @@ from utils.json_encoder import JSONEncoder
 from django_hbase.models import HBaseModel
 
 import json
+import struct
 
 
 class DjangoModelSerializer:
@@ -19,6 +20,11 @@ class DjangoModelSerializer:
         # ORM 的 object，而是一个 DeserializedObject 的类型
         return list(serializers.deserialize('json', serialized_data))[0].object
 
+    @classmethod
+    def deserialize_list(cls, serialized_list):
+        return [cls.deserialize(serialized_data)
+                for serialized_data in serialized_list]
+
 
 class HBaseSerializer:
     """
@@ -49,3 +55,54 @@ class HBaseSerializer:
         model_class = cls.get_model_class(json_data['model_class_name'])
         del json_data['model_class_name']
         return model_class(**json_data)
+
+    @classmethod
+    def deserialize_list(cls, serialized_list):
+        return [cls.deserialize(serialized_data)
+                for serialized_data in serialized_list]
+
+
+class TimelineSerializer:
+    """
+    redis中timeline(list)的每个元素只存几个定长的整数，例如(created_at, tweet_id)
+    打包为16 bytes，而不是DjangoModelSerializer的200+ bytes的json
+    读取时整个list一起还原，需要完整的object时通过cache批量获取，
+    也不需要django的反序列化
+    子类需要定义format(struct的格式)，get_values和from_values_list
+    get_values的第一个值必须是created_at，参考RedisHelper.load_timeline
+    """
+    format = None
+
+    @classmethod
+    def get_values(cls, instance):
+        raise NotImplementedError
+
+    @classmethod
+    def from_values_list(cls, values_list):
+        """
+        返回object list，已经不存在的object会被跳过
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def get_score(cls, instance):
+        """
+        第一个值是created_at(in micro seconds)，作为sorted set中的score
+        """
+        return cls.get_values(instance)[0]
+
+    @classmethod
+    def serialize(cls, instance):
+        return struct.pack(cls.format, *cls.get_values(instance))
+
+    @classmethod
+    def deserialize(cls, serialized_data):
+        objects = cls.deserialize_list([serialized_data])
+        return objects[0] if objects else None
+
+    @classmethod
+    def deserialize_list(cls, serialized_list):
+        return cls.from_values_list([
+            struct.unpack(cls.format, serialized_data)
+            for serialized_data in serialized_list
+        ])
@@ -0,0 +1,107 @@
+from django.conf import settings
+from utils.redis_client import RedisClient
+
+import math
+import random
+import time
+import uuid
+
+# 只有持有锁的进程才能删除，避免lease过期之后删除了别人的锁
+RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+
+# get_cached()返回NOT_CACHED表示还没有加载完，None、[]等都是加载好的结果
+NOT_CACHED = object()
+
+
+class SingleFlight:
+    """
+    热门的cache失效时，所有的请求都会同时去数据库加载同样的数据(cache stampede)
+    用redis实现一个分布式的锁，同一个key只有拿到锁的进程去加载，其它进程等待
+    cache被写入之后直接读取
+    锁有一个很短的lease(SINGLE_FLIGHT_LEASE)，加载的进程挂掉也不会一直锁住
+    """
+    poll_interval = 0.02
+
+    @classmethod
+    def get_lock_key(cls, key):
+        return f'single_flight:{key}'
+
+    @classmethod
+    def get_empty_key(cls, key):
+        return f'single_flight_empty:{key}'
+
+    @classmethod
+    def mark_empty(cls, key):
+        """
+        加载的结果为空时，redis中不会有这个key(例如空的list)，等待的进程无法
+        区分"还没有加载完"和"加载完了但是为空"，所以额外记录一下
+        只需要在等待的这段时间内有效
+        """
+        RedisClient.get_connection().set(
+            cls.get_empty_key(key), 1,
+            px=int(settings.SINGLE_FLIGHT_LEASE * 1000),
+        )
+
+    @classmethod
+    def is_empty(cls, key):
+        return bool(RedisClient.get_connection().exists(cls.get_empty_key(key)))
+
+    @classmethod
+    def acquire(cls, key, lease=None):
+        """
+        拿到锁时返回token，否则返回None
+        lease: 锁的有效时间(in seconds)，默认是SINGLE_FLIGHT_LEASE
+        """
+        if lease is None:
+            lease = settings.SINGLE_FLIGHT_LEASE
+        token = uuid.uuid4().hex
+        acquired = RedisClient.get_connection().set(
+            cls.get_lock_key(key), token, nx=True, px=int(lease * 1000),
+        )
+        return token if acquired else None
+
+    @classmethod
+    def release(cls, key, token):
+        conn = RedisClient.get_connection()
+        conn.eval(RELEASE_LOCK_SCRIPT, 1, cls.get_lock_key(key), token)
+
+    @classmethod
+    def run(cls, key, load, get_cached):
+        """
+        拿到锁时执行load()写入cache并返回结果
+        没有拿到锁时轮询get_cached()，直到返回的不是NOT_CACHED
+        等待超过SINGLE_FLIGHT_WAIT秒(加载的进程太慢或者挂掉了)，自己执行load()
+        """
+        token = cls.acquire(key)
+        if token is not None:
+            try:
+                return load()
+            finally:
+                cls.release(key, token)
+
+        deadline = time.time() + settings.SINGLE_FLIGHT_WAIT
+        while time.time() < deadline:
+            time.sleep(cls.poll_interval)
+            value = get_cached()
+            if value is not NOT_CACHED:
+                return value
+        return load()
+
+    @classmethod
+    def should_refresh_early(cls, ttl, delta):
+        """
+        probabilistic early refresh(XFetch)
+        ttl: 还有多久过期，delta: 重新加载需要的时间(in seconds)
+        离过期越近、加载越慢，提前刷新的概率越大，访问越多的key越可能在过期之前
+        被某一个请求刷新，不会在同一时刻全部失效
+        """
+        if ttl is None:
+            return False
+        # 1 - random()的范围是(0, 1]，log不会出错
+        return ttl <= -delta * settings.CACHE_EARLY_REFRESH_BETA * \
+            math.log(1 - random.random())
@@ -1,5 +1,21 @@
+from datetime import datetime
+from django.conf import settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
 from testing.testcases import TestCase
+from tweets.services import TweetTimelineSerializer
 from utils.redis_client import RedisClient
+from utils.paginations import EndlessPagination
+from utils.redis_helper import (
+    LOAD_TIMELINE_SCRIPT,
+    PUSH_TIMELINE_SCRIPT,
+    RedisHelper,
+)
+from utils.single_flight import SingleFlight
+from utils.time_helpers import datetime_to_timestamp
+
+import pytz
+import time
 
 
 class UtilsTests(TestCase):
@@ -25,3 +41,89 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_redis_helper_scripts(self):
+        conn = RedisClient.get_connection()
+        # key不存在时不会push
+        self.assertEqual(RedisHelper.run_script(
+            PUSH_TIMELINE_SCRIPT, keys=['redis_key'], args=[3, 1, 'a']), 0)
+        self.assertEqual(conn.exists('redis_key'), False)
+
+        # 已经存在时不会重复load
+        for _ in range(2):
+            RedisHelper.run_script(
+                LOAD_TIMELINE_SCRIPT,
+                keys=['redis_key'],
+                args=[60, 2, 'b', 3, 'c'],
+            )
+        self.assertEqual(conn.zrevrange('redis_key', 0, -1), [b'c', b'b'])
+        self.assertGreater(conn.ttl('redis_key'), 0)
+
+        # push之后超过长度上限的时候删除最旧的
+        for score, value in [(4, 'd'), (5, 'e')]:
+            RedisHelper.run_script(
+                PUSH_TIMELINE_SCRIPT,
+                keys=['redis_key'],
+                args=[3, score, value],
+            )
+        self.assertEqual(
+            conn.zrevrange('redis_key', 0, -1), [b'e', b'd', b'c'])
+
+    def test_timestamp_param(self):
+        paginator = EndlessPagination()
+
+        def get_param(value):
+            request = Request(APIRequestFactory().get(
+                '/', {'created_at__lt': value}))
+            return paginator.get_timestamp_param(request, 'created_at__lt')
+
+        date = datetime(2021, 1, 1, tzinfo=pytz.utc)
+        self.assertEqual(get_param('2021-01-01'), datetime_to_timestamp(date))
+        # 全是数字的iso格式也是日期，不是timestamp
+        self.assertEqual(get_param('20210101'), datetime_to_timestamp(date))
+        self.assertEqual(get_param('1637000000000000'), 1637000000000000)
+        self.assertEqual(paginator.get_timestamp_param(
+            Request(APIRequestFactory().get('/')), 'created_at__lt'), None)
+
+    def test_single_flight(self):
+        token = SingleFlight.acquire('key')
+        self.assertIsNotNone(token)
+        # 锁已经被拿走了
+        self.assertIsNone(SingleFlight.acquire('key'))
+        # token不对时不会删除别人的锁
+        SingleFlight.release('key', 'wrong token')
+        self.assertIsNone(SingleFlight.acquire('key'))
+
+        # 没有拿到锁时等待cache写入，不会执行load
+        loads = []
+        result = SingleFlight.run(
+            'key', lambda: loads.append(1) or 'loaded', lambda: 'cached')
+        self.assertEqual(result, 'cached')
+        self.assertEqual(loads, [])
+
+        SingleFlight.release('key', token)
+        result = SingleFlight.run(
+            'key', lambda: loads.append(1) or 'loaded', lambda: 'cached')
+        self.assertEqual(result, 'loaded')
+        self.assertEqual(loads, [1])
+        # 执行完之后锁被释放
+        self.assertIsNotNone(SingleFlight.acquire('key'))
+
+        # 加载完的结果为None或者空的list时，等待的进程也不会等到超时
+        def must_not_load(*args):
+            raise AssertionError('should not load')
+
+        SingleFlight.acquire('empty_key')
+        start = time.time()
+        self.assertIsNone(
+            SingleFlight.run('empty_key', must_not_load, lambda: None))
+        timeline_key = 'user_tweets:v3:1'
+        SingleFlight.acquire(timeline_key)
+        SingleFlight.mark_empty(timeline_key)
+        self.assertEqual(RedisHelper.load_timeline(
+            timeline_key, must_not_load, TweetTimelineSerializer), [])
+        self.assertLess(time.time() - start, settings.SINGLE_FLIGHT_WAIT)
+
+        self.assertFalse(SingleFlight.should_refresh_early(None, 1))
+        self.assertFalse(SingleFlight.should_refresh_early(3600, 0.001))
+        self.assertTrue(SingleFlight.should_refresh_early(0, 0.001))
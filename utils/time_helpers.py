@@ -1,6 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def datetime_to_timestamp(value):
+    """
+    datetime => in micro seconds，用整数运算，float会有精度误差
+    """
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def timestamp_to_datetime(value):
+    return EPOCH + timedelta(microseconds=value)
@@ -0,0 +1,284 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from gatekeeper.models import GateKeeper
+from utils.redis_client import RedisClient
+from utils.redis_helper import (
+    DIRTY_COUNTS_KEY,
+    FLUSHING_COUNTS_KEY,
+    RedisHelper,
+)
+from utils.single_flight import SingleFlight
+
+# 每一个flush过的count都会被reconcile一次
+RECONCILE_COUNTS_KEY = 'dirty_counts:reconcile'
+
+# 先记录增量，key存在时再修改count，key不存在时返回nil，由调用者回填
+# 回填时会加上这个增量，参考BACKFILL_COUNT_SCRIPT
+# KEYS[1]: count的key，KEYS[2]: DIRTY_COUNTS_KEY，ARGV[1]: 增量，ARGV[2]: 超时时间
+CHANGE_COUNT_SCRIPT = '''
+redis.call('HINCRBY', KEYS[2], KEYS[1], ARGV[1])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+'''
+
+# 把DIRTY_COUNTS_KEY改名为FLUSHING_COUNTS_KEY，之后的增量写入新的hash
+# 上一次flush没有完成时(FLUSHING_COUNTS_KEY还存在)，先重新flush上一次的增量
+# KEYS[1]: DIRTY_COUNTS_KEY，KEYS[2]: FLUSHING_COUNTS_KEY
+TAKE_DIRTY_COUNTS_SCRIPT = '''
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+return redis.call('HGETALL', KEYS[2])
+'''
+
+# 还没有写入数据库的增量是DIRTY_COUNTS_KEY和FLUSHING_COUNTS_KEY(上一次flush
+# 失败时)中的增量之和，和count之前的快照相同时才用实际的count覆盖cache并返回增量，
+# 数据库中的值应该是两者之差
+# 不同时说明count的过程中有新的增量，实际的count可能已经包含了它，跳过这个key，
+# 放回RECONCILE_COUNTS_KEY下一次再reconcile
+# KEYS[1]: count的key，KEYS[2], KEYS[3]: DIRTY_COUNTS_KEY, FLUSHING_COUNTS_KEY
+# KEYS[4]: RECONCILE_COUNTS_KEY，ARGV[1]: 实际的count，ARGV[2]: 增量的快照
+RECONCILE_COUNT_SCRIPT = '''
+local pending = tonumber(redis.call('HGET', KEYS[2], KEYS[1]) or 0) +
+    tonumber(redis.call('HGET', KEYS[3], KEYS[1]) or 0)
+if pending ~= tonumber(ARGV[2]) then
+    redis.call('SADD', KEYS[4], KEYS[1])
+    return false
+end
+redis.call('SET', KEYS[1], ARGV[1], 'XX', 'KEEPTTL')
+return pending
+'''
+
+
+class WriteBehindCounter:
+    """
+    likes_count, comments_count的write-behind模式，热门的tweet每次点赞都要
+    UPDATE同一行，在mysql中会有行锁的竞争
+    - 打开switch_write_behind_counters之后，count只在redis中修改，redis是
+      source of truth，增量记录在DIRTY_COUNTS_KEY中
+    - flush_counts_task定期把增量汇总之后，每一个count字段只需要一条
+      UPDATE ... CASE语句写入数据库
+    - 进程崩溃、redis数据丢失等都会让数据库和redis中的count漂移，flush之后
+      reconcile用实际的likes/comments数量修复
+    """
+    switch_name = 'switch_write_behind_counters'
+    lock_key = 'write_behind_counters'
+    # {'Tweet.likes_count': (model_label, attr, count_objects)}
+    # count_objects(model_class, object_ids)返回{object_id: 实际的count}
+    counters = {}
+
+    @classmethod
+    def is_enabled(cls):
+        return GateKeeper.is_switch_on(cls.switch_name)
+
+    @classmethod
+    def register(cls, model_label, attr, count_objects):
+        """
+        model_label例如'tweets.Tweet'，用字符串避免models之间的循环依赖
+        """
+        model_name = model_label.split('.')[-1]
+        cls.counters[f'{model_name}.{attr}'] = (
+            model_label, attr, count_objects,
+        )
+
+    @classmethod
+    def parse_count_key(cls, key):
+        """
+        count的key参考RedisHelper.get_count_key，返回(counter, object_id)
+        """
+        counter_name, object_id = key.rsplit(':', 1)
+        return cls.counters[counter_name], int(object_id)
+
+    @classmethod
+    def change_count(cls, obj, attr, delta):
+        """
+        obj只需要有id，cache miss时才会从数据库加载
+        """
+        key = RedisHelper.get_count_key(obj, attr)
+        count = RedisHelper.run_script(
+            CHANGE_COUNT_SCRIPT,
+            keys=[key, DIRTY_COUNTS_KEY],
+            args=[delta, settings.REDIS_KEY_EXPIRE_TIME],
+        )
+        if count is not None:
+            return count
+        # 数据库中还没有这次的增量，回填时会从DIRTY_COUNTS_KEY中加上
+        obj.refresh_from_db()
+        return RedisHelper.backfill_count(obj, attr, getattr(obj, attr))
+
+    @classmethod
+    def incr_count(cls, obj, attr):
+        return cls.change_count(obj, attr, 1)
+
+    @classmethod
+    def decr_count(cls, obj, attr):
+        return cls.change_count(obj, attr, -1)
+
+    @classmethod
+    def group_counts(cls, counts):
+        """
+        {count_key: value}按照counter分组，返回{counter: {object_id: value}}
+        """
+        groups = {}
+        for key, value in counts.items():
+            counter, object_id = cls.parse_count_key(key)
+            groups.setdefault(counter, {})[object_id] = int(value)
+        return groups
+
+    @classmethod
+    def bulk_update(cls, model_class, attr, values, incremental):
+        """
+        values: {object_id: value}，所有的object只需要一条UPDATE语句
+        UPDATE ... SET attr = attr + CASE id WHEN 1 THEN 3 ... END WHERE id IN
+        incremental为False时直接设置为value
+        """
+        if not values:
+            return 0
+        case = Case(
+            *[
+                When(id=object_id, then=Value(value))
+                for object_id, value in values.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+        return model_class.objects.filter(id__in=values.keys()).update(
+            **{attr: F(attr) + case if incremental else case},
+        )
+
+    @classmethod
+    def flush(cls):
+        """
+        把增量写入数据库，返回更新的行数
+        lock保证同一时间只有一个进程在flush或者reconcile
+        """
+        token = SingleFlight.acquire(
+            cls.lock_key, lease=settings.WRITE_BEHIND_LOCK_LEASE)
+        if token is None:
+            return 0
+        try:
+            flat_counts = RedisHelper.run_script(
+                TAKE_DIRTY_COUNTS_SCRIPT,
+                keys=[DIRTY_COUNTS_KEY, FLUSHING_COUNTS_KEY],
+                args=[],
+            )
+            deltas = dict(zip(flat_counts[::2], flat_counts[1::2]))
+            if not deltas:
+                return 0
+            rows = 0
+            groups = cls.group_counts({
+                key.decode(): delta for key, delta in deltas.items()
+            })
+            # 所有的UPDATE在一个事务中，中途失败时全部回滚，下一次flush重新写入
+            # 时不会重复加上已经提交的增量
+            with transaction.atomic():
+                for (model_label, attr, _), values in groups.items():
+                    rows += cls.bulk_update(
+                        apps.get_model(model_label),
+                        attr,
+                        {
+                            object_id: delta
+                            for object_id, delta in values.items() if delta
+                        },
+                        incremental=True,
+                    )
+            # 写入数据库之后再删除，中途失败时下一次flush会重新写入
+            conn = RedisClient.get_connection()
+            pipeline = conn.pipeline()
+            pipeline.delete(FLUSHING_COUNTS_KEY)
+            pipeline.sadd(RECONCILE_COUNTS_KEY, *deltas.keys())
+            pipeline.execute()
+            return rows
+        finally:
+            SingleFlight.release(cls.lock_key, token)
+
+    @classmethod
+    def get_pending_deltas(cls, keys):
+        """
+        返回每个count的key还没有写入数据库的增量
+        """
+        pipeline = RedisClient.get_connection().pipeline(transaction=False)
+        for key in keys:
+            pipeline.hget(DIRTY_COUNTS_KEY, key)
+            pipeline.hget(FLUSHING_COUNTS_KEY, key)
+        values = [int(value or 0) for value in pipeline.execute()]
+        return [
+            dirty + flushing
+            for dirty, flushing in zip(values[::2], values[1::2])
+        ]
+
+    @classmethod
+    def reconcile_objects(cls, model_label, attr, object_ids):
+        """
+        用实际的count修复redis和数据库中的count
+        redis中是实际的count，数据库中是实际的count减去还没有flush的增量
+        count的过程中有新的增量的object会被跳过，留到下一次reconcile
+        """
+        count_objects = cls.counters[
+            '{}.{}'.format(model_label.split('.')[-1], attr)][2]
+        model_class = apps.get_model(model_label)
+        keys = [
+            RedisHelper.get_count_key(model_class(id=object_id), attr)
+            for object_id in object_ids
+        ]
+        # 先记录增量的快照再count，count之后才提交的like会改变增量
+        snapshots = cls.get_pending_deltas(keys)
+        actual_counts = count_objects(model_class, object_ids)
+
+        pipeline = RedisClient.get_connection().pipeline(transaction=False)
+        for object_id, key, snapshot in zip(object_ids, keys, snapshots):
+            RedisHelper.run_script(
+                RECONCILE_COUNT_SCRIPT,
+                keys=[
+                    key,
+                    DIRTY_COUNTS_KEY,
+                    FLUSHING_COUNTS_KEY,
+                    RECONCILE_COUNTS_KEY,
+                ],
+                args=[actual_counts.get(object_id, 0), snapshot],
+                client=pipeline,
+            )
+        pending_deltas = pipeline.execute()
+        return cls.bulk_update(
+            model_class,
+            attr,
+            {
+                object_id: actual_counts.get(object_id, 0) - pending
+                for object_id, pending in zip(object_ids, pending_deltas)
+                if pending is not None
+            },
+            incremental=False,
+        )
+
+    @classmethod
+    def reconcile(cls, batch_size=None):
+        """
+        每次最多reconcile batch_size个flush过的count，返回更新的行数
+        """
+        if batch_size is None:
+            batch_size = settings.WRITE_BEHIND_RECONCILE_BATCH_SIZE
+        token = SingleFlight.acquire(
+            cls.lock_key, lease=settings.WRITE_BEHIND_LOCK_LEASE)
+        if token is None:
+            return 0
+        try:
+            conn = RedisClient.get_connection()
+            keys = conn.spop(RECONCILE_COUNTS_KEY, batch_size)
+            if not keys:
+                return 0
+            rows = 0
+            groups = cls.group_counts({key.decode(): 0 for key in keys})
+            for (model_label, attr, _), values in groups.items():
+                rows += cls.reconcile_objects(
+                    model_label, attr, list(values.keys()))
+            return rows
+        finally:
+            SingleFlight.release(cls.lock_key, token)